@@ -0,0 +1,12 @@
+"""
+Benchmarks for the cwfs reconstruction pipeline.
+
+The benchmark classes follow the asv conventions (``params``, ``setup``,
+``time_*`` methods), so they run under asv with the asv.conf.json at the
+top of the repository.  They can also be run without asv,
+
+    python -m benchmarks [-k pattern] [--quick] [--json results.json]
+
+which reports the time per call and the peak memory traced by tracemalloc
+for every stage.
+"""
@@ -0,0 +1,115 @@
+"""
+Run the benchmarks without asv:
+
+    python -m benchmarks [-k pattern] [--repeat N] [--quick] [--json file]
+
+Every time_* method is called once to warm the caches, then timed with
+timeit (best of --repeat runs), then called once more under tracemalloc
+for its peak memory.
+"""
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import pkgutil
+import timeit
+import tracemalloc
+
+import benchmarks
+
+
+def benchmarkClasses():
+    for info in sorted(pkgutil.iter_modules(benchmarks.__path__),
+                       key=lambda info: info.name):
+        if not info.name.startswith('bench_'):
+            continue
+        module = importlib.import_module('benchmarks.' + info.name)
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if (cls.__module__ == module.__name__ and
+                    any(m.startswith('time_') for m in dir(cls))):
+                yield cls
+
+
+def paramSets(cls):
+    params = getattr(cls, 'params', None)
+    if params is None:
+        return [()]
+    if (len(params) > 0 and all(isinstance(p, list) for p in params)):
+        return list(itertools.product(*params))
+    return [(p,) for p in params]
+
+
+def runBenchmark(cls, method, params, repeat, quick):
+    bench = cls()
+    if hasattr(bench, 'setup'):
+        try:
+            bench.setup(*params)
+        except NotImplementedError:
+            return None
+    func = getattr(bench, method)
+    try:
+        func(*params)
+        if quick:
+            seconds = timeit.timeit(lambda: func(*params), number=1)
+        else:
+            timer = timeit.Timer(lambda: func(*params))
+            number, _ = timer.autorange()
+            seconds = min(timer.repeat(repeat, number)) / number
+        tracemalloc.start()
+        try:
+            func(*params)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*params)
+    return seconds, peak
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Time the cwfs pipeline stages and report their peak '
+        'memory')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timing runs, the best one is kept')
+    parser.add_argument('--quick', action='store_true',
+                        help='time a single call of each benchmark')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(args)
+
+    results = []
+    print('%-50s %-24s %12s %10s' % ('benchmark', 'params', 'time (ms)',
+                                     'peak (MB)'))
+    for cls in benchmarkClasses():
+        methods = sorted(m for m in dir(cls) if m.startswith('time_'))
+        for method in methods:
+            name = '%s.%s.%s' % (cls.__module__.split('.')[-1],
+                                 cls.__name__, method)
+            if args.pattern not in name:
+                continue
+            for params in paramSets(cls):
+                result = runBenchmark(cls, method, params, args.repeat,
+                                      args.quick)
+                if result is None:
+                    continue
+                seconds, peak = result
+                print('%-50s %-24s %12.3f %10.2f' % (
+                    name, ', '.join(str(p) for p in params), seconds * 1e3,
+                    peak / 1024**2), flush=True)
+                results.append(dict(
+                    name=name, params=dict(zip(
+                        getattr(cls, 'param_names', []), params)),
+                    seconds=seconds, peakBytes=peak))
+
+    if args.json:
+        with open(args.json, 'w') as fid:
+            json.dump(results, fid, indent=1)
+
+
+if __name__ == '__main__':
+    main()
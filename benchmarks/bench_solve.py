@@ -0,0 +1,45 @@
+"""
+Benchmarks of complete solves
+"""
+from cwfs.algorithm import Algorithm
+from cwfs.image import Image
+from cwfs.instrument import Instrument
+
+from .common import PAIRS, SIZES, loadPair, syntheticPair
+
+
+class RunItBundled(object):
+    params = [list(PAIRS), ['fft', 'exp']]
+    param_names = ['pair', 'solver']
+    timeout = 300
+
+    def setup(self, pair, solver):
+        if (pair == 'F1.23_1mm_v61' and solver == 'exp'):
+            # not one of the validation cases
+            raise NotImplementedError
+        self.intra, self.extra = loadPair(pair)
+        self.fieldXY, self.model = PAIRS[pair][2:]
+        self.solver = solver
+
+    def time_runIt(self, pair, solver):
+        inst = Instrument('lsst', self.intra.shape[0])
+        I1 = Image(self.intra.copy(), self.fieldXY, Image.INTRA)
+        I2 = Image(self.extra.copy(), self.fieldXY, Image.EXTRA)
+        algo = Algorithm(self.solver, inst, 0)
+        algo.runIt(inst, I1, I2, self.model)
+
+
+class RunItSynthetic(object):
+    params = [SIZES, ['fft', 'exp']]
+    param_names = ['size', 'solver']
+    timeout = 300
+
+    def setup(self, size, solver):
+        self.intra, self.extra, self.inst = syntheticPair(size)
+        self.solver = solver
+
+    def time_runIt(self, size, solver):
+        I1 = Image(self.intra.copy(), (0, 0), Image.INTRA)
+        I2 = Image(self.extra.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm(self.solver, self.inst, 0)
+        algo.runIt(self.inst, I1, I2, 'onAxis')
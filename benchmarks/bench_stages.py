@@ -0,0 +1,174 @@
+"""
+Benchmarks of the single stages of a reconstruction
+"""
+import os
+
+import numpy as np
+from scipy import interpolate
+
+from cwfs import tools
+from cwfs.algorithm import Algorithm
+from cwfs.image import Image, aperture2image, readFile
+
+from .common import FIELDS, SIZES, pairFiles, syntheticPair
+
+
+class ReadFile(object):
+    params = ['txt', 'fits']
+    param_names = ['format']
+
+    def setup(self, fmt):
+        if (fmt == 'txt'):
+            self.filename = pairFiles('LSST_C_SN26')[0]
+        else:
+            self.filename = os.path.join(
+                tools.getDataDir(), 'testImages', 'AuxTel',
+                'I1_intra_20190912_HD21161_z05.fits')
+
+    def time_readFile(self, fmt):
+        readFile(self.filename)
+
+
+class ImageStages(object):
+    params = [SIZES, ['onAxis', 'offAxis']]
+    param_names = ['size', 'model']
+
+    def setup(self, size, model):
+        self.intra, _, self.inst = syntheticPair(size)
+        self.fieldXY = FIELDS[model]
+        self.model = model
+        self.algo = Algorithm('exp', self.inst, 0)
+
+    def time_Image(self, size, model):
+        Image(self.intra, self.fieldXY, Image.INTRA)
+
+    def time_makeMask(self, size, model):
+        # built from scratch, as without the mask cache
+        I1 = Image(self.intra, self.fieldXY, Image.INTRA)
+        I1.makeMaskList(self.inst, self.model)
+        I1.makeMask(self.inst, self.algo.boundaryT, 1)
+
+    def time_getMasks(self, size, model):
+        # from the mask cache
+        I1 = Image(self.intra, self.fieldXY, Image.INTRA)
+        I1.getMasks(self.inst, self.model, self.algo.boundaryT, 1)
+
+    def time_imageCoCenter(self, size, model):
+        I1 = Image(self.intra.copy(), self.fieldXY, Image.INTRA)
+        I1.imageCoCenter(self.inst, self.algo)
+
+
+class Compensate(object):
+    params = [SIZES, ['paraxial', 'onAxis', 'offAxis']]
+    param_names = ['size', 'model']
+
+    def setup(self, size, model):
+        intra, extra, self.inst = syntheticPair(size)
+        self.model = model
+        self.I1 = Image(intra, FIELDS[model], Image.INTRA)
+        self.I2 = Image(extra, FIELDS[model], Image.EXTRA)
+        self.algo = Algorithm('exp', self.inst, 0)
+        self.algo.itr0(self.inst, self.I1, self.I2, model)
+        # 100nm of coma and spherical to compensate
+        self.zcomp = np.zeros(self.algo.numTerms)
+        self.zcomp[[6, 7, 10]] = 1e-7
+
+    def time_compensate(self, size, model):
+        self.I1.image = self.I1.image0.copy()
+        self.I1.compensate(self.inst, self.algo, self.zcomp, 1, self.model)
+
+
+class Remap(object):
+    """
+    The interpolation of the stamp onto the projection look-up table in
+    compensate: one spline call per pixel, as compensate used to do it,
+    against a single ev() call over the whole table
+    """
+    params = [[128, 160, 256, 512], ['loop', 'ev']]
+    param_names = ['size', 'method']
+
+    def setup(self, size, method):
+        intra, _, inst = syntheticPair(size)
+        I1 = Image(intra, (0, 0), Image.INTRA)
+        algo = Algorithm('exp', inst, 0)
+        I1.getMasks(inst, 'onAxis', algo.boundaryT, 1)
+        # the look-up table of compensate for 100nm of coma and spherical
+        zcomp = np.zeros(algo.numTerms)
+        zcomp[[6, 7, 10]] = 1e-7
+        half = size / 2
+        luty, lutx = np.mgrid[-(half - 0.5):(half + 0.5),
+                              -(half - 0.5):(half + 0.5)]
+        lutx = lutx / (half / inst.sensorFactor)
+        luty = luty / (half / inst.sensorFactor)
+        self.ip = interpolate.RectBivariateSpline(
+            luty[:, 0], lutx[0, :], I1.image, kx=1, ky=1)
+        self.lutxp, self.lutyp, _ = aperture2image(
+            I1, inst, algo, zcomp, lutx, luty, size, 'onAxis')
+        self.lutxp[np.isnan(self.lutxp)] = 0
+        self.lutyp[np.isnan(self.lutyp)] = 0
+
+    def time_remap(self, size, method):
+        if (method == 'loop'):
+            lutIp = np.zeros(self.lutxp.size)
+            for i, (xx, yy) in enumerate(zip(self.lutxp.ravel(),
+                                             self.lutyp.ravel())):
+                lutIp[i] = self.ip(yy, xx)[0, 0]
+            lutIp.reshape(self.lutxp.shape)
+        else:
+            self.ip.ev(self.lutyp, self.lutxp)
+
+
+class SolvePoissonEq(object):
+    params = [SIZES, ['fft', 'exp']]
+    param_names = ['size', 'solver']
+
+    def setup(self, size, solver):
+        intra, extra, self.inst = syntheticPair(size)
+        self.I1 = Image(intra, (0, 0), Image.INTRA)
+        self.I2 = Image(extra, (0, 0), Image.EXTRA)
+        self.algo = Algorithm(solver, self.inst, 0)
+        # itr0 leaves the masked, normalized stamps ready to solve
+        self.algo.itr0(self.inst, self.I1, self.I2, 'onAxis')
+
+    def time_solvePoissonEq(self, size, solver):
+        self.algo.solvePoissonEq(self.inst, self.I1, self.I2, 0)
+
+
+class Zernike(object):
+    params = [SIZES]
+    param_names = ['size']
+
+    def setup(self, size):
+        _, _, inst = syntheticPair(size)
+        self.x = inst.xoSensor
+        self.y = inst.yoSensor
+        self.e = inst.obscuration
+        self.mask = np.isfinite(self.x)
+        self.numTerms = 22
+        self.Z = np.random.default_rng(0).normal(0, 1e-7, self.numTerms)
+        self.S = tools.ZernikeAnnularEval(self.Z, self.x, self.y, self.e)
+
+    def time_ZernikeEval(self, size):
+        tools.ZernikeEval(self.Z, self.x, self.y)
+
+    def time_ZernikeAnnularEval(self, size):
+        tools.ZernikeAnnularEval(self.Z, self.x, self.y, self.e)
+
+    def time_ZernikeAnnularGrad(self, size):
+        tools.ZernikeAnnularGrad(self.Z, self.x, self.y, self.e, 'dx')
+
+    def time_ZernikeAnnularJacobian(self, size):
+        tools.ZernikeAnnularJacobian(self.Z, self.x, self.y, self.e, '1st')
+
+    def time_ZernikeAnnularBasisEval(self, size):
+        # from the basis cache
+        tools.ZernikeAnnularBasisEval(self.Z, self.x, self.y, self.e)
+
+    def time_ZernikeAnnularFit(self, size):
+        tools.ZernikeAnnularFit(self.S[self.mask], self.x[self.mask],
+                                self.y[self.mask], self.numTerms, self.e)
+
+    def time_ZernikeMaskedFit(self, size):
+        # with the cached fitter
+        tools.ZernikeMaskedFit(self.S, self.x, self.y, self.numTerms,
+                               self.mask, self.e)
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+from cwfs.image import readFile
+from cwfs.instrument import Instrument
+from cwfs.tools import getDataDir
+
+# the bundled pairs of cwfs/tests/test_validate.py:
+# name: (directory, filename format, fieldXY, model)
+PAIRS = {
+    'F1.23_1mm_v61': ('F1.23_1mm_v61', 'z7_0.25_%s.txt', (0, 0),
+                      'paraxial'),
+    'LSST_C_SN26': ('LSST_C_SN26', 'z7_0.25_%s.txt', (0, 0), 'onAxis'),
+    'LSST_NE_SN25': ('LSST_NE_SN25', 'z11_0.25_%s.txt', (1.185, 1.185),
+                     'offAxis'),
+}
+
+# stamp sizes of the synthetic pairs, in pixels
+SIZES = [64, 128, 256]
+
+# field positions used for each model
+FIELDS = {'paraxial': (0, 0), 'onAxis': (0, 0), 'offAxis': (1.185, 1.185)}
+
+# the bundled LSST stamps are this many pixels across
+_STAMP = 120
+
+
+def pairFiles(name):
+    """
+    Return the intra and extra filenames of a bundled pair
+    """
+    imgDir, fmt = PAIRS[name][:2]
+    imgDir = os.path.join(getDataDir(), 'testImages', imgDir)
+    return (os.path.join(imgDir, fmt % 'intra'),
+            os.path.join(imgDir, fmt % 'extra'))
+
+
+def loadPair(name):
+    """
+    Return the intra and extra images of a bundled pair
+    """
+    intraFile, extraFile = pairFiles(name)
+    return readFile(intraFile), readFile(extraFile)
+
+
+def syntheticPair(size, seed=0):
+    """
+    Return the intra and extra images of an unaberrated LSST donut, with
+    photon noise, on a stamp of size pixels, and the Instrument for them.
+    The stamp covers the same area as the bundled 120 pixel stamps, so
+    the pixels get smaller as size grows.
+    """
+    inst = Instrument('lsst', size)
+    inst.setSensorSamples(size, inst.pixelSize * _STAMP / size)
+    r2 = inst.xSensor**2 + inst.ySensor**2
+    donut = ((r2 <= 1) & (r2 >= inst.obscuration**2)).astype(float)
+    donut *= 1e5 / donut.sum() * (size / _STAMP)**2
+    rng = np.random.default_rng(seed)
+    intra = rng.poisson(donut + 1).astype(float)
+    extra = rng.poisson(donut + 1).astype(float)
+    return intra, extra, inst
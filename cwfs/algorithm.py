@@ -8,12 +8,17 @@
 # written by William P. Kuhn
 ##
 
+import copy
 import os
-import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 import numpy as np
 import scipy.ndimage as ndimage
 
 from . import tools
+from .errors import imageDiffSizeError, nonSquareImageError
+from .image import Image
+from .timing import StageTimer
 
 
 class Algorithm(object):
@@ -21,54 +26,59 @@ class Algorithm(object):
     def __init__(self, algoFile, inst, debugLevel):
         algoDir = os.path.join(tools.getDataDir(), "algo")
         self.filename = os.path.join(algoDir, f"{algoFile}.algo")
-        fid = open(self.filename)
-
-        iscomment = False
-        for line in fid:
-            line = line.strip()
-            if (line.startswith('###')):
-                iscomment = ~iscomment
-            if (not(line.startswith('#')) and
-                    (not iscomment) and len(line) > 0):
-                if (line.startswith('PoissonSolver')):
-                    self.PoissonSolver = line.split()[1]
-                elif (line.startswith('Num_of_Zernikes')):
-                    self.numTerms = int(line.split()[1])
-                elif (line.startswith('ZTerms')):
-                    self.ZTerms = np.hstack(
-                        ([1, 2, 3], [int(x) for x in line.split()[1:]]))
-                elif (line.startswith('Num_of_outer_itr')):
-                    self.outerItr = int(line.split()[1])
-                elif (line.startswith('Num_of_inner_itr')):
-                    self.innerItr = int(line.split()[1])
-                elif (line.startswith('Zernikes')):
-                    self.zobsR = int(line.split()[1])
-                elif (line.startswith('Increase_resolution')):
-                    self.upReso = float(line.split()[1])
-                elif (line.startswith('FFT_dimension')):
-                    self.padDim = int(line.split()[2])
-                elif (line.startswith('Feedback_gain')):
-                    self.feedbackGain = float(line.split()[1])
-                elif (line.startswith('Compensator_oversample')):
-                    self.compOversample = float(line.split()[1])
-                elif (line.startswith('Compensator_mode')):
-                    self.compMode = line.split()[1]
-                elif (line.startswith('OffAxis_poly_order')):
-                    self.offAxisPolyOrder = int(line.split()[1])
-                elif (line.startswith('Boundary_thickness')):
-                    self.boundaryT = int(line.split()[2])
-                elif (line.startswith('Compensation_sequence')):
-                    self.compSequence = np.loadtxt(
-                        os.path.join(algoDir, line.split()[1]))
-                    self.compSequence = self.compSequence.astype(int)
-                elif (line.startswith('Sumclip_sequence')):
-                    self.sumclipSequence = np.loadtxt(
-                        os.path.join(algoDir, line.split()[1]))
-                elif (line.startswith('Image_formation')):
-                    self.imageFormation = line.split()[1]
-                elif (line.startswith('Minimization')):
-                    self.minimization = line.split()[1]
-        fid.close()
+        # the parameter lines are kept as the provenance of results
+        self.params = tools.readParamFile(self.filename)
+        for line in self.params:
+            if (line.startswith('PoissonSolver')):
+                self.PoissonSolver = line.split()[1]
+            elif (line.startswith('Num_of_Zernikes')):
+                self.numTerms = int(line.split()[1])
+            elif (line.startswith('ZTerms')):
+                self.ZTerms = np.hstack(
+                    ([1, 2, 3], [int(x) for x in line.split()[1:]]))
+            elif (line.startswith('Num_of_outer_itr')):
+                self.outerItr = int(line.split()[1])
+            elif (line.startswith('Num_of_inner_itr')):
+                self.innerItr = int(line.split()[1])
+            elif (line.startswith('Zernikes')):
+                self.zobsR = int(line.split()[1])
+            elif (line.startswith('Increase_resolution')):
+                self.upReso = float(line.split()[1])
+            elif (line.startswith('FFT_dimension')):
+                self.padDim = int(line.split()[2])
+            elif (line.startswith('FFT_workers')):
+                self.fftWorkers = int(line.split()[1])
+            elif (line.startswith('Exp_tile_size')):
+                self.expTileSize = int(line.split()[-1])
+            elif (line.startswith('Stage_timing')):
+                self.timer = StageTimer(int(line.split()[-1]) != 0)
+            elif (line.startswith('Pair_threads')):
+                self.pairThreads = int(line.split()[-1]) != 0
+            elif (line.startswith('Feedback_gain')):
+                self.feedbackGain = float(line.split()[1])
+            elif (line.startswith('Compensator_oversample')):
+                self.compOversample = float(line.split()[1])
+            elif (line.startswith('Compensator_mode')):
+                self.compMode = line.split()[1]
+            elif (line.startswith('OffAxis_poly_order')):
+                self.offAxisPolyOrder = int(line.split()[1])
+            elif (line.startswith('Boundary_thickness')):
+                self.boundaryT = int(line.split()[2])
+            elif (line.startswith('Compensation_sequence')):
+                self.compSequence = tools.loadTxt(
+                    os.path.join(algoDir, line.split()[1]))
+                self.compSequence = self.compSequence.astype(int)
+            elif (line.startswith('Sumclip_sequence')):
+                self.sumclipSequence = tools.loadTxt(
+                    os.path.join(algoDir, line.split()[1]))
+            elif (line.startswith('Image_formation')):
+                self.imageFormation = line.split()[1]
+            elif (line.startswith('Minimization')):
+                self.minimization = line.split()[1]
+            elif (line.startswith('Convergence_tolerance')):
+                self.convergeTol = float(line.split()[-1])
+            elif (line.startswith('Convergence_mode')):
+                self.convergeMode = line.split()[1]
 
         if not (hasattr(self, 'ZTerms')):
             self.ZTerms = np.arange(self.numTerms) + 1  # starts from 1
@@ -97,9 +107,11 @@ class Algorithm(object):
                     :, self.compSequence.shape[1] + 1:self.outerItr] = 1
 
         # if padDim==999, get the minimum padDim possible based on image size.
+        self.autoPadDim = False
         try:
             if ((self.PoissonSolver == 'fft') and (self.padDim == 999)):
                 self.padDim = int(2**np.ceil(np.log2(inst.sensorSamples)))
+                self.autoPadDim = True
         except AttributeError:
             pass
 
@@ -111,16 +123,117 @@ class Algorithm(object):
         self.debugLevel = debugLevel
         self.currentItr = 0
 
+        # early termination of runIt() is off unless the algo file sets
+        # Convergence_tolerance, or setConvergence() is called
+        if not hasattr(self, 'fftWorkers'):
+            self.fftWorkers = None
+        if not hasattr(self, 'expTileSize'):
+            self.expTileSize = 0
+        # per-stage timing is off unless the algo file sets Stage_timing,
+        # or setTiming() is called
+        if not hasattr(self, 'timer'):
+            self.timer = StageTimer()
+        # the intra and extra images are worked on one after the other
+        # unless the algo file sets Pair_threads, or setPairThreads() is
+        # called
+        if not hasattr(self, 'pairThreads'):
+            self.pairThreads = False
+        if not hasattr(self, 'convergeTol'):
+            self.convergeTol = None
+        if not hasattr(self, 'convergeMode'):
+            self.convergeMode = 'abs'
+        self.convergeGroups = None
+        self.stopReason = None
+        self.stopItr = None
+        self.z0 = None
+        self.pendingFit = None
+        # the boundary rings of the pupil masks seen so far and the fft
+        # solver, shared with the copies newPair() makes
+        self.boundaryRings = {}
+        self.fftSolvers = {}
+
+    def newPair(self):
+        """
+        Return a copy of this Algorithm, ready to solve another pair: it
+        shares the configuration read from the algo file, the boundary
+        rings and the fft solver's work buffer, but not the state of a
+        solve.  So the copies must not solve at the same time on different
+        threads.  runBatch() makes one per pair.
+        """
+        algo = copy.copy(self)
+        algo.timer = StageTimer(self.timer.enabled)
+        algo.caustic = 0
+        algo.converge = np.zeros((self.numTerms, self.outerItr + 1))
+        algo.currentItr = 0
+        algo.stopReason = None
+        algo.stopItr = None
+        algo.z0 = None
+        algo.pendingFit = None
+        return algo
+
     def makeMasterMask(self, I1, I2):
         self.pMask = I1.pMask * I2.pMask
         self.cMask = I1.cMask * I2.cMask
         try:
             if (self.PoissonSolver == 'fft'):
-                self.pMaskPad = tools.padArray(self.pMask, self.padDim)
-                self.cMaskPad = tools.padArray(self.cMask, self.padDim)
+                if (_paddedTo(I1, self.padDim) and
+                        _paddedTo(I2, self.padDim)):
+                    self.pMaskPad = I1.pMaskPad * I2.pMaskPad
+                    self.cMaskPad = I1.cMaskPad * I2.cMaskPad
+                else:
+                    self.pMaskPad = tools.padArray(self.pMask, self.padDim)
+                    self.cMaskPad = tools.padArray(self.cMask, self.padDim)
+                self.shareBoundaryRing(I1, I2)
         except AttributeError:
             pass
 
+    def shareBoundaryRing(self, I1, I2):
+        # the (read-only) masks of the mask cache are the same objects for
+        # every pair at the same field position, so their rings are made
+        # once. the masks are kept with their rings, so the ids stay unique
+        if (I1.pMask.flags.writeable or I2.pMask.flags.writeable):
+            self.makeBoundaryRing()
+            return
+        key = (id(I1.pMask), id(I2.pMask))
+        if key in self.boundaryRings:
+            (self.ApringOut, self.ApringIn,
+             self.ApringInCount) = self.boundaryRings[key][2:]
+            return
+        self.makeBoundaryRing()
+        if (len(self.boundaryRings) >= 64):
+            self.boundaryRings.clear()
+        self.boundaryRings[key] = (I1.pMask, I2.pMask, self.ApringOut,
+                                   self.ApringIn, self.ApringInCount)
+
+    def makeBoundaryRing(self):
+        # find the rings of pixels just ouside and just inside the
+        # aperture for use in setting dWdn = 0. they only depend on
+        # self.pMask, so we do it once per mask rather than per solve.
+        struct = ndimage.generate_binary_structure(2, 1)
+        struct = ndimage.iterate_structure(struct, self.boundaryT)
+        self.ApringOut = np.logical_xor(ndimage.binary_dilation(
+            self.pMask, structure=struct), self.pMask)
+        self.ApringIn = np.logical_xor(ndimage.binary_erosion(
+            self.pMask, structure=struct), self.pMask)
+        # number of ApringIn pixels in the (2T+1)x(2T+1) box around each
+        # pixel. this is the normalizer for the boundary average.
+        self.ApringInCount = ndimage.uniform_filter(
+            self.ApringIn.astype(float), size=2 * self.boundaryT + 1,
+            mode='constant')[self.ApringOut]
+
+    def getFFTSolver(self, aperturePixelSize):
+        # one solver, with its filter and work buffer, per geometry; only
+        # the one of the latest geometry is kept
+        key = (self.padDim, aperturePixelSize, self.S.dtype)
+        solver = self.fftSolvers.get(key)
+        if (solver is None):
+            solver = tools.PoissonFFTSolver(
+                self.padDim, aperturePixelSize, self.fftWorkers,
+                self.S.dtype)
+            self.fftSolvers.clear()
+            self.fftSolvers[key] = solver
+        return solver
+
     def createSignal(self, inst, I1, I2, cliplevel):
 
         m1, n1 = I1.image.shape
@@ -166,12 +279,11 @@ class Algorithm(object):
         m2, n2 = I2.image.shape
 
         if(m1 != n1):
-            print('getdIandI: I1 is not square')
-            exit()
+            raise nonSquareImageError('getdIandI: I1 is not square')
 
         if((m1 != m2) or (n1 != n2)):
-            print('getdIandI: I1 and I2 are not the same size')
-            exit()
+            raise imageDiffSizeError(
+                'getdIandI: I1 and I2 are not the same size')
 
         I1 = I1.image
         I2 = np.rot90(I2.image, 2)
@@ -180,6 +292,44 @@ class Algorithm(object):
         self.dI = I2 - I1
 
     def solvePoissonEq(self, inst, I1, I2, iOutItr=0):
+        with self.timer.stage('solvePoissonEq'):
+            self.startPoissonEq(inst, I1, I2, iOutItr)
+            solution = None
+            if self.pendingFit is not None:
+                with self.timer.stage('zernikeFit'):
+                    solution = solveLeastSquares([self])[0]
+            self.finishPoissonEq(inst, solution)
+
+    def startPoissonEq(self, inst, I1, I2, iOutItr):
+        """
+        Do the pixel work of a Poisson solve, up to its least-squares step,
+        which is left in self.pendingFit (None if there is none).  Hand
+        the solution of solveLeastSquares() to finishPoissonEq() to
+        complete the solve; solvePoissonEq() does all three.
+        """
+        self._startPoissonEq(inst, I1, I2, iOutItr)
+        self.timer.count('solves')
+        if self.timer.enabled:
+            self.timer.count('pixels', int(np.count_nonzero(self.cMask)))
+
+    def finishPoissonEq(self, inst, solution):
+        if self.pendingFit is None:
+            return
+        if self.pendingFit[0] == 'fit':
+            # the fft solver's Zernikes, one column per inner iteration
+            numTerms = self.pendingFit[1].numTerms
+            self.zc = np.zeros((self.numTerms, self.innerItr))
+            self.zc[:numTerms, :] = solution.T
+        else:
+            idx, dz = self.pendingFit[3:]
+            self.zc = np.zeros(self.numTerms)
+            self.zc[idx] = solution / dz
+            self.West = self.zernikeWavefront(
+                np.concatenate(([0, 0, 0], self.zc[3:])),
+                inst.xSensor * self.cMask, inst.ySensor * self.cMask)
+        self.pendingFit = None
+
+    def _startPoissonEq(self, inst, I1, I2, iOutItr):
 
         numTerms = self.compSequence[iOutItr]
         if self.PoissonSolver == 'fft':
@@ -191,54 +341,36 @@ class Algorithm(object):
             aperturePixelSize = \
                 (inst.apertureDiameter *
                  inst.sensorFactor / inst.sensorSamples)
-            v, u = np.mgrid[
-                -0.5 / aperturePixelSize:(0.5) / aperturePixelSize:
-                1 / self.padDim / aperturePixelSize,
-                -0.5 / aperturePixelSize:(0.5) / aperturePixelSize:
-                1 / self.padDim / aperturePixelSize]
+            with self.timer.stage('createSignal'):
+                self.createSignal(inst, I1, I2, cliplevel)
+            solver = self.getFFTSolver(aperturePixelSize)
             if self.debugLevel >= 3:
                 print('iOuter=%d, cliplevel=%4.2f' % (iOutItr, cliplevel))
-                print(v.shape)
-
-            u2v2 = -4 * (np.pi**2) * (u * u + v * v)
-
-            # Set origin to Inf and 0 to result in 0 at origin after filtering
-            ctrIdx = int(np.floor(self.padDim / 2))
-            u2v2[ctrIdx, ctrIdx] = np.inf
-
-            self.createSignal(inst, I1, I2, cliplevel)
-
-            # find the indices for a ring of pixels
-            # just ouside and just inside the
-            # aperture for use in setting dWdn = 0
-
-            struct = ndimage.generate_binary_structure(2, 1)
-            struct = ndimage.iterate_structure(struct, self.boundaryT)
-            # print struct
-            ApringOut = np.logical_xor(ndimage.morphology.binary_dilation(
-                self.pMask, structure=struct), self.pMask).astype(int)
-            ApringIn = np.logical_xor(ndimage.morphology.binary_erosion(
-                self.pMask, structure=struct), self.pMask).astype(int)
-            bordery, borderx = np.nonzero(ApringOut)
-
-            if (self.compMode == 'zer'):
-                zc = np.zeros((self.numTerms, self.innerItr))
-                #        print "ZC ONE",zc.shape
+                print(solver.filter.shape)
 
             # **************************************************************
             # initial BOX 3 - put signal in boundary (since there's no existing
             # Sestimate, S just equals self.S
-            S = self.S.copy()
-
+            # Sestimate lives in solver.work from here on; the Laplacian of
+            # BOX 7 only ever writes into its central (sensorSamples)^2 part
+            S = solver.work
+            S[...] = self.S
+            inside = self.pMaskPad == 1
+            i0 = int(np.floor((self.padDim - inst.sensorSamples) / 2))
+            i1 = i0 + inst.sensorSamples
+            del2W = S[i0:i1, i0:i1]
+
+            # the Zernikes of every inner iteration's estimate are fitted
+            # at once after the loop (in finishPoissonEq); they don't feed
+            # back into it
+            Wests = []
+            laps = self.timer.laps('innerItr')
             for jj in range(int(self.innerItr)):
 
                 # *************************************************************
                 # BOX 4 - forward filter: forward FFT, divide by u2v2, inverse
                 # FFT
-                SFFT = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(S)))
-                # print SFFT.shape, u2v2.shape
-                W = np.fft.fftshift(np.fft.irfft2(np.fft.fftshift(SFFT / u2v2),
-                                                  s=S.shape))
+                W = solver.solve(S)
 
                 # *************************************************************
                 # BOX 5 - Wavefront estimate
@@ -251,163 +383,195 @@ class Algorithm(object):
                 West[self.pMask == 0] = 0
 
                 if (self.compMode == 'zer'):
-
-                    zc[:numTerms, jj] = tools.ZernikeMaskedFit(
-                        West, inst.xSensor, inst.ySensor,
-                        numTerms, self.pMask, self.zobsR)
+                    Wests.append(West)
 
                 # ************************************************************
                 # BOX 6 - set dWestimate/dn = 0 around boundary
                 WestdWdn0 = West.copy()
 
-                # do a 3x3 average around each border pixel,
+                # do a (2T+1)x(2T+1) average around each border pixel,
                 # including only those pixels inside the aperture
-                for ii in range(len(borderx)):
-                    reg = West[borderx[ii] - self.boundaryT:
-                               borderx[ii] + self.boundaryT + 1,
-                               bordery[ii] - self.boundaryT:
-                               bordery[ii] + self.boundaryT + 1]
-                    intersectIdx = ApringIn[borderx[ii] - self.boundaryT:
-                                            borderx[ii] + self.boundaryT + 1,
-                                            bordery[ii] - self.boundaryT:
-                                            bordery[ii] + self.boundaryT + 1]
-                    WestdWdn0[borderx[ii], bordery[ii]] =\
-                        reg[np.nonzero(intersectIdx)].mean()
+                WestIn = ndimage.uniform_filter(
+                    West * self.ApringIn, size=2 * self.boundaryT + 1,
+                    mode='constant')
+                WestdWdn0[self.ApringOut] = \
+                    WestIn[self.ApringOut] / self.ApringInCount
 
                 # ***********************************************************
-                # BOX 7 - Take Laplacian to find sensor signal estimate
-
-                Wxx = np.zeros((inst.sensorSamples, inst.sensorSamples))
-                Wyy = np.zeros((inst.sensorSamples, inst.sensorSamples))
-                Wt = WestdWdn0.copy()
-
-                Wxx[:, 1:-1] = (Wt[:, 0:-2] - 2 * Wt[:, 1:-1] + Wt[:, 2:]) /\
-                    aperturePixelSize**2
-                Wyy[1:-1, :] = (Wt[0:-2, :] - 2 * Wt[1:-1, :] + Wt[2:, :]) /\
-                    aperturePixelSize**2
-                del2W = Wxx + Wyy
-                Sest = tools.padArray(del2W, self.padDim)
+                # BOX 7 - Take Laplacian to find sensor signal estimate,
+                # straight into the middle of the padded Sestimate
+                Wt = WestdWdn0
+
+                del2W[...] = 0
+                del2W[:, 1:-1] = Wt[:, 0:-2] - 2 * Wt[:, 1:-1] + Wt[:, 2:]
+                del2W[1:-1, :] += Wt[0:-2, :] - 2 * Wt[1:-1, :] + Wt[2:, :]
+                del2W /= aperturePixelSize**2
+                S[:i0, :] = 0
+                S[i1:, :] = 0
+                S[:, :i0] = 0
+                S[:, i1:] = 0
 
                 # ********************************************************
                 # BOX 3 - Put signal back inside boundary,
                 # leaving the rest of Sestimate
-                Sest[self.pMaskPad == 1] = self.S[self.pMaskPad == 1]
-                S = Sest
+                S[inside] = self.S[inside]
+                laps.lap()
 
             self.West = West.copy()
+            self.pendingFit = None
             if (self.compMode == 'zer'):
-                self.zc = zc
+                self.pendingFit = ('fit', tools.getZernikeMaskedFitter(
+                    inst.xSensor, inst.ySensor, numTerms, self.pMask,
+                    self.zobsR), np.stack(Wests))
 
         elif self.PoissonSolver == 'exp':
-            self.getdIandI(I1, I2)
-
-            xSensor = inst.xSensor * self.cMask
-            ySensor = inst.ySensor * self.cMask
-
-            F = np.zeros(numTerms)
-            dZidx = np.zeros((numTerms, inst.sensorSamples,
-                              inst.sensorSamples))
-            dZidy = dZidx.copy()
+            with self.timer.stage('getdIandI'):
+                self.getdIandI(I1, I2)
+            fit = self.timer.laps('zernikeFit', series=False)
 
             aperturePixelSize = \
                 (inst.apertureDiameter *
                  inst.sensorFactor / inst.sensorSamples)
-            zcCol = np.zeros(numTerms)
-            for i in range(int(numTerms)):
-                zcCol[i] = 1
-                # we integrate, instead of decompose, integration is faster.
-                # Also, decomposition is ill-defined on m.cMask.
-                # Using m.pMask, the two should give same results.
+
+            # work on the pixels inside the computational mask. every pixel
+            # outside of it sits at (x, y) = (0, 0) in xSensor/ySensor, so
+            # they are lumped together into one extra sample at the origin
+            # weighted by their summed intensities.
+            inMask = self.cMask != 0
+            xPix = np.append(inst.xSensor[inMask], 0).astype(
+                inst.dtype, copy=False)[np.newaxis, :]
+            yPix = np.append(inst.ySensor[inMask], 0).astype(
+                inst.dtype, copy=False)[np.newaxis, :]
+            dIPix = np.append(self.dI[inMask],
+                              self.dI[~inMask].sum(dtype=float))
+            imagePix = np.append(self.image[inMask],
+                                 self.image[~inMask].sum(dtype=float))
+
+            # we integrate, instead of decompose, integration is faster.
+            # Also, decomposition is ill-defined on m.cMask.
+            # Using m.pMask, the two should give same results.
+            # F = Z^T dI and Mij = Gx^T diag(I) Gx + Gy^T diag(I) Gy, where
+            # the columns of Z, Gx and Gy are the Zernike basis and its
+            # gradients sampled at those pixels, i.e. (npix x numTerms)
+            if (self.expTileSize > 0):
+                # low memory: stream over tiles of pixels, rather than
+                # building (and caching) the whole bases
+                F, M = tools.ZernikeGradSums(
+                    xPix, yPix, self.zobsR, numTerms, dIPix, imagePix,
+                    self.expTileSize)
+            else:
+                # the bases are built with all self.numTerms terms and
+                # sliced, so the 4, 6, 13, ... terms of the compensation
+                # sequence share one cache entry per grid
+                allTerms = self.numTerms
                 if (self.zobsR > 0):
-                    F[i] = np.sum(np.sum(
-                        self.dI * tools.ZernikeAnnularEval(
-                            zcCol, xSensor, ySensor,
-                            self.zobsR))) * aperturePixelSize**2
-                    dZidx[i, :, :] = tools.ZernikeAnnularGrad(
-                        zcCol, xSensor, ySensor, self.zobsR, 'dx')
-                    dZidy[i, :, :] = tools.ZernikeAnnularGrad(
-                        zcCol, xSensor, ySensor, self.zobsR, 'dy')
+                    Z = tools.ZernikeAnnularBasis(
+                        xPix, yPix, self.zobsR, allTerms)
+                    Gx = tools.ZernikeAnnularBasis(
+                        xPix, yPix, self.zobsR, allTerms, 'dx')
+                    Gy = tools.ZernikeAnnularBasis(
+                        xPix, yPix, self.zobsR, allTerms, 'dy')
                 else:
-                    F[i] = np.sum(np.sum(
-                        self.dI * tools.ZernikeEval(
-                            zcCol, xSensor, ySensor))) * aperturePixelSize**2
-                    dZidx[i, :, :] = tools.ZernikeGrad(
-                        zcCol, xSensor, ySensor, 'dx')
-                    dZidy[i, :, :] = tools.ZernikeGrad(
-                        zcCol, xSensor, ySensor, 'dy')
-                zcCol[i] = 0
-
-            self.Mij = np.zeros((numTerms, numTerms))
-            for i in range(numTerms):
-                for j in range(numTerms):
-                    self.Mij[i, j] = aperturePixelSize**2 /\
-                        (inst.apertureDiameter / 2)**2 * \
-                        np.sum(
-                            self.image *
-                            (dZidx[i, :, :].squeeze() *
-                             dZidx[j, :, :].squeeze() +
-                             dZidy[i, :, :].squeeze() *
-                             dZidy[j, :, :].squeeze()))
+                    Z = tools.ZernikeBasis(xPix, yPix, allTerms)
+                    Gx = tools.ZernikeBasis(xPix, yPix, allTerms, 'dx')
+                    Gy = tools.ZernikeBasis(xPix, yPix, allTerms, 'dy')
+                # the sums over pixels are done in double precision
+                Z = Z[:numTerms, 0, :].T.astype(float, copy=False)
+                Gx = Gx[:numTerms, 0, :].T.astype(float, copy=False)
+                Gy = Gy[:numTerms, 0, :].T.astype(float, copy=False)
+
+                F = np.dot(dIPix, Z)
+                # stack the x and y gradients so Mij is a single product
+                G = np.vstack((Gx, Gy))
+                GI = G * np.tile(imagePix, 2)[:, np.newaxis]
+                M = np.dot(G.T, GI)
+
+            F = F * aperturePixelSize**2
+            self.Mij = aperturePixelSize**2 / \
+                (inst.apertureDiameter / 2)**2 * M
+            # enforce the symmetry Mij = Mji that rounding doesn't quite
+            # preserve
+            self.Mij = (self.Mij + self.Mij.T) / 2
 
             dz = 2 * inst.focalLength * \
                 (inst.focalLength - inst.offset) / inst.offset
-            self.zc = np.zeros(self.numTerms)
             idx = [x - 1 for x in self.ZTerms]
             for i in idx.copy():
                 if i + 1 > numTerms:
                     idx.remove(i)
-            # phi in GN paper is phase, phi/(2pi)*lambda=W
-            zc_tmp = np.dot(np.linalg.pinv(self.Mij[:, idx][idx]), F[idx]) / dz
-            self.zc[idx] = zc_tmp
-
-            if (self.zobsR > 0):
-                self.West = tools.ZernikeAnnularEval(
-                    np.concatenate(([0, 0, 0], self.zc[3:])),
-                    xSensor, ySensor, self.zobsR)
-            else:
-                self.West = tools.ZernikeEval(
-                    np.concatenate(([0, 0, 0], self.zc[3:])),
-                    xSensor, ySensor)
+            # phi in GN paper is phase, phi/(2pi)*lambda=W; the
+            # pinv(Mij) F / dz is left to solveLeastSquares() and
+            # finishPoissonEq()
+            self.pendingFit = ('pinv', self.Mij[:, idx][idx], F[idx], idx,
+                               dz)
+            fit.lap()
 
     def itr0(self, inst, I1, I2, model):
+        self._startItr0(inst, I1, I2, model)
+        self.solvePoissonEq(inst, I1, I2, 0)
+        self._finishItr0(inst)
+
+    def _startItr0(self, inst, I1, I2, model):
+        # itr0() up to its Poisson solve
 
         self.reset(I1, I2)
         # if we want to internally/artificially increase the image resolution
         try:
             if (self.upReso > 1):
-                newSize = inst.sensorSamples * self.upReso
-                I1.upResolution(self.upReso, newSize, newSize)
-                I2.upResolution(self.upReso, newSize, newSize)
-                inst.pixel_size = inst.pixel_size / self.upReso
-                inst.sensorSamples = newSize
-                I1.sizeinPix = newSize
-                I2.sizeinPix = newSize
+                upReso = int(self.upReso)
+                newSize = I1.sizeinPix * upReso
+                # reset() may have brought back the already resampled images
+                if (I1.image.shape[0] == I1.sizeinPix):
+                    I1.upResolution(upReso, newSize, newSize)
+                if (I2.image.shape[0] == I2.sizeinPix):
+                    I2.upResolution(upReso, I2.sizeinPix * upReso,
+                                    I2.sizeinPix * upReso)
+                # same physical stamp size, on the finer grid
+                if (inst.sensorSamples != newSize):
+                    inst.setSensorSamples(
+                        newSize,
+                        inst.pixelSize * inst.sensorSamples / newSize)
+                if (self.PoissonSolver == 'fft' and self.autoPadDim):
+                    self.padDim = int(2**np.ceil(np.log2(newSize)))
         except AttributeError:
             pass
 
+        # in single precision mode, work on float32 copies of the stamps
+        if (inst.dtype == np.float32):
+            I1.image = I1.image.astype(np.float32)
+            I2.image = I2.image.astype(np.float32)
+
         if I1.image.shape[0] != I2.image.shape[0]:
-            print('%s image size = (%d, %d) ' % (
-                I1.type, I1.image.shape[0], I1.image.shape[1]))
-            print('%s image size = (%d, %d) ' % (
-                I2.type, I2.image.shape[0], I2.image.shape[1]))
-            print('Error: The intra and extra image stamps need to be of same size.')
-            sys.exit()
+            raise imageDiffSizeError(
+                'The intra and extra image stamps need to be of same size: '
+                '%s image size = (%d, %d), %s image size = (%d, %d)' % (
+                    I1.type, I1.image.shape[0], I1.image.shape[1],
+                    I2.type, I2.image.shape[0], I2.image.shape[1]))
 
         # pupil mask, computational mask, and their parameters
-        I1.makeMaskList(inst, model)
-        I2.makeMaskList(inst, model)
-        I1.makeMask(inst, self.boundaryT, 1)
-        I2.makeMask(inst, self.boundaryT, 1)
-        self.makeMasterMask(I1, I2)
+        # (from the mask cache, so repeated solves at the same field
+        # position don't rebuild them)
+        padDim = None
+        if (getattr(self, 'PoissonSolver', None) == 'fft'):
+            padDim = self.padDim
+        with self.timer.stage('masks'):
+            self.forPair(
+                lambda: I1.getMasks(inst, model, self.boundaryT, 1, padDim),
+                lambda: I2.getMasks(inst, model, self.boundaryT, 1, padDim))
+            self.makeMasterMask(I1, I2)
 
         # load offAxis correction coefficients
         if model == 'offAxis':
-            I1.getOffAxisCorr(inst.instDir, self.offAxisPolyOrder)
-            I2.getOffAxisCorr(inst.instDir, self.offAxisPolyOrder)
+            self.forPair(
+                lambda: I1.getOffAxisCorr(inst.instDir,
+                                          self.offAxisPolyOrder),
+                lambda: I2.getOffAxisCorr(inst.instDir,
+                                          self.offAxisPolyOrder))
 
         # cocenter the images
-        I1.imageCoCenter(inst, self)
-        I2.imageCoCenter(inst, self)
+        with self.timer.stage('coCenter'):
+            self.forPair(lambda: I1.imageCoCenter(inst, self),
+                         lambda: I2.imageCoCenter(inst, self))
 
         # we want the compensator always start from I1.image0 and I2.image0
         if hasattr(I1, 'image0') or hasattr(I2, 'image0'):
@@ -418,12 +582,35 @@ class Algorithm(object):
 
         if self.compMode == 'zer':
             self.zcomp = np.zeros(self.numTerms)
-            if 'Axis' in model:  # onAxis or offAxis, remove distortion first
-                I1.compensate(inst, self, self.zcomp, 1, model)
-                I2.compensate(inst, self, self.zcomp, 1, model)
+            if self.z0 is not None:  # warm start
+                self.zcomp = self.z0.copy()
+            # onAxis or offAxis, remove distortion first
+            if 'Axis' in model or self.z0 is not None:
+                self.compensatePair(inst, I1, I2, self.zcomp,
+                                    self.compOversample, model)
+
+        elif (self.compMode == 'opd'):
+            self.wcomp = np.zeros((inst.sensorSamples, inst.sensorSamples),
+                                  dtype=inst.dtype)
+            if self.z0 is not None:  # warm start
+                if self.z0.ndim == 2:
+                    self.wcomp = self.z0.copy()
+                elif (self.zobsR == 0):
+                    self.wcomp = tools.ZernikeBasisEval(
+                        self.z0, inst.xSensor, inst.ySensor)
+                else:
+                    self.wcomp = tools.ZernikeAnnularBasisEval(
+                        self.z0, inst.xSensor, inst.ySensor, self.zobsR)
+
+            # onAxis or offAxis, remove distortion first
+            if 'Axis' in model or self.z0 is not None:
+                self.compensatePair(inst, I1, I2, self.wcomp, 1, model)
+
+        applyI1I2pMask(self, I1, I2)
 
-            I1, I2 = applyI1I2pMask(self, I1, I2)
-            self.solvePoissonEq(inst, I1, I2, 0)
+    def _finishItr0(self, inst):
+        # itr0() after its Poisson solve
+        if self.compMode == 'zer':
             if self.PoissonSolver == 'fft':
                 self.converge[:, 0] = self.zcomp + \
                     self.zc[:, self.innerItr - 1]
@@ -432,20 +619,15 @@ class Algorithm(object):
 
             #    self.West includes Zernikes presented by self.zc
             self.Wconverge = self.West
+            if self.z0 is not None:
+                self.Wconverge = self.zcompWavefront(inst) + self.West
 
         elif (self.compMode == 'opd'):
-            self.wcomp = np.zeros(inst.sensorSamples, inst.sensorSamples)
-
-            if 'Axis' in model:  # onAxis or offAxis, remove distortion first
-                I1.compensate(inst, self, self.wcomp, 1, model)
-                I2.compensate(inst, self, self.wcomp, 1, model)
-
-            I1, I2 = applyI1I2pMask(self, I1, I2)
-            self.solvePoissonEq(inst, I1, I2, 0)
-            self.Wconverge = self.West
-            self.converge[:, 0] = tools.ZernikeMaskedFit(
-                self.Wconverge, inst.xSensor, inst.ySensor,
-                self.numTerms, self.pMask, self.zobsR)
+            self.Wconverge = self.wcomp + self.West
+            with self.timer.stage('zernikeFit'):
+                self.converge[:, 0] = tools.ZernikeMaskedFit(
+                    self.Wconverge, inst.xSensor, inst.ySensor,
+                    self.numTerms, self.pMask, self.zobsR)
 
         if self.debugLevel >= 2:
             tmp = self.converge[3:, 0] * 1e9
@@ -455,104 +637,176 @@ class Algorithm(object):
         self.currentItr = self.currentItr + 1
 
     def singleItr(self, inst, I1, I2, model):
+        self._beginItr(inst)
+        with self.timer.stage('outerItr', series=True):
+            self._singleItr(self.itrInst, I1, I2, model)
 
+    def _beginItr(self, inst):
         if self.currentItr == 0:
-            self.itr0(inst, I1, I2, model)
-        else:
-            j = int(self.currentItr)
-
-            if self.compMode == 'zer':
-                if not self.caustic:
-                    if (self.PoissonSolver == 'fft'):
-                        ztmp = self.zc[:, -1]
-                    else:
-                        ztmp = self.zc
-                    if (self.compSequence.ndim == 1):
-                        ztmp[self.compSequence[j - 1]:] = 0
-                    else:
-                        ztmp = ztmp * self.compSequence[:, j - 1]
-
-                    self.zcomp = self.zcomp + ztmp * self.feedbackGain
-
-                    I1.image = I1.image0.copy()
-                    I2.image = I2.image0.copy()
-
-                    I1.compensate(inst, self, self.zcomp, 1, model)
-                    I2.compensate(inst, self, self.zcomp, 1, model)
-                    if (I1.caustic == 1 or I2.caustic == 1):
-                        self.converge[:, j] = self.converge[:, j - 1]
-                        self.caustic = 1
-                        return  # done with this singleItr()
-                    I1, I2 = applyI1I2pMask(self, I1, I2)
-                    self.solvePoissonEq(inst, I1, I2, j)
-                    if self.PoissonSolver == 'fft':
-                        self.converge[:, j] = self.zcomp +\
-                            self.zc[:, self.innerItr - 1]
-                    elif self.PoissonSolver == 'exp':
-                        self.converge[:, j] = self.zcomp + self.zc
-
-                    # self.West is the estimated wavefront from the
-                    # last run of PoissonSolver (both fft and exp).
-                    # self.zcomp is what had be compensated before that run.
-                    # self.West includes two parts (for fft):
-                    #        latest self.zc, and self.Wres
-                    # self.West includes only self.zc (for exp).
-                    # self.Wres is the residual wavefront on top of
-                    # self.converge(:,end), (or self.Wconverge, in 2D form)
-                    # self.Wres is only available for the fft algorithm.
-                    if (self.zobsR == 0):
-                        self.Wconverge = tools.ZernikeEval(
-                            np.concatenate(
-                                ([0, 0, 0], self.zcomp[3:])),
-                            inst.xoSensor, inst.yoSensor) + self.West
-                    else:
-                        self.Wconverge = tools.ZernikeAnnularEval(
-                            np.concatenate(
-                                ([0, 0, 0], self.zcomp[3:])),
-                            inst.xoSensor, inst.yoSensor, self.zobsR) + \
-                            self.West
-                else:
-                    # once we run into caustic, stop here, results may be
-                    # close to real aberration.
-                    # Continuation may lead to disatrous results
-                    self.converge[:, j] = self.converge[:, j - 1]
-
-            elif (self.compMode == 'opd'):
-
-                if not self.caustic:
-                    wtmp = self.West
-                    self.wcomp = self.wcomp + wtmp * self.feedbackGain
-
-                    I1.image = I1.image0.copy()
-                    I2.image = I2.image0.copy()
-                    I1.compensate(inst, self, self.wcomp, 1, model)
-                    I2.compensate(inst, self, self.wcomp, 1, model)
-                    if (I1.caustic == 1 or I2.caustic == 1):
-                        self.caustic = 1
-                    I1, I2 = applyI1I2pMask(self, I1, I2)
-                    self.solvePoissonEq(inst, I1, I2, j)
-
-                    self.Wconverge = self.wcomp + self.West
-                    self.converge[:, j - 1] = tools.ZernikeMaskedFit(
-                        self.Wconverge, inst.xSensor, inst.ySensor,
-                        self.numTerms, self.pMask, self.zobsR)
-                else:
-                    # once we run into caustic, stop here, results may be
-                    # close to real aberration.
-                    # Continuation may lead to disatrous results
-                    self.converge[:, j] = self.converge[:, j - 1]
+            # a new solve, with new timings
+            self.timer.reset()
+            # itr0 resamples the sensor grid when upReso > 1; it does so on
+            # a copy, so the caller's Instrument keeps its geometry for the
+            # next pair
+            self.itrInst = inst
+            if (getattr(self, 'upReso', 1) > 1):
+                self.itrInst = copy.copy(inst)
+
+    def _singleItr(self, inst, I1, I2, model):
+        j = self._startItr(inst, I1, I2, model)
+        if j is not None:
+            self.solvePoissonEq(inst, I1, I2, j)
+            self._finishItr(inst)
+
+    def _startItr(self, inst, I1, I2, model):
+        # the outer iteration up to its Poisson solve. returns the iteration
+        # to solve for, or None if there is nothing to solve
+
+        if self.currentItr == 0:
+            self._startItr0(inst, I1, I2, model)
+            return 0
+
+        j = int(self.currentItr)
+        if self.caustic:
+            # once we run into caustic, stop here, results may be
+            # close to real aberration.
+            # Continuation may lead to disatrous results
+            self.converge[:, j] = self.converge[:, j - 1]
+            self._endItr(j)
+            return None
 
-            self.zer4UpNm = self.converge[3:, j] * 1e9  # convert to nm
+        if self.compMode == 'zer':
+            if (self.PoissonSolver == 'fft'):
+                ztmp = self.zc[:, -1]
+            else:
+                ztmp = self.zc
+            if (self.compSequence.ndim == 1):
+                ztmp[self.compSequence[j - 1]:] = 0
+            else:
+                ztmp = ztmp * self.compSequence[:, j - 1]
+
+            self.zcomp = self.zcomp + ztmp * self.feedbackGain
+
+            I1.image = I1.image0.copy()
+            I2.image = I2.image0.copy()
+
+            self.compensatePair(inst, I1, I2, self.zcomp,
+                                self.compOversample, model)
+            if (I1.caustic == 1 or I2.caustic == 1):
+                self.converge[:, j] = self.converge[:, j - 1]
+                self.caustic = 1
+                return None  # done with this singleItr()
+
+        elif (self.compMode == 'opd'):
+            wtmp = self.West
+            self.wcomp = self.wcomp + wtmp * self.feedbackGain
+
+            I1.image = I1.image0.copy()
+            I2.image = I2.image0.copy()
+            self.compensatePair(inst, I1, I2, self.wcomp, 1, model)
+            if (I1.caustic == 1 or I2.caustic == 1):
+                self.caustic = 1
+
+        applyI1I2pMask(self, I1, I2)
+        return j
 
-            if self.currentItr < int(self.outerItr):
-                self.currentItr = self.currentItr + 1
+    def _finishItr(self, inst):
+        # the outer iteration after its Poisson solve
 
-            if self.debugLevel >= 2:
-                tmp = self.converge[3:, j] * 1e9
-                print('itr = %d, z4-z%d' % (j, self.numTerms))
-                print(np.rint(tmp))
+        if self.currentItr == 0:
+            self._finishItr0(inst)
+            return
 
-            # self.Wconverge = self.Wconverge * self.pMask
+        j = int(self.currentItr)
+        if self.compMode == 'zer':
+            if self.PoissonSolver == 'fft':
+                self.converge[:, j] = self.zcomp +\
+                    self.zc[:, self.innerItr - 1]
+            elif self.PoissonSolver == 'exp':
+                self.converge[:, j] = self.zcomp + self.zc
+
+            # self.West is the estimated wavefront from the
+            # last run of PoissonSolver (both fft and exp).
+            # self.zcomp is what had be compensated before that run.
+            # self.West includes two parts (for fft):
+            #        latest self.zc, and self.Wres
+            # self.West includes only self.zc (for exp).
+            # self.Wres is the residual wavefront on top of
+            # self.converge(:,end), (or self.Wconverge, in 2D form)
+            # self.Wres is only available for the fft algorithm.
+            self.Wconverge = self.zcompWavefront(inst) + self.West
+
+        elif (self.compMode == 'opd'):
+            self.Wconverge = self.wcomp + self.West
+            with self.timer.stage('zernikeFit'):
+                self.converge[:, j - 1] = tools.ZernikeMaskedFit(
+                    self.Wconverge, inst.xSensor, inst.ySensor,
+                    self.numTerms, self.pMask, self.zobsR)
+
+        self._endItr(j)
+
+    def _endItr(self, j):
+        self.zer4UpNm = self.converge[3:, j] * 1e9  # convert to nm
+
+        if self.currentItr < int(self.outerItr):
+            self.currentItr = self.currentItr + 1
+
+        if self.debugLevel >= 2:
+            tmp = self.converge[3:, j] * 1e9
+            print('itr = %d, z4-z%d' % (j, self.numTerms))
+            print(np.rint(tmp))
+
+        # self.Wconverge = self.Wconverge * self.pMask
+
+    def compensatePair(self, inst, I1, I2, zcCol, oversample, model):
+        # compensate both images for zcCol (zer mode) or the wavefront
+        # map zcCol (opd mode)
+        def compensateIntra():
+            with self.timer.stage('compensateIntra'):
+                I1.compensate(inst, self, zcCol, oversample, model)
+
+        def compensateExtra():
+            with self.timer.stage('compensateExtra'):
+                I2.compensate(inst, self, zcCol, oversample, model)
+
+        self.forPair(compensateIntra, compensateExtra)
+        self.timer.count('compensatedImages', 2)
+        self.timer.count('causticImages', I1.caustic + I2.caustic)
+
+    def forPair(self, intra, extra):
+        """
+        Run intra() and extra(), the two halves of a stage that work on
+        the intra and extra image only, at the same time on two threads if
+        pairThreads is on (see setPairThreads()), else one after the other
+        """
+        if not self.pairThreads:
+            intra()
+            extra()
+            return
+        future = _pairPool().submit(extra)
+        try:
+            intra()
+        finally:
+            # the extra half is waited for even if the intra one failed
+            wait([future])
+        future.result()
+
+    def zernikeWavefront(self, z, x, y):
+        # the low-memory exp mode doesn't keep (numTerms x N x N) bases
+        # around, it evaluates the Zernikes directly
+        if (self.PoissonSolver == 'exp' and self.expTileSize > 0):
+            z = np.asarray(z, dtype=x.dtype)
+            if (self.zobsR == 0):
+                return tools.ZernikeEval(z, x, y)
+            return tools.ZernikeAnnularEval(z, x, y, self.zobsR)
+        if (self.zobsR == 0):
+            return tools.ZernikeBasisEval(z, x, y)
+        return tools.ZernikeAnnularBasisEval(z, x, y, self.zobsR)
+
+    def zcompWavefront(self, inst):
+        # the wavefront of the compensated Zernikes, z4 and up
+        zcomp = np.concatenate(([0, 0, 0], self.zcomp[3:]))
+        return self.zernikeWavefront(zcomp, inst.xoSensor, inst.yoSensor)
 
     def nextItr(self, inst, I1, I2, model, nItr=1):
         i = 0
@@ -560,11 +814,147 @@ class Algorithm(object):
             i = i + 1
             self.singleItr(inst, I1, I2, model)
 
-    def runIt(self, inst, I1, I2, model):
+    def runIt(self, inst, I1, I2, model, z0=None, warmItr=4):
+        """
+        Run the outer compensation loop; see setWarmStart() for z0 and
+        warmItr, and setConvergence() for stopping it early.
+        """
+        if z0 is not None:
+            self.setWarmStart(z0, warmItr)
+        self.stopReason = 'outerItr'
+        total = self.timer.laps('runIt', series=False)
         i = self.currentItr
         while (i <= int(self.outerItr)):
             i = i + 1
+            j = self.currentItr
             self.singleItr(inst, I1, I2, model)
+            if self._stopAfter(j):
+                break
+        total.lap()
+
+    def _stopAfter(self, j):
+        # whether runIt() stops after outer iteration j
+        self.stopItr = j
+        if j == 0:
+            return False
+        if self.caustic:
+            # every later iteration just copies the last estimate
+            self.stopReason = 'caustic'
+            return True
+        if self.isConverged(j):
+            self.stopReason = 'converged'
+            return True
+        return False
+
+    def setConvergence(self, tol, mode='abs', groups=None):
+        """
+        Let runIt() stop as soon as the Zernikes stop changing.
+
+        tol is the largest change in z4 and up between two outer iterations
+        that counts as converged: in nm for mode 'abs', and as a fraction
+        of the largest term for mode 'rel'.  groups optionally splits the
+        Zernikes into (first, last) Noll index ranges, each checked on its
+        own; tol may then hold one tolerance per group.  tol=None turns
+        early termination off.
+
+        runIt() never stops before every term in compSequence has been
+        switched on and compensated for one full iteration.
+        """
+        if mode not in ('abs', 'rel'):
+            raise ValueError("setConvergence: mode must be 'abs' or 'rel', "
+                             "not %r" % mode)
+        if (tol is not None and groups is not None and
+                np.size(tol) not in (1, len(groups))):
+            raise ValueError('setConvergence: need one tolerance, or one '
+                             'per group')
+        self.convergeTol = tol
+        self.convergeMode = mode
+        self.convergeGroups = groups
+
+    def setTiming(self, enabled=True):
+        """
+        Turn the per-stage timing of the next solves on or off.  After a
+        solve self.timer.asDict() holds the wall time of each stage (masks,
+        coCenter, compensateIntra/Extra, createSignal or getdIandI,
+        zernikeFit, solvePoissonEq, which includes the last three, and
+        runIt), the time of every outer iteration and every fft inner
+        iteration, and the counts of solves, pixels solved for, compensated
+        images and caustic images; see timing.StageTimer.
+        """
+        self.timer.enabled = enabled
+
+    def setPairThreads(self, enabled=True):
+        """
+        Work on the intra and extra images at the same time, on two
+        threads, in the stages that treat them separately: the masks, the
+        off-axis corrections, the co-centering and the compensation.  Most
+        of that time is spent in numpy and scipy calls that release the
+        GIL, so on a multi-core machine this brings those stages close to
+        half their time; the results are the same either way.
+        """
+        self.pairThreads = enabled
+
+    def setWarmStart(self, z0, outerItr=4):
+        """
+        Start the next solve from a prior solution instead of from zero.
+
+        z0 is the initial zcomp, e.g. the converge[:, stopItr] of the
+        previous exposure of the same star, in m and with all numTerms
+        terms.  In opd compensator mode it may also be the initial wcomp
+        wavefront map.  Since every term is compensated from the start, the
+        compensation schedule is cut to outerItr iterations, all with every
+        term of compSequence switched on and with the last entries of
+        sumclipSequence.  outerItr=None keeps the current schedule.  Must be
+        called before the first iteration.
+        """
+        z0 = np.array(z0, dtype=float)
+        if z0.ndim == 1 and z0.size != self.numTerms:
+            raise ValueError('setWarmStart: z0 has %d terms, expected %d' % (
+                z0.size, self.numTerms))
+        self.z0 = z0
+        if outerItr is not None:
+            full = self.compSequence[..., self.fullCompItr() - 1]
+            self.outerItr = int(outerItr)
+            # one more than outerItr, for the solve after the last
+            # compensation
+            self.compSequence = np.repeat(
+                np.expand_dims(full, -1), self.outerItr + 1, axis=-1)
+            if hasattr(self, 'sumclipSequence'):
+                self.sumclipSequence = \
+                    self.sumclipSequence[-(self.outerItr + 1):]
+            self.converge = np.zeros((self.numTerms, self.outerItr + 1))
+
+    def fullCompItr(self):
+        # the first iteration whose compensation uses every term the
+        # compSequence schedule will ever switch on
+        if (self.compSequence.ndim == 1):
+            seq = self.compSequence[:self.outerItr]
+            return int(np.argmax(seq >= seq.max())) + 1
+        seq = self.compSequence[:, :self.outerItr]
+        full = np.all(seq >= seq.max(axis=1)[:, np.newaxis], axis=0)
+        return int(np.argmax(full)) + 1
+
+    def isConverged(self, j):
+        if self.convergeTol is None:
+            return False
+        # in opd mode singleItr() fills converge[:, j - 1]
+        if self.compMode == 'opd':
+            j = j - 1
+        if j - 1 < self.fullCompItr():
+            return False
+
+        z = self.converge[:, j] * 1e9
+        dz = np.abs(z - self.converge[:, j - 1] * 1e9)
+        groups = self.convergeGroups
+        if groups is None:
+            groups = [(4, self.numTerms)]
+        tols = np.broadcast_to(self.convergeTol, (len(groups),))
+        for (first, last), tol in zip(groups, tols):
+            if self.convergeMode == 'rel':
+                tol = tol * np.max(np.abs(z[first - 1:last]))
+            if np.max(dz[first - 1:last]) > tol:
+                return False
+        return True
 
     def setDebugLevel(self, debugLevel):
         self.debugLevel = debugLevel
@@ -583,6 +973,19 @@ class Algorithm(object):
             pass
 
 
+@lru_cache(maxsize=None)
+def _pairPool():
+    # shared by every Algorithm of the process; the intra half runs on the
+    # calling thread, so each solve takes one of these threads at a time
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                              thread_name_prefix='cwfs-pair')
+
+
+def _paddedTo(img, padDim):
+    pMaskPad = getattr(img, 'pMaskPad', None)
+    return pMaskPad is not None and pMaskPad.shape[0] == padDim
+
+
 def applyI1I2pMask(algo, I1, I2):
     if (I1.fieldX != I2.fieldX or I1.fieldY != I2.fieldY):
         I1.image = I1.image * algo.pMask
@@ -591,3 +994,188 @@ def applyI1I2pMask(algo, I1, I2):
         I2.image = I2.image / np.sum(I2.image)
         # no need vignetting correction, this is after masking already
     return I1, I2
+
+
+def solveLeastSquares(algos):
+    """
+    Do the least-squares step that each Algorithm in algos has left in its
+    pendingFit (see Algorithm.startPoissonEq), stacked across them: the
+    fft Zernike fits of every solve on the same grid, mask and number of
+    terms are one multi-RHS ZernikeMaskedFitter.fit(), and the exp normal
+    equations of the same size one stacked np.linalg.pinv().  Returns the
+    solution of each, in order.
+    """
+    groups = {}
+    for k, algo in enumerate(algos):
+        kind, A = algo.pendingFit[:2]
+        # the fitters come from the fitter cache, so the solves on one
+        # grid share theirs
+        key = (kind, id(A)) if kind == 'fit' else (kind, A.shape)
+        groups.setdefault(key, []).append(k)
+
+    solutions = [None] * len(algos)
+    for (kind, _), members in groups.items():
+        pending = [algos[k].pendingFit for k in members]
+        if kind == 'fit':
+            stacks = [fit[2] for fit in pending]
+            coefs = pending[0][1].fit(np.concatenate(stacks))
+            parts = np.split(coefs, np.cumsum([len(S) for S in stacks])[:-1])
+        else:
+            M = np.stack([fit[1] for fit in pending])
+            F = np.stack([fit[2] for fit in pending])
+            parts = np.matmul(np.linalg.pinv(M), F[..., np.newaxis])[..., 0]
+        for k, part in zip(members, parts):
+            solutions[k] = part
+    return solutions
+
+
+def runBatch(inst, algoFile, intraStamps, extraStamps, fieldXY, model,
+             debugLevel=0, z0=None, warmItr=4, chain=False):
+    """
+    Solve a batch of intra/extra donut pairs with the same instrument,
+    algorithm and optical model.
+
+    intraStamps and extraStamps are (nPairs, N, N) stacks of donut stamps,
+    where N must be inst.sensorSamples.  fieldXY holds the field position
+    (degrees) of each pair, shape (nPairs, 2), or a single (x, y) for all
+    of them.  The input stamps are not modified.
+
+    Returns (zer4UpNm, errors).  zer4UpNm is the (nPairs, numTerms - 3)
+    array of Zernikes z4 and up, in nm, i.e. the stacked Algorithm.zer4UpNm
+    of each pair.  errors has one entry per pair, None if it was solved,
+    otherwise 'ExceptionType: message'; the row of a pair that failed is
+    NaN, and the other pairs are still solved.  Stacks that don't match
+    each other or the instrument raise ValueError before anything is
+    solved.
+
+    z0 warm-starts the solves (see Algorithm.setWarmStart) with warmItr
+    outer iterations; it is one (numTerms,) zcomp in m for all pairs, or
+    one per pair.  With chain=True every pair after the first starts from
+    the solution of the last pair that was solved, as for consecutive
+    exposures of the same star.
+
+    The algo file is read once.  The pairs run their outer iterations in
+    lockstep, each stopping on its own as runIt() would, and the
+    least-squares step of every iteration is done for all of them at once
+    by solveLeastSquares(): one multi-RHS fit per mask for the fft solver,
+    one stacked pinv for the exp solver.  The compensation and the rest of
+    the pixel work are done pair by pair, as is the opd compensator's fit
+    of the whole wavefront.  With chain=True each pair needs the solution
+    of the one before, so the pairs are solved one after the other.
+    """
+    intraStamps = np.asarray(intraStamps, dtype=float)
+    extraStamps = np.asarray(extraStamps, dtype=float)
+    if intraStamps.ndim == 2:
+        intraStamps = intraStamps[np.newaxis]
+    if extraStamps.ndim == 2:
+        extraStamps = extraStamps[np.newaxis]
+    if intraStamps.shape != extraStamps.shape:
+        raise ValueError(
+            'runBatch: intra and extra stacks have different shapes, '
+            '%s and %s' % (intraStamps.shape, extraStamps.shape))
+    nPairs = intraStamps.shape[0]
+    if intraStamps.shape[1:] != (inst.sensorSamples, inst.sensorSamples):
+        raise ValueError(
+            'runBatch: stamps are %dx%d but the instrument was set up for '
+            '%d pixels' % (intraStamps.shape[1], intraStamps.shape[2],
+                           inst.sensorSamples))
+
+    fieldXY = np.broadcast_to(np.asarray(fieldXY, dtype=float), (nPairs, 2))
+    if z0 is not None:
+        z0 = np.asarray(z0, dtype=float)
+        z0 = np.broadcast_to(z0, (nPairs, z0.shape[-1]))
+
+    template = Algorithm(algoFile, inst, debugLevel)
+    zer4UpNm = np.full((nPairs, template.numTerms - 3), np.nan)
+    errors = [None] * nPairs
+
+    # with chain=True each pair starts from the one before, so they run
+    # one at a time
+    if chain:
+        batches = [[k] for k in range(nPairs)]
+    else:
+        batches = [range(nPairs)]
+    zPrev = None
+    for batch in batches:
+        solves = []
+        for k in batch:
+            zStart = None if z0 is None else z0[k]
+            if chain and zPrev is not None:
+                zStart = zPrev
+            try:
+                fldxy = tuple(fieldXY[k])
+                I1 = Image(intraStamps[k].copy(), fldxy, Image.INTRA)
+                I2 = Image(extraStamps[k].copy(), fldxy, Image.EXTRA)
+                algo = template.newPair()
+                if zStart is not None:
+                    algo.setWarmStart(zStart, warmItr)
+            except (Exception, SystemExit) as e:
+                errors[k] = '%s: %s' % (type(e).__name__, e)
+                continue
+            solves.append((k, algo, I1, I2))
+        for k, algo in _runLockstep(solves, inst, model, errors):
+            zer4UpNm[k] = algo.zer4UpNm
+            zPrev = algo.converge[:, algo.stopItr]
+
+    return zer4UpNm, errors
+
+
+def _runLockstep(solves, inst, model, errors):
+    # run the (k, algo, I1, I2) solves of runBatch() one outer iteration at
+    # a time, with the least-squares steps of each iteration stacked. yields
+    # (k, algo) for every solve that ran to its end
+    def fail(k, e):
+        errors[k] = '%s: %s' % (type(e).__name__, e)
+
+    for k, algo, I1, I2 in solves:
+        algo.stopReason = 'outerItr'
+    active = list(solves)
+    nItr = 0
+    while (len(active) > 0):
+        solving = []
+        for solve in active:
+            k, algo, I1, I2 = solve
+            try:
+                algo._beginItr(inst)
+                j = algo.currentItr
+                jSolve = algo._startItr(algo.itrInst, I1, I2, model)
+                if jSolve is not None:
+                    algo.startPoissonEq(algo.itrInst, I1, I2, jSolve)
+            except (Exception, SystemExit) as e:
+                fail(k, e)
+                continue
+            solving.append((solve, j, jSolve))
+
+        fitting = [solve[1] for solve, j, jSolve in solving
+                   if jSolve is not None and solve[1].pendingFit is not None]
+        try:
+            solutions = dict(zip(map(id, fitting),
+                                 solveLeastSquares(fitting)))
+        except (Exception, SystemExit):
+            # find the solves at fault by fitting them one by one
+            solutions = {}
+            for (k, algo, I1, I2), j, jSolve in solving:
+                if any(algo is a for a in fitting):
+                    try:
+                        solutions[id(algo)] = solveLeastSquares([algo])[0]
+                    except (Exception, SystemExit) as e:
+                        fail(k, e)
+
+        nItr = nItr + 1
+        active = []
+        for solve, j, jSolve in solving:
+            k, algo, I1, I2 = solve
+            if errors[k] is not None:
+                continue
+            try:
+                if jSolve is not None:
+                    algo.finishPoissonEq(algo.itrInst,
+                                         solutions.get(id(algo)))
+                    algo._finishItr(algo.itrInst)
+            except (Exception, SystemExit) as e:
+                fail(k, e)
+                continue
+            if algo._stopAfter(j) or nItr > int(algo.outerItr):
+                yield k, algo
+            else:
+                active.append(solve)
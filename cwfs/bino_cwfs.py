@@ -8,26 +8,29 @@
 
 import os
 import sys
+import copy
 import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from pathlib import Path
 
 import astropy.units as u
-from astropy.io import fits
 
 from mmtwfs.zernike import ZernikeVector
 from mmtwfs.wfs import WFSFactory
 
 from cwfs.instrument import Instrument
 from cwfs.algorithm import Algorithm
-from cwfs.image import Image, readFile
+from cwfs.image import Image, readCutout
 from cwfs.tools import outParam, outZer4Up
 
 import logging
 
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 matplotlib.use('Agg')
 
 log = logging.getLogger('CWFS')
@@ -40,6 +43,38 @@ ch.setFormatter(formatter)
 log.addHandler(ch)
 
 
+def writeOutputs(output, algo, inst, I1, I2, model, zv):
+    """
+    Write the .param, .pdf, .raw.lsst.zernikes and .rot.zernikes outputs
+    of a solve.  Nothing else uses algo or zv once the corrections are
+    computed, and no pyplot state is touched, so this can run in a
+    background thread.
+    """
+    # output parameters
+    outParam(output + ".param", algo, inst, I1, I2, model)
+
+    # save wavefront image. a Figure with its own Agg canvas rather than
+    # pyplot's current one, so this is safe off the main thread.
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    fig.add_subplot().imshow(algo.Wconverge, origin='lower')
+    fig.savefig(output + ".pdf")
+
+    # output Zernikes 4 and up
+    outZer4Up(algo.zer4UpNm, 'nm', output + ".raw.lsst.zernikes")
+    zv.save(filename=output + ".rot.zernikes")
+
+
+def plotZernikes(output, zv):
+    """
+    Write the .zernikes.pdf bar chart.  mmtwfs draws it with pyplot, which
+    is not thread-safe, so this stays on the main thread.
+    """
+    chart = zv.fringe_bar_chart()
+    chart.savefig(output + ".zernikes.pdf")
+    plt.close(chart)
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -156,6 +191,14 @@ def main():
         default=1.0,
         help='Gain factor for calculating M2 corrections. Default 1.0.'
     )
+    parser.add_argument(
+        '-p',
+        '--pipeline',
+        dest='pipeline',
+        action='store_true',
+        help='Compute and send the corrections right after the solve. Output files are written in the background '
+             'and the Zernike chart is drawn after the corrections are sent.'
+    )
     parser.add_argument(
         '-v',
         '--version',
@@ -186,23 +229,19 @@ def main():
     wfs.m1gain = args.m1gain
     wfs.m2gain = args.m2gain
 
-    # get rotator and focus values from the headers, if available
+    # get rotator and focus values from the headers, if available. raw
+    # Binospec SOG frames are trimmed to the donut stamp as they are read;
+    # the files themselves are left alone.
+    start = time.time()
     rots = []
     focusvals = []
+    stamps = []
     images = args.images
     for image in images:
         if args.imgDir:
             image = os.path.join(args.imgDir, image)
-        h = fits.open(image)
-        hdr = h[-1].header
-        data = h[-1].data
-        if len(h) > 1 or data.shape == (516, 532):
-            log.info(f"Found raw Binospec SOG image. Trimming and rewriting {image} as single extension.")
-            data = data[259-128:259+128, 295-128:295+128]
-            data = np.flipud(data)
-
-        f = fits.PrimaryHDU(data, hdr)
-        f.writeto(image, overwrite=True)
+        data, hdr = readCutout(image, recipe='binospec')
+        stamps.append(data)
         if 'ROT' in hdr:
             rots.append(hdr['ROT'])
         if 'FOCUS' in hdr:
@@ -220,14 +259,14 @@ def main():
 
     if len(focusvals) == 2:
         focusvals = np.array(focusvals)
-        intraFile = Path(images[np.argmin(focusvals)])
-        extraFile = Path(images[np.argmax(focusvals)])
+        intra, extra = np.argmin(focusvals), np.argmax(focusvals)
         focoff = focusvals.max() - focusvals.mean()
     else:
         focoff = args.focoff
-        intraFile = Path(images[0])
-        extraFile = Path(images[1])
+        intra, extra = 0, 1
         log.warning(f"WARNING: No focus information in image headers. Assuming M2 focus offset of {focoff} um.")
+    intraFile = Path(images[intra])
+    extraFile = Path(images[extra])
 
     log.info(f"\t Intra-focal image: {intraFile.name}")
     log.info(f"\t Extra-focal image: {extraFile.name}")
@@ -237,8 +276,10 @@ def main():
 
     log.info(f"Total pupil rotation: {rotation.round(2)}")
 
-    I1 = Image(readFile(str(intraFile)), args.intra_xy, Image.INTRA)
-    I2 = Image(readFile(str(extraFile)), args.extra_xy, Image.EXTRA)
+    I1 = Image(stamps[intra], args.intra_xy, Image.INTRA)
+    I2 = Image(stamps[extra], args.extra_xy, Image.EXTRA)
+    I1.name = intraFile.name
+    I2.name = extraFile.name
 
     # load instrument and algorithm parameters
     inst = Instrument(args.instruFile, I1.sizeinPix)
@@ -256,12 +297,6 @@ def main():
     # run it
     algo.runIt(inst, I1, I2, args.model)
 
-    # output parameters
-    outParam(args.output + ".param", algo, inst, I1, I2, args.model)
-
-    # save wavefront image
-    plt.imshow(algo.Wconverge, origin='lower')
-    plt.savefig(args.output + ".pdf")
     # convert the LSST zernike array to a ZernikeVector that the mmtwfs code
     # can handle, then apply necessary derotation to it.
     zv = ZernikeVector()
@@ -271,10 +306,14 @@ def main():
     if args.debugLevel >= 0:
         log.info("\n" + repr(zv))
 
-    # output Zernikes 4 and up
-    outZer4Up(algo.zer4UpNm, 'nm', args.output + ".raw.lsst.zernikes")
-    zv.save(filename=args.output + ".rot.zernikes")
-    zv.fringe_bar_chart().savefig(args.output + ".zernikes.pdf")
+    # in pipeline mode the outputs are written while the corrections are
+    # computed and sent, and the Zernike chart is drawn after they are sent
+    if args.pipeline:
+        outputPool = ThreadPoolExecutor(max_workers=1)
+        outputs = outputPool.submit(writeOutputs, args.output, algo, inst, I1, I2, args.model, copy.deepcopy(zv))
+    else:
+        writeOutputs(args.output, algo, inst, I1, I2, args.model, zv)
+        plotZernikes(args.output, zv)
 
     # calculate the corrections
     focus = wfs.calculate_focus(zv)
@@ -289,6 +328,7 @@ def main():
     )
     if args.debugLevel >= 1:
         log.info(forces)
+        log.info(f"Corrections computed {time.time() - start:0.2f} s after reading the images")
 
     # send corrections to secondary, if applicable
     if args.sendm2:
@@ -303,6 +343,14 @@ def main():
         wfs.telescope.correct_primary(forces, m1focus, filename=args.output + ".forces")
         time.sleep(10)
 
+    if args.pipeline:
+        plotZernikes(args.output, zv)
+        try:
+            outputs.result()
+        except Exception:
+            log.exception("Writing the outputs failed")
+        outputPool.shutdown()
+
 
 if __name__ == "__main__":
     main()
@@ -7,14 +7,14 @@
 
 class nonSquareImageError(Exception):
 
-    def __init__(self):
-        pass
+    def __init__(self, *args):
+        Exception.__init__(self, *args)
 
 
 class imageDiffSizeError(Exception):
 
-    def __init__(self):
-        pass
+    def __init__(self, *args):
+        Exception.__init__(self, *args)
 
 
 class unknownUnitError(Exception):
@@ -25,5 +25,5 @@ class unknownUnitError(Exception):
 
 class oddNumPixError(Exception):
 
-    def __init__(self):
-        pass
+    def __init__(self, *args):
+        Exception.__init__(self, *args)
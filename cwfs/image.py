@@ -5,8 +5,8 @@
 # @       Large Synoptic Survey Telescope
 
 
-import sys
 import os
+from functools import lru_cache
 
 import numpy as np
 import scipy.ndimage as ndimage
@@ -14,11 +14,13 @@ import scipy.interpolate as interpolate
 from astropy.io import fits
 from skimage import filters
 from scipy.ndimage import center_of_mass
-from scipy.signal import correlate
+import scipy.fft
 
+from . import resample
 from . import tools
-from .tools import ZernikeAnnularGrad, ZernikeGrad, \
-    ZernikeAnnularJacobian, ZernikeJacobian
+from .errors import oddNumPixError
+from .tools import ZernikeAnnularBasisEval, ZernikeBasisEval, \
+    ZernikeAnnularGrad, ZernikeGrad, ZernikeAnnularJacobian, ZernikeJacobian
 
 
 def readFile(filename):
@@ -41,6 +43,77 @@ def readFile(filename):
     return image
 
 
+# how to cut the donut stamp out of an instrument's raw frames:
+# ext      the HDU holding the frame
+# shape    the shape of a raw frame; frames of other shapes are taken
+#          whole, as already trimmed
+# multiExt whether any multi-extension file is a raw frame too, whatever
+#          its shape
+# box      (rowStart, rowStop, colStart, colStop) of the stamp in a raw
+#          frame
+# flipud   whether to flip the stamp upside down
+TRIM_RECIPES = {
+    # the Binospec SOG frames, 516x532 or multi-extension, 256x256 stamps
+    'binospec': dict(ext=-1, shape=(516, 532), multiExt=True,
+                     box=(259 - 128, 259 + 128, 295 - 128, 295 + 128),
+                     flipud=True),
+}
+
+
+def readCutout(filename, box=None, recipe=None, ext=None):
+    """
+    Read a stamp out of a FITS file without loading the whole frame.
+
+    box is (rowStart, rowStop, colStart, colStop), or recipe names one of
+    TRIM_RECIPES; with neither, the whole frame is read.  ext is the HDU,
+    by default the recipe's or the primary one.  The file is memory-mapped
+    read-only and only the rows of the stamp are read; it is never
+    written to.  Returns the stamp, as a float array of its own, and the
+    header of the HDU.
+    """
+    flipud = False
+    if recipe is not None:
+        try:
+            recipe = TRIM_RECIPES[recipe]
+        except KeyError:
+            raise ValueError('readCutout: unknown trim recipe %r, known '
+                             'ones are %s' % (recipe, sorted(TRIM_RECIPES)))
+        if ext is None:
+            ext = recipe['ext']
+    if ext is None:
+        ext = 0
+
+    # scaled (e.g. unsigned int) data can't be memory-mapped by astropy,
+    # so the raw values are read and scaled here
+    with fits.open(filename, mode='readonly', memmap=True,
+                   do_not_scale_image_data=True) as hdul:
+        hdu = hdul[ext]
+        header = hdu.header.copy()
+        shape = tuple(hdu.shape)
+        if (recipe is not None and box is None and
+                (shape == recipe['shape'] or
+                 (recipe.get('multiExt') and len(hdul) > 1))):
+            box = recipe['box']
+            flipud = recipe['flipud']
+        if box is None:
+            box = (0, shape[0], 0, shape[1])
+        r0, r1, c0, c1 = box
+        if (not (0 <= r0 < r1 <= shape[0] and 0 <= c0 < c1 <= shape[1])):
+            raise ValueError('readCutout: box %s is outside the %dx%d '
+                             'frame of %s' % (box, shape[0], shape[1],
+                                              filename))
+        # .section only reads the pixels asked for
+        raw = hdu.section[r0:r1, c0:c1]
+        stamp = raw * float(header.get('BSCALE', 1)) + \
+            float(header.get('BZERO', 0))
+        if 'BLANK' in header and raw.dtype.kind in 'iu':
+            stamp[raw == header['BLANK']] = np.nan
+
+    if flipud:
+        stamp = np.flipud(stamp).copy()
+    return stamp, header
+
+
 class Image(object):
     INTRA = "intra"
     EXTRA = "extra"
@@ -74,68 +147,57 @@ class Image(object):
             print('we cut it to (%d, %d)' % (
                 self.image.shape[0], self.image.shape[1]))
         elif self.image.shape[0] % 2 == 1:
-            print('%s image size = (%d, %d)' % (
-                type, self.image.shape[0], self.image.shape[1]))
-            print('Error: number of pixels cannot be odd numbers')
-            sys.exit()
+            raise oddNumPixError(
+                '%s image size = (%d, %d): number of pixels cannot be odd '
+                'numbers' % (type, self.image.shape[0], self.image.shape[1]))
 
         self.sizeinPix = self.image.shape[0]
 
+    @classmethod
+    def fromFits(cls, filename, fieldXY, type, box=None, recipe=None,
+                 ext=None):
+        """
+        Create an Image from a stamp cut out of a FITS file, see
+        readCutout().  The Image's name is the filename and its header the
+        header of the HDU.
+        """
+        stamp, header = readCutout(filename, box, recipe, ext)
+        image = cls(stamp, fieldXY, type)
+        image.name = str(filename)
+        image.header = header
+        return image
+
     # if we pass inst.maskParam, a try: catch: is needed in cwfs.py
     def makeMaskList(self, inst, model):
-        if (model == 'paraxial' or model == 'onAxis'):
-            if inst.obscuration == 0:
-                self.masklist = np.array([[0, 0, 1, 1]])
-            else:
-                self.masklist = np.array([[0, 0, 1, 1],
-                                          [0, 0, inst.obscuration, 0]])
-        else:
-            self.maskCa, self.maskRa, self.maskCb, self.maskRb = \
-                interpMaskParam(self.fieldX, self.fieldY, inst.maskParam)
-            cax, cay, cbx, cby = rotateMaskParam(  # only change the center
-                self.maskCa, self.maskCb, self.fieldX, self.fieldY)
-            self.masklist = np.array(
-                [[0, 0, 1, 1], [0, 0, inst.obscuration, 0],
-                 [cax, cay, self.maskRa, 1], [cbx, cby, self.maskRb, 0]])
+        self.masklist, maskParam = makeMaskList(
+            inst, self.fieldX, self.fieldY, model)
+        if maskParam is not None:
+            self.maskCa, self.maskRa, self.maskCb, self.maskRb = maskParam
 
     def makeMask(self, inst, boundaryT, maskScalingFactor):
+        self.pMask, self.cMask = makeMask(
+            inst, self.masklist, boundaryT, maskScalingFactor)
+        self.pMaskPad = None
+        self.cMaskPad = None
 
-        self.pMask = np.ones(inst.sensorSamples, dtype=int)
-        self.cMask = self.pMask
-
-        rMask = inst.apertureDiameter / (2 * inst.focalLength / inst.offset)\
-            * maskScalingFactor
-
-        for ii in range(self.masklist.shape[0]):
-
-            r = np.sqrt((inst.xSensor - self.masklist[ii, 0])**2 +
-                        (inst.ySensor - self.masklist[ii, 1])**2)
-
-            # Initialize both mask elements to the opposite of the pass/block
-            # boolean
-            pMaskii = (1 - self.masklist[ii, 3]) * np.ones(
-                (inst.sensorSamples, inst.sensorSamples), dtype=int)
-            cMaskii = (1 - self.masklist[ii, 3]) * np.ones(
-                (inst.sensorSamples, inst.sensorSamples), dtype=int)
-
-            # Find the indices that correspond to the mask element, set them to
-            # the pass/block boolean
-            idx = r <= self.masklist[ii, 2]
-            if (self.masklist[ii, 3] >= 1):
-                # make a mask >r so that we can keep a larger area of S
-                aidx = np.nonzero(r <= self.masklist[ii, 2] *
-                                  (1 + boundaryT * inst.pixelSize / rMask))
-            else:
-                aidx = np.nonzero(r <= self.masklist[ii, 2] *
-                                  (1 - boundaryT * inst.pixelSize / rMask))
-            pMaskii[idx] = self.masklist[ii, 3]
-            cMaskii[aidx] = self.masklist[ii, 3]
-
-            # Multiplicatively add the current mask elements to the model masks
-            # padded mask - for use at the offset planes
-            self.pMask = self.pMask * pMaskii
-            # non-padded mask corresponding to aperture
-            self.cMask = self.cMask * cMaskii
+    def getMasks(self, inst, model, boundaryT, maskScalingFactor,
+                 padDim=None):
+        """
+        Set the mask list, pMask and cMask, as makeMaskList() and makeMask()
+        do, from the mask cache; see getMaskSet().  The masks are read-only
+        boolean arrays, and pMaskPad/cMaskPad are their versions padded to
+        padDim (None without a padDim).
+        """
+        masks = getMaskSet(inst, self.fieldX, self.fieldY, model, boundaryT,
+                           maskScalingFactor, padDim)
+        self.masklist = masks.masklist
+        if masks.maskParam is not None:
+            self.maskCa, self.maskRa, self.maskCb, self.maskRb = \
+                masks.maskParam
+        self.pMask = masks.pMask
+        self.cMask = masks.cMask
+        self.pMaskPad = masks.pMaskPad
+        self.cMaskPad = masks.cMaskPad
 
     def getOffAxisCorr(self, instDir, order):
         self.offAxis_coeff = np.zeros((4, int((order + 1) * (order + 2) / 2)))
@@ -153,34 +215,25 @@ class Image(object):
             self.fldr)
 
     def upResolution(self, oversample, lm, ln):
-        # lm and ln are dimensions after upResolution
-        sm = lm / oversample
-        sn = ln / oversample
-
-        newI = np.zeros((lm, ln))
-        for i in range(sm):
-            for j in range(sn):
-                for k in range(oversample):
-                    for ll in range(oversample):
-                        newI[i * oversample + k, j * oversample + ll] = \
-                            self.image[i, j] / oversample / oversample
-        self.image = newI
+        # lm and ln are dimensions after upResolution. each pixel is split
+        # into oversample x oversample pixels sharing its counts
+        if (self.image.shape[0] * oversample != lm or
+                self.image.shape[1] * oversample != ln):
+            raise ValueError(
+                'upResolution: (%d, %d) image can not be resampled to '
+                '(%d, %d) by %d' % (self.image.shape + (lm, ln, oversample)))
+        self.image = resample.upsample(self.image, oversample) / \
+            oversample**2
 
     def downResolution(self, oversample, sm, sn):
-        # sm and sn are dimensions after downResolution
-        newI = np.zeros((sm, sn))
-        for i in range(sm):
-            for j in range(sn):
-                subI = self.image[i * oversample:(i + 1) * oversample,
-                                  j * oversample:(j + 1) * oversample]
-                idx = (~np.isnan(subI)).nonzero()
-                if np.sum(np.sum(subI)) > 0:
-                    newI[i, j] = np.sum(subI[idx])
-                    newI[i, j] = newI[i, j] / np.sum(np.sum(idx))
-                else:
-                    newI[i, j] = np.nan
-
-        self.image = newI
+        # sm and sn are dimensions after downResolution. each
+        # oversample x oversample block becomes its mean, ignoring NaNs
+        if (self.image.shape[0] != sm * oversample or
+                self.image.shape[1] != sn * oversample):
+            raise ValueError(
+                'downResolution: (%d, %d) image can not be resampled to '
+                '(%d, %d) by %d' % (self.image.shape + (sm, sn, oversample)))
+        self.image = resample.downsample(self.image, oversample)
 
     def imageCoCenter(self, inst, algo):
 
@@ -190,7 +243,8 @@ class Image(object):
 
         stampCenterx1 = inst.sensorSamples / 2. + 0.5
         stampCentery1 = inst.sensorSamples / 2. + 0.5
-        radialShift = 3.5 * algo.upReso * \
+        # inst.pixelSize already accounts for any upReso
+        radialShift = 3.5 * \
             (inst.offset / 1e-3) * (10e-6 / inst.pixelSize)
 
         radialShift = radialShift * self.fldr / 1.75
@@ -217,14 +271,17 @@ class Image(object):
 
         sm, sn = self.image.shape
 
+        oversample = int(oversample)
         projSamples = sm * oversample
 
         # Let us create a look-up table for x -> xp first.
         luty, lutx = np.mgrid[
             -(projSamples / 2 - 0.5):(projSamples / 2 + 0.5),
             -(projSamples / 2 - 0.5):(projSamples / 2 + 0.5)]
-        lutx = lutx / (projSamples / 2 / inst.sensorFactor)
-        luty = luty / (projSamples / 2 / inst.sensorFactor)
+        lutx = (lutx / (projSamples / 2 / inst.sensorFactor)).astype(
+            inst.dtype, copy=False)
+        luty = (luty / (projSamples / 2 / inst.sensorFactor)).astype(
+            inst.dtype, copy=False)
 
         # set up the mapping
         lutxp, lutyp, J = aperture2image(
@@ -239,18 +296,14 @@ class Image(object):
 
         show_lutxyp = tools.padArray(show_lutxyp, projSamples + 20)
 
-        struct0 = ndimage.generate_binary_structure(2, 1)
-        struct = ndimage.iterate_structure(struct0, 4)
-        struct = ndimage.morphology.binary_dilation(struct, structure=struct0)
-        struct = ndimage.morphology.binary_dilation(
-            struct, structure=struct0).astype(int)
-        show_lutxyp = ndimage.morphology.binary_dilation(
-            show_lutxyp, structure=struct)
-        show_lutxyp = ndimage.morphology.binary_erosion(
-            show_lutxyp, structure=struct)
+        show_lutxyp = closeProjection(show_lutxyp)
         show_lutxyp = tools.extractArray(show_lutxyp, projSamples)
 
-        self.centerOnProjection(show_lutxyp.astype(float))
+        # the projection is on the oversampled grid, the image isn't
+        show_lutxyp = show_lutxyp.astype(float)
+        if (oversample > 1):
+            show_lutxyp = resample.downsample(show_lutxyp, oversample)
+        self.centerOnProjection(show_lutxyp)
 
         # let's construct the interpolant,
         # to get the intensity on (x',p') plane
@@ -270,28 +323,13 @@ class Image(object):
         lutxp[np.isnan(lutxp)] = 0
         lutyp[np.isnan(lutyp)] = 0
 
-        #    lutIp=interp2(xp,yp,self.image,lutxp,lutyp)
-        #    print xp.shape, yp.shape, self.image.shape
-        #    print lutxp.ravel()
-        #    print xp[:,0],yp[0,:]
+        # bilinear interpolant; evaluate it over the whole look-up table in
+        # one call rather than one spline evaluation per pixel.
         ip = interpolate.RectBivariateSpline(
             yp[:, 0], xp[0, :], self.image, kx=1, ky=1)
+        lutIp = ip.ev(lutyp, lutxp)
 
-        #    ip = interpolate.interp2d(xp, yp, self.image)
-        #    ip = interpolate.interp2d(xp, yp, self.image)
-        #    print lutxp.shape, lutyp.shape
-        #    lutIp = ip(0.5, -0.5)
-        #    print lutIp, 'lutIp1'
-        #    lutIp = ip([-0.1],[-0.1])
-        #    print lutIp, 'lutIp2'
-        #    lutIp = ip(np.array(0.5,-0.1), np.array(-0.5, -0.1))
-        #    print lutIp, 'lutIp12',lutxp.ravel()[0:10]
-        lutIp = np.zeros(lutxp.shape[0] * lutxp.shape[1])
-        for i, (xx, yy) in enumerate(zip(lutxp.ravel(), lutyp.ravel())):
-            lutIp[i] = ip(yy, xx)
-        lutIp = lutIp.reshape(lutxp.shape)
-
-        self.image = lutIp * J
+        self.image = (lutIp * J).astype(inst.dtype, copy=False)
 
         if (self.type == 'extra'):
             self.image = np.rot90(self.image, k=2)
@@ -317,7 +355,7 @@ class Image(object):
 
         self.image[self.image < 0] = 0
         if (oversample > 1):
-            self.downResolution(self, oversample, sm, sn)
+            self.downResolution(oversample, sm, sn)
 
     def normalizeI(self, outerR, obsR):
         xmax = self.image.shape[1]
@@ -349,21 +387,65 @@ class Image(object):
             print('Saturation detected\n' % self.type)
 
     def centerOnProjection(self, template, window=20):
-        length = self.image.shape[0]
-        center = length // 2
-        corr = correlate(self.image, template, mode='same')
-        mask = np.zeros(corr.shape)
+        # roll the image onto the template, by the shift within the window
+        # that maximizes their correlation
         r = window // 2
-        mask[center-r:center+r, center-r:center+r] = 1
-        idx = np.argmax(corr * mask)
-        xmatch = (idx // length)
-        ymatch = (idx % length)
-        dx = center - xmatch
-        dy = center - ymatch
+        corr = windowCorrelation(self.image, template, r)
+        idx = np.argmax(corr)
+        dx = r - idx // (2 * r)
+        dy = r - idx % (2 * r)
 
         self.image = np.roll(np.roll(self.image, dx, axis=0), dy, axis=1)
 
 
+@lru_cache(maxsize=None)
+def _closingStructures():
+    # the projection has always been closed with a 9x9 octagon, a cross
+    # iterated 4 times and then dilated twice more by a cross (inside the
+    # 9x9 box).  The octagon is the Minkowski sum of a 5x5 square and a
+    # radius 2 diamond, i.e. two 3x3 square steps and two cross steps.
+    square = ndimage.generate_binary_structure(2, 2)
+    cross = ndimage.generate_binary_structure(2, 1)
+    square.setflags(write=False)
+    cross.setflags(write=False)
+    return square, cross
+
+
+def closeProjection(mask):
+    """
+    Morphological closing of the projected pupil mask with the compensator's
+    9x9 octagon, as four small cached structuring elements
+    """
+    square, cross = _closingStructures()
+    mask = ndimage.binary_dilation(mask, structure=square, iterations=2)
+    mask = ndimage.binary_dilation(mask, structure=cross, iterations=2)
+    mask = ndimage.binary_erosion(mask, structure=square, iterations=2)
+    return ndimage.binary_erosion(mask, structure=cross, iterations=2)
+
+
+def windowCorrelation(image, template, r):
+    """
+    Correlation of image with template for the shifts within r pixels of
+    the centre, as a (2r x 2r) array.  Element [r + a, r + b] is
+    scipy.signal.correlate(image, template, mode='same') at
+    (M // 2 + a, N // 2 + b), with (M, N) the image shape.  Only these
+    shifts are computed, with real FFTs just big enough not to wrap around.
+    """
+    M, N = image.shape
+    m, n = template.shape
+    # c[d] = sum_l image[l] * template[l - d], for d in [lo, lo + 2r)
+    lo0 = M // 2 - m // 2 - r
+    lo1 = N // 2 - n // 2 - r
+    s = (scipy.fft.next_fast_len(max(M, m, m + lo0 + 2 * r, M - lo0)),
+         scipy.fft.next_fast_len(max(N, n, n + lo1 + 2 * r, N - lo1)))
+    c = scipy.fft.irfft2(
+        scipy.fft.rfft2(image, s) * np.conj(scipy.fft.rfft2(template, s)),
+        s)
+    rows = np.arange(lo0, lo0 + 2 * r) % s[0]
+    cols = np.arange(lo1, lo1 + 2 * r) % s[1]
+    return c[np.ix_(rows, cols)]
+
+
 def getCenter(image):
     cut = filters.threshold_otsu(image)
     mask = image > cut
@@ -380,7 +462,7 @@ def linear2D(xydata, c00, c10, c01):
 def getOffAxisCorr_single(confFile, fldr):
     cwfsSrcDir = os.path.split(os.path.abspath(__file__))[0]
     cwfsBaseDir = '%s/../' % cwfsSrcDir
-    cdata = np.loadtxt(os.path.join(cwfsBaseDir, confFile))
+    cdata = tools.loadTxt(os.path.join(cwfsBaseDir, confFile))
     c = cdata[:, 1:]
     offset = cdata[0, 0]
 
@@ -412,12 +494,141 @@ def getOffAxisCorr_single(confFile, fldr):
     return corr_coeff, offset
 
 
+def makeMaskList(inst, fieldX, fieldY, model):
+    """
+    Return the mask elements of an image at (fieldX, fieldY), one
+    (x, y, radius, pass/block) row per element, and the interpolated
+    (ca, ra, cb, rb) vignetting parameters, or None for the on-axis models.
+    """
+    if (model == 'paraxial' or model == 'onAxis'):
+        if inst.obscuration == 0:
+            masklist = np.array([[0, 0, 1, 1]])
+        else:
+            masklist = np.array([[0, 0, 1, 1],
+                                 [0, 0, inst.obscuration, 0]])
+        return masklist, None
+
+    ca, ra, cb, rb = interpMaskParam(fieldX, fieldY, inst.maskParam)
+    cax, cay, cbx, cby = rotateMaskParam(  # only change the center
+        ca, cb, fieldX, fieldY)
+    masklist = np.array(
+        [[0, 0, 1, 1], [0, 0, inst.obscuration, 0],
+         [cax, cay, ra, 1], [cbx, cby, rb, 0]])
+    return masklist, (ca, ra, cb, rb)
+
+
+def makeMask(inst, masklist, boundaryT, maskScalingFactor):
+    """
+    Return the pupil mask and the computational mask for masklist, as
+    arrays of inst.dtype.  The computational mask is boundaryT pixels
+    wider (or narrower) at each edge.
+    """
+    pMask = np.ones(inst.sensorSamples, dtype=inst.dtype)
+    cMask = pMask
+
+    rMask = inst.apertureDiameter / (2 * inst.focalLength / inst.offset)\
+        * maskScalingFactor
+
+    for ii in range(masklist.shape[0]):
+
+        r = np.sqrt((inst.xSensor - masklist[ii, 0])**2 +
+                    (inst.ySensor - masklist[ii, 1])**2)
+
+        # Initialize both mask elements to the opposite of the pass/block
+        # boolean
+        pMaskii = np.full((inst.sensorSamples, inst.sensorSamples),
+                          1 - masklist[ii, 3], dtype=inst.dtype)
+        cMaskii = np.full((inst.sensorSamples, inst.sensorSamples),
+                          1 - masklist[ii, 3], dtype=inst.dtype)
+
+        # Find the indices that correspond to the mask element, set them to
+        # the pass/block boolean
+        idx = r <= masklist[ii, 2]
+        if (masklist[ii, 3] >= 1):
+            # make a mask >r so that we can keep a larger area of S
+            aidx = np.nonzero(r <= masklist[ii, 2] *
+                              (1 + boundaryT * inst.pixelSize / rMask))
+        else:
+            aidx = np.nonzero(r <= masklist[ii, 2] *
+                              (1 - boundaryT * inst.pixelSize / rMask))
+        pMaskii[idx] = masklist[ii, 3]
+        cMaskii[aidx] = masklist[ii, 3]
+
+        # Multiplicatively add the current mask elements to the model masks
+        # padded mask - for use at the offset planes
+        pMask = pMask * pMaskii
+        # non-padded mask corresponding to aperture
+        cMask = cMask * cMaskii
+
+    return pMask, cMask
+
+
+class MaskSet(object):
+    """
+    The read-only boolean pupil and computational masks of an image, with
+    their mask list and, if padDim is given, their versions padded to
+    padDim for the FFT solver.  Use getMaskSet() to get a cached one.
+    """
+
+    def __init__(self, inst, fieldX, fieldY, model, boundaryT,
+                 maskScalingFactor, padDim=None):
+        self.masklist, self.maskParam = makeMaskList(
+            inst, fieldX, fieldY, model)
+        pMask, cMask = makeMask(inst, self.masklist, boundaryT,
+                                maskScalingFactor)
+        self.pMask = pMask != 0
+        self.cMask = cMask != 0
+        self.pMaskPad = None
+        self.cMaskPad = None
+        if padDim is not None:
+            self.pMaskPad = tools.padArray(pMask, padDim) != 0
+            self.cMaskPad = tools.padArray(cMask, padDim) != 0
+        self.nbytes = 0
+        for a in (self.masklist, self.pMask, self.cMask, self.pMaskPad,
+                  self.cMaskPad):
+            if a is not None:
+                a.setflags(write=False)
+                self.nbytes += a.nbytes
+
+
+# the masks only depend on the instrument geometry, the field position (for
+# the off-axis model), the model and the boundary parameters, so every
+# exposure at the same position shares them
+_maskCache = tools.LRUCache(maxBytes=128 * 1024**2)
+
+
+def getMaskCache():
+    """
+    Return the process-wide cache used by getMaskSet()
+    """
+    return _maskCache
+
+
+def getMaskSet(inst, fieldX, fieldY, model, boundaryT, maskScalingFactor,
+               padDim=None):
+    """
+    Return the MaskSet of an image at (fieldX, fieldY), building it only if
+    it isn't in the mask cache yet.  Field positions are matched to 1e-6
+    degrees; the on-axis models ignore them.
+    """
+    if (model == 'paraxial' or model == 'onAxis'):
+        field = None
+    else:
+        field = (round(float(fieldX), 6), round(float(fieldY), 6))
+    key = (inst.filename, inst.maskParam, inst.sensorSamples,
+           inst.pixelSize, inst.offset, inst.obscuration, inst.focalLength,
+           inst.apertureDiameter, field, model, boundaryT,
+           float(maskScalingFactor), padDim)
+    return _maskCache.get(key, lambda: MaskSet(
+        inst, fieldX, fieldY, model, boundaryT, maskScalingFactor, padDim))
+
+
 def interpMaskParam(fieldX, fieldY, maskParam):
     fldr = np.sqrt(fieldX**2 + fieldY**2)
 
     cwfsSrcDir = os.path.split(os.path.abspath(__file__))[0]
     cwfsBaseDir = '%s/../' % cwfsSrcDir
-    c = np.loadtxt(os.path.join(cwfsBaseDir, maskParam))
+    c = tools.loadTxt(os.path.join(cwfsBaseDir, maskParam))
     ruler = np.sqrt(2 * c[:, 0]**2)
     step = ruler[1] - ruler[0]
 
@@ -497,6 +708,23 @@ def createPupilGrid(lutx, luty, onepixel, ca, cb, ra, rb, fieldX, fieldY=None):
     return lutx, luty
 
 
+def zernikeDerivative(Z, x, y, e, atype, cached):
+    """
+    The atype derivative ('dx', 'dy', 'dx2', 'dy2' or 'dxy') of the
+    Zernikes Z on (x, y): annular ones with obscuration e, or standard ones
+    if e is None (only 'dx' and 'dy').  With cached, from the Zernike basis
+    cache, which pays off only for grids that are evaluated over and over;
+    otherwise by the closed-form expressions, without building bases.
+    """
+    if cached:
+        if e is None:
+            return ZernikeBasisEval(Z, x, y, atype)
+        return ZernikeAnnularBasisEval(Z, x, y, e, atype)
+    if e is None:
+        return ZernikeGrad(Z, x, y, atype)
+    return ZernikeAnnularGrad(Z, x, y, e, atype)
+
+
 def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
     R = inst.apertureDiameter / 2.0
     if (Im.type == 'intra'):
@@ -505,9 +733,6 @@ def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
     elif (Im.type == 'extra'):
         myC = inst.focalLength * (inst.focalLength / inst.offset + 1) / R**2
 
-    polyFunc = tools.getFunction('poly%d_2D' % algo.offAxisPolyOrder)
-    polyGradFunc = tools.getFunction('poly%dGrad' % algo.offAxisPolyOrder)
-
     lutr = np.sqrt(lutx**2 + luty**2)
     # 1 pixel larger than projected pupil. No need to be EF-like, anything
     # outside of this will be masked off by the computational mask
@@ -576,9 +801,18 @@ def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
         # first rotate back to reference orientation
         lutx0 = lutx * costheta + luty * sintheta
         luty0 = -lutx * sintheta + luty * costheta
-        # use mapping at reference orientation
-        lutxp0 = polyFunc(cx, lutx0, y=luty0)
-        lutyp0 = polyFunc(cy, lutx0, y=luty0)
+        # use mapping at reference orientation. the monomials of
+        # (lutx0, luty0) are built once; the mapping and its gradients
+        # (needed for the Jacobian) then come from one matrix product.
+        order = algo.offAxisPolyOrder
+        polyCoeff = np.vstack((
+            cx, cy,
+            tools.polyGradCoeff(cx, order, 'dx'),
+            tools.polyGradCoeff(cx, order, 'dy'),
+            tools.polyGradCoeff(cy, order, 'dx'),
+            tools.polyGradCoeff(cy, order, 'dy')))
+        lutxp0, lutyp0, cxdx0, cxdy0, cydx0, cydy0 = np.tensordot(
+            polyCoeff, tools.polyMonomials(lutx0, luty0, order), axes=1)
         lutxp = lutxp0 * costheta - lutyp0 * sintheta  # rotate back
         lutyp = lutxp0 * sintheta + lutyp0 * costheta
         # Zemax data are in mm, therefore 1000
@@ -592,15 +826,16 @@ def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
         print('wrong model number in compensate\n')
         return
 
+    # the paraxial and onAxis look-up tables are the same in every solve,
+    # so their Zernike derivatives come from the cached bases; the offAxis
+    # ones move with the field, and are evaluated directly
+    cached = (model != 'offAxis')
     if (zcCol.ndim == 1):
-        if (algo.zobsR > 0):
-            lutxp = lutxp + myC * \
-                ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dx')
-            lutyp = lutyp + myC * \
-                ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dy')
-        else:
-            lutxp = lutxp + myC * ZernikeGrad(zcCol, lutx, luty, 'dx')
-            lutyp = lutyp + myC * ZernikeGrad(zcCol, lutx, luty, 'dy')
+        e = algo.zobsR if (algo.zobsR > 0) else None
+        lutxp = lutxp + myC * zernikeDerivative(
+            zcCol, lutx, luty, e, 'dx', cached)
+        lutyp = lutyp + myC * zernikeDerivative(
+            zcCol, lutx, luty, e, 'dy', cached)
     else:
         FX, FY = np.gradient(zcCol,
                              inst.sensorFactor / (inst.sensorSamples / 2))
@@ -629,36 +864,37 @@ def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
             xpox = algo.maskScalingFactor * myA * (
                 1 +
                 lutx**2 * R**2. / (inst.focalLength**2 - R**2 * lutr**2)) + \
-                myC * ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dx2')
+                myC * zernikeDerivative(
+                    zcCol, lutx, luty, algo.zobsR, 'dx2', cached)
             ypoy = algo.maskScalingFactor * myA * (
                 1 +
                 luty**2 * R**2. / (inst.focalLength**2 - R**2 * lutr**2)) + \
-                myC * ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dy2')
+                myC * zernikeDerivative(
+                    zcCol, lutx, luty, algo.zobsR, 'dy2', cached)
             xpoy = algo.maskScalingFactor * myA * \
                 lutx * luty * R**2 / (inst.focalLength**2 - R**2 * lutr**2) + \
-                myC * ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dxy')
+                myC * zernikeDerivative(
+                    zcCol, lutx, luty, algo.zobsR, 'dxy', cached)
             ypox = xpoy
 
             J = (xpox * ypoy - xpoy * ypox)
         elif (model == 'offAxis'):
-            xp0ox = polyGradFunc(cx, lutx0, luty0, 'dx') * costheta - \
-                polyGradFunc(cx, lutx0, luty0, 'dy') * sintheta
-            yp0ox = polyGradFunc(cy, lutx0, luty0, 'dx') * costheta - \
-                polyGradFunc(cy, lutx0, luty0, 'dy') * sintheta
-            xp0oy = polyGradFunc(cx, lutx0, luty0, 'dx') * sintheta + \
-                polyGradFunc(cx, lutx0, luty0, 'dy') * costheta
-            yp0oy = polyGradFunc(cy, lutx0, luty0, 'dx') * sintheta + \
-                polyGradFunc(cy, lutx0, luty0, 'dy') * costheta
+            xp0ox = cxdx0 * costheta - cxdy0 * sintheta
+            yp0ox = cydx0 * costheta - cydy0 * sintheta
+            xp0oy = cxdx0 * sintheta + cxdy0 * costheta
+            yp0oy = cydx0 * sintheta + cydy0 * costheta
             xpox = (xp0ox * costheta - yp0ox * sintheta) * \
                 reduced_coordi_factor + \
-                myC * ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dx2')
+                myC * zernikeDerivative(
+                    zcCol, lutx, luty, algo.zobsR, 'dx2', cached)
 
             ypoy = (xp0oy * sintheta + yp0oy * costheta) * \
                 reduced_coordi_factor + \
-                myC * ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dy2')
+                myC * zernikeDerivative(
+                    zcCol, lutx, luty, algo.zobsR, 'dy2', cached)
 
-            temp = myC * \
-                ZernikeAnnularGrad(zcCol, lutx, luty, algo.zobsR, 'dxy')
+            temp = myC * zernikeDerivative(
+                zcCol, lutx, luty, algo.zobsR, 'dxy', cached)
             # if temp==0,xpoy doesn't need to be symmetric about x=y
             xpoy = (xp0oy * costheta - yp0oy * sintheta) * \
                 reduced_coordi_factor + temp
@@ -691,14 +927,12 @@ def aperture2image(Im, inst, algo, zcCol, lutx, luty, projSamples, model):
                 (inst.focalLength**2 - R**2 * lutr**2) + myC * FXY
             ypox = xpoy
         elif (model == 'offAxis'):
-            xpox = polyGradFunc(cx, lutx, luty, 'dx') * \
-                reduced_coordi_factor + myC * FXX
-            ypoy = polyGradFunc(cy, lutx, luty, 'dy') * \
-                reduced_coordi_factor + myC * FYY
-            xpoy = polyGradFunc(cx, lutx, luty, 'dy') * \
-                reduced_coordi_factor + myC * FXY
-            ypox = polyGradFunc(cy, lutx, luty, 'dx') * \
-                reduced_coordi_factor + myC * FXY
+            cxdx, cxdy, cydx, cydy = np.tensordot(
+                polyCoeff[2:], tools.polyMonomials(lutx, luty, order), axes=1)
+            xpox = cxdx * reduced_coordi_factor + myC * FXX
+            ypoy = cydy * reduced_coordi_factor + myC * FYY
+            xpoy = cxdy * reduced_coordi_factor + myC * FXY
+            ypox = cydx * reduced_coordi_factor + myC * FXY
 
         J = (xpox * ypoy - xpoy * ypox)
 
@@ -11,33 +11,48 @@ from . import tools
 
 class Instrument(object):
 
-    def __init__(self, instruFile, sensorSamples):
+    def __init__(self, instruFile, sensorSamples, dtype=np.float64):
+        """!Create a cwfs Instrument
+
+        @param instruFile     name of the instrument configuration
+        @param sensorSamples  size of the donut stamps, in pixels
+        @param dtype          np.float32 runs the whole reconstruction in
+                              single precision
+        """
         self.instDir = os.path.join(tools.getDataDir(), "config", instruFile)
         self.filename = os.path.join(self.instDir, (instruFile + '.param'))
-        fid = open(self.filename)
-        iscomment = False
-        for line in fid:
-            line = line.strip()
-            if (line.startswith('###')):
-                iscomment = ~iscomment
-            if (not(line.startswith('#')) and
-                    (not iscomment) and len(line) > 0):
-                if (line.startswith('Obscuration')):
-                    self.obscuration = float(line.split()[-1])
-                elif (line.startswith('Focal_length')):
-                    self.focalLength = float(line.split()[-1])
-                elif (line.startswith('Aperture_diameter')):
-                    self.apertureDiameter = float(line.split()[-1])
-                elif (line.startswith('Offset')):
-                    self.offset = float(line.split()[-1])
-                elif (line.startswith('Pixel_size')):
-                    self.pixelSize = float(line.split()[-1])
-        fid.close()
+        # the parameter lines are kept as the provenance of results
+        self.params = tools.readParamFile(self.filename)
+        for line in self.params:
+            if (line.startswith('Obscuration')):
+                self.obscuration = float(line.split()[-1])
+            elif (line.startswith('Focal_length')):
+                self.focalLength = float(line.split()[-1])
+            elif (line.startswith('Aperture_diameter')):
+                self.apertureDiameter = float(line.split()[-1])
+            elif (line.startswith('Offset')):
+                self.offset = float(line.split()[-1])
+            elif (line.startswith('Pixel_size')):
+                self.pixelSize = float(line.split()[-1])
         self.fno = self.focalLength / self.apertureDiameter
         self.marginalFL = np.sqrt(
             self.focalLength**2 - (self.apertureDiameter / 2)**2)
         self.maskParam = os.path.join(self.instDir, 'mask_migrate.txt')
 
+        self.dtype = np.dtype(dtype)
+        self.setSensorSamples(sensorSamples)
+
+    def setSensorSamples(self, sensorSamples, pixelSize=None):
+        """!Set up the sensor grids for stamps of sensorSamples pixels
+
+        @param sensorSamples  size of the donut stamps, in pixels
+        @param pixelSize      pixel size (m), by default unchanged; e.g.
+                              Algorithm.itr0 shrinks it when it resamples
+                              the stamps to a finer grid
+        """
+        if pixelSize is not None:
+            self.pixelSize = pixelSize
+
         # the below need to be instrument parameters, b/c it is not specific
         # for I1 or I2
         self.sensorSamples = sensorSamples
@@ -59,6 +74,8 @@ class Instrument(object):
             (self.sensorSamples / 2 / self.sensorFactor)
         r2Sensor = self.xSensor**2 + self.ySensor**2
         idx = (r2Sensor > 1) | (r2Sensor < self.obscuration**2)
+        self.xSensor = self.xSensor.astype(self.dtype, copy=False)
+        self.ySensor = self.ySensor.astype(self.dtype, copy=False)
         self.xoSensor = self.xSensor.copy()  # o indicates annulus
         self.yoSensor = self.ySensor.copy()
         self.xoSensor[idx] = np.nan
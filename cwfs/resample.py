@@ -0,0 +1,48 @@
+# @package cwfs
+# @file resample.py
+##
+# @       Integer-factor resampling of 2-d images by array reshaping
+
+import numpy as np
+
+
+def _checkFactor(factor):
+    if (int(factor) != factor or factor < 1):
+        raise ValueError('resampling factor must be a positive integer, '
+                         'not %r' % factor)
+    return int(factor)
+
+
+def upsample(image, factor):
+    """
+    Replicate every pixel of image into a (factor x factor) block.  Returns
+    an array of shape (m * factor, n * factor); the values are not scaled.
+    """
+    factor = _checkFactor(factor)
+    image = np.asarray(image)
+    m, n = image.shape
+    out = np.broadcast_to(image[:, np.newaxis, :, np.newaxis],
+                          (m, factor, n, factor))
+    return out.reshape(m * factor, n * factor)
+
+
+def downsample(image, factor):
+    """
+    Average image over (factor x factor) blocks, ignoring NaNs.  Returns an
+    array of shape (m / factor, n / factor); blocks that are all NaN are
+    NaN.  Both dimensions of image must be multiples of factor.
+    """
+    factor = _checkFactor(factor)
+    image = np.asarray(image)
+    m, n = image.shape
+    if (m % factor or n % factor):
+        raise ValueError('downsample: image size (%d, %d) is not a multiple '
+                         'of %d' % (m, n, factor))
+    blocks = image.reshape(m // factor, factor, n // factor, factor)
+    finite = np.isfinite(blocks)
+    count = finite.sum(axis=(1, 3))
+    total = np.where(finite, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = total / count
+    out[count == 0] = np.nan
+    return out.astype(np.result_type(image.dtype, np.float32), copy=False)
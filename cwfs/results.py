@@ -0,0 +1,309 @@
+# @package cwfs
+# @file results.py
+##
+# @       Immutable solve results and bulk result files
+
+import json
+import os
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+_provenanceFields = ('instrumentFile', 'instrumentParams', 'algorithmFile',
+                     'algorithmParams', 'model', 'version')
+
+
+class Provenance(namedtuple('Provenance', _provenanceFields)):
+    """
+    Where a result comes from: the instrument and algorithm files with the
+    parameter lines read from them when they were loaded, the optical model
+    and the cwfs version.  It is the same for every pair solved with one
+    configuration; the geometry a pair was actually solved with, which
+    callers change per pair (e.g. the offset from the FOCUS header), is
+    kept in SolveResult.geometry.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromSolve(cls, inst, algo, model):
+        return cls(inst.filename, inst.params, algo.filename, algo.params,
+                   model, _version())
+
+    def toJSON(self):
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def fromJSON(cls, text):
+        d = json.loads(text)
+        d['instrumentParams'] = tuple(d['instrumentParams'])
+        d['algorithmParams'] = tuple(d['algorithmParams'])
+        return cls(**d)
+
+
+def _version():
+    try:
+        from . import __version__
+    except ImportError:
+        return ''
+    return __version__
+
+
+_resultFields = ('index', 'intraName', 'extraName', 'fieldXY', 'zer4UpNm',
+                 'converge', 'caustic', 'stopReason', 'stopItr', 'timing',
+                 'Wconverge', 'geometry', 'provenance')
+
+_geometryFields = ('obscuration', 'focalLength', 'apertureDiameter',
+                   'offset', 'pixelSize', 'sensorSamples')
+
+
+class SolveResult(namedtuple('SolveResult', _resultFields)):
+    """
+    The result of one intra/extra solve, as a read-only record
+
+    index       caller's index of the pair, -1 if not given
+    intraName   name of the intra image (e.g. its file), or ''
+    extraName   name of the extra image, or ''
+    fieldXY     field position of the intra image (degrees)
+    zer4UpNm    the Zernikes z4 and up, in nm
+    converge    the (numTerms, outerItr + 1) Zernike history in m, column j
+                is the estimate after outer iteration j (columns after
+                stopItr are zero)
+    caustic     1 if the solve ran into a caustic
+    stopReason  why runIt stopped, 'outerItr', 'caustic' or 'converged'
+    stopItr     the last outer iteration run
+    timing      Algorithm.timer.asDict() if timing was on, else None
+    Wconverge   the wavefront map, only if asked for, else None
+    geometry    dict of the instrument geometry the pair was solved with:
+                obscuration, focalLength, apertureDiameter, offset,
+                pixelSize and sensorSamples
+    provenance  a Provenance
+
+    The arrays are read-only copies, so the Algorithm can be reused.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromAlgorithm(cls, algo, inst, I1, I2, model, index=-1,
+                      intraName='', extraName='', wavefront=False):
+        """
+        Collect the result of algo.runIt(inst, I1, I2, model)
+        """
+        Wconverge = None
+        if wavefront:
+            Wconverge = _readOnly(algo.Wconverge)
+        timing = None
+        if algo.timer.enabled:
+            timing = algo.timer.asDict()
+        return cls(int(index), intraName, extraName,
+                   (float(I1.fieldX), float(I1.fieldY)),
+                   _readOnly(algo.zer4UpNm), _readOnly(algo.converge),
+                   int(algo.caustic), algo.stopReason,
+                   -1 if algo.stopItr is None else int(algo.stopItr),
+                   timing, Wconverge, _geometry(inst),
+                   Provenance.fromSolve(inst, algo, model))
+
+
+def _geometry(inst):
+    geometry = {name: float(getattr(inst, name)) for name in _geometryFields}
+    geometry['sensorSamples'] = int(inst.sensorSamples)
+    return geometry
+
+
+def _readOnly(a):
+    a = np.array(a)
+    a.setflags(write=False)
+    return a
+
+
+class ResultWriter(object):
+
+    def __init__(self, filename, batchSize=1000):
+        """!Bulk writer of SolveResults, e.g. one file per night
+
+        @param filename   the .npz or .fits file to write; results are added
+                          to it if it exists
+        @param batchSize  number of results buffered before they are
+                          written out as one batch
+
+        Each batch is stored column by column: index, intraName, extraName,
+        fieldX, fieldY, zer4UpNm, converge, caustic, stopReason, stopItr,
+        timing (as JSON) and the geometry, one column per field.  The
+        provenance is written once per file and every result added must
+        have the same provenance.  Use readResults()
+        to read the file back.
+        """
+        if filename.endswith('.npz'):
+            self.format = 'npz'
+        elif filename.endswith(('.fits', '.fit')):
+            self.format = 'fits'
+        else:
+            raise ValueError('ResultWriter: %s is neither .npz nor .fits'
+                             % filename)
+        self.filename = filename
+        self.batchSize = batchSize
+        self.results = []
+        self.provenance = None
+        self.nBatches = 0
+        if os.path.exists(filename):
+            self.provenance, self.nBatches = _fileInfo(filename,
+                                                       self.format)
+
+    def append(self, result):
+        if self.provenance is None:
+            self.provenance = result.provenance
+        elif result.provenance != self.provenance:
+            raise ValueError(
+                'ResultWriter: result %d comes from another configuration '
+                'than the results in %s' % (result.index, self.filename))
+        self.results.append(result)
+        if len(self.results) >= self.batchSize:
+            self.flush()
+
+    def extend(self, results):
+        for result in results:
+            self.append(result)
+
+    def flush(self):
+        """
+        Write out the buffered results
+        """
+        if len(self.results) == 0:
+            return
+        columns = _columns(self.results)
+        if self.format == 'npz':
+            self._writeNpz(columns)
+        else:
+            self._writeFits(columns)
+        self.nBatches += 1
+        self.results = []
+
+    def _writeNpz(self, columns):
+        with zipfile.ZipFile(self.filename, 'a', zipfile.ZIP_STORED) as zf:
+            if self.nBatches == 0:
+                _writeMember(zf, 'provenance',
+                             np.array(self.provenance.toJSON()))
+            for name, column in columns.items():
+                _writeMember(zf, 'batch%06d/%s' % (self.nBatches, name),
+                             column)
+
+    def _writeFits(self, columns):
+        hdu = fits.table_to_hdu(Table(columns))
+        hdu.name = 'RESULTS'
+        if self.nBatches == 0:
+            prov = fits.table_to_hdu(Table(
+                {'provenance': [self.provenance.toJSON()]}))
+            prov.name = 'PROVENANCE'
+            fits.HDUList([fits.PrimaryHDU(), prov, hdu]).writeto(
+                self.filename)
+        else:
+            fits.append(self.filename, hdu.data, hdu.header)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_columnNames = ('index', 'intraName', 'extraName', 'fieldX', 'fieldY',
+                'zer4UpNm', 'converge', 'caustic', 'stopReason', 'stopItr',
+                'timing') + _geometryFields
+
+
+def _stack(arrays):
+    # warm-started solves have shorter histories; pad them with zeros
+    nItr = max(a.shape[-1] for a in arrays)
+    out = np.zeros((len(arrays),) + arrays[0].shape[:-1] + (nItr,))
+    for k, a in enumerate(arrays):
+        out[k, ..., :a.shape[-1]] = a
+    return out
+
+
+def _columns(results):
+    return dict(
+        index=np.array([r.index for r in results], dtype=np.int64),
+        intraName=np.array([r.intraName for r in results], dtype=str),
+        extraName=np.array([r.extraName for r in results], dtype=str),
+        fieldX=np.array([r.fieldXY[0] for r in results]),
+        fieldY=np.array([r.fieldXY[1] for r in results]),
+        zer4UpNm=np.array([r.zer4UpNm for r in results]),
+        converge=_stack([r.converge for r in results]),
+        caustic=np.array([r.caustic for r in results], dtype=np.int16),
+        stopReason=np.array([r.stopReason or '' for r in results],
+                            dtype=str),
+        stopItr=np.array([r.stopItr for r in results], dtype=np.int32),
+        timing=np.array([json.dumps(r.timing) for r in results], dtype=str),
+        **{name: np.array([r.geometry[name] for r in results])
+           for name in _geometryFields})
+
+
+def _writeMember(zf, name, array):
+    with zf.open(name + '.npy', 'w', force_zip64=True) as fid:
+        np.lib.format.write_array(fid, np.asanyarray(array),
+                                  allow_pickle=False)
+
+
+def _fileInfo(filename, format):
+    # the provenance and number of batches of an existing result file
+    if format == 'npz':
+        with np.load(filename) as npz:
+            provenance = Provenance.fromJSON(str(npz['provenance']))
+            nBatches = len(set(name.split('/')[0] for name in npz.files
+                               if name.startswith('batch')))
+    else:
+        with fits.open(filename) as hdul:
+            provenance = Provenance.fromJSON(
+                str(hdul['PROVENANCE'].data['provenance'][0]))
+            nBatches = len(hdul) - 2
+    return provenance, nBatches
+
+
+def _asStr(a):
+    # FITS string columns come back as bytes
+    return a.astype(str) if a.dtype.kind == 'S' else a
+
+
+def readResults(filename):
+    """
+    Read a file written by ResultWriter.  Returns a dict of the columns,
+    concatenated over all batches, with the decoded Provenance under
+    'provenance'.  The timing column holds dicts (or None).
+    """
+    if filename.endswith('.npz'):
+        with np.load(filename) as npz:
+            provenance = Provenance.fromJSON(str(npz['provenance']))
+            batches = {}
+            for name in npz.files:
+                if name.startswith('batch'):
+                    batch, column = name.split('/')
+                    batches.setdefault(batch, {})[column] = npz[name]
+        batches = [batches[k] for k in sorted(batches)]
+    else:
+        with fits.open(filename) as hdul:
+            provenance = Provenance.fromJSON(
+                str(hdul['PROVENANCE'].data['provenance'][0]))
+            batches = [Table.read(hdu) for hdu in hdul[2:]]
+            batches = [{name: _asStr(np.asarray(t[name]))
+                        for name in t.colnames} for t in batches]
+
+    columns = {}
+    for name in _columnNames:
+        parts = [b[name] for b in batches]
+        if len(parts) == 0:
+            columns[name] = np.array([])
+        elif name == 'converge':
+            nItr = max(part.shape[-1] for part in parts)
+            columns[name] = np.concatenate([np.pad(
+                part, [(0, 0), (0, 0), (0, nItr - part.shape[-1])])
+                for part in parts])
+        else:
+            columns[name] = np.concatenate(parts)
+    columns['timing'] = [json.loads(t) for t in columns['timing']]
+    columns['provenance'] = provenance
+    return columns
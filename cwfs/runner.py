@@ -0,0 +1,238 @@
+# @package cwfs
+# @file runner.py
+##
+# @       Parallel solving of many intra/extra donut pairs
+
+import copy
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+
+import numpy as np
+
+from .algorithm import Algorithm
+from .image import Image, readFile
+from .instrument import Instrument
+from .results import SolveResult
+
+log = logging.getLogger('cwfs.runner')
+
+
+@lru_cache(maxsize=None)
+def _getInstrument(instruFile, sensorSamples, dtype):
+    return Instrument(instruFile, sensorSamples, dtype)
+
+
+def getInstrument(instruFile, sensorSamples, dtype=np.float64):
+    """
+    Return an Instrument for instruFile, sensorSamples and dtype.  The
+    configuration is parsed once per process; each call gets its own
+    shallow copy, so per-pair changes (e.g. the up-resolution in
+    Algorithm.itr0) don't leak into the next pair.
+    """
+    return copy.copy(_getInstrument(instruFile, sensorSamples,
+                                    np.dtype(dtype)))
+
+
+# the Instrument attributes instParams may set: the geometry read from the
+# instrument file
+INST_PARAMS = ('obscuration', 'focalLength', 'apertureDiameter', 'offset',
+               'pixelSize')
+
+
+def checkInstParams(instParams):
+    """
+    Return a copy of instParams (see solvePair), or {} for None, with the
+    values as floats.  Raises ValueError if it isn't a dict, has a key
+    that isn't in INST_PARAMS, or a value that isn't a finite number.
+    """
+    if instParams is None:
+        return {}
+    if not isinstance(instParams, dict):
+        raise ValueError('instParams must be a dict, not %s'
+                         % type(instParams).__name__)
+    checked = {}
+    for name, value in instParams.items():
+        if name not in INST_PARAMS:
+            raise ValueError('instParams: %r is not one of %s'
+                             % (name, ', '.join(INST_PARAMS)))
+        try:
+            checked[name] = float(value)
+        except (TypeError, ValueError):
+            checked[name] = np.nan
+        if not np.isfinite(checked[name]):
+            raise ValueError('instParams: %s must be a finite number, not '
+                             '%r' % (name, value))
+    return checked
+
+
+def solvePair(index, intra, extra, intraXY, extraXY, instruFile, algoFile,
+              model, debugLevel=0, z0=None, warmItr=4, dtype=np.float64,
+              timing=False, instParams=None):
+    """
+    Solve one intra/extra pair and return a result record, a dict with
+
+    index     the index passed in, so records can be matched to their input
+    zer4UpNm  the Zernikes z4 and up in nm, or None if the solve failed
+    caustic   the caustic flag of the solve
+    error     None on success, otherwise 'ExceptionType: message'
+    traceback the formatted traceback of the failure, or None
+    timing    with timing=True, the per-stage timings of the solve (see
+              Algorithm.setTiming), otherwise None
+    result    the SolveResult of the solve, or None if it failed
+
+    intra and extra are either image arrays or filenames that
+    image.readFile() understands.  z0 and warmItr warm-start the solve, see
+    Algorithm.setWarmStart(), and dtype=np.float32 solves in single
+    precision.  instParams is a dict of Instrument attributes set on the
+    pair's copy of the instrument, e.g. the offset that bino_cwfs works
+    out from the image headers; only the geometry in INST_PARAMS may be
+    set, see checkInstParams().  Any exception raised while solving is
+    turned into an error record rather than propagated, so one bad pair
+    doesn't abort a batch.
+    """
+    record = dict(index=index, zer4UpNm=None, caustic=None, error=None,
+                  traceback=None, timing=None, result=None)
+    try:
+        intraName = intra if isinstance(intra, str) else ''
+        extraName = extra if isinstance(extra, str) else ''
+        if isinstance(intra, str):
+            intra = readFile(intra)
+        if isinstance(extra, str):
+            extra = readFile(extra)
+        I1 = Image(np.array(intra, dtype=float), intraXY, Image.INTRA)
+        I2 = Image(np.array(extra, dtype=float), extraXY, Image.EXTRA)
+        inst = getInstrument(instruFile, I1.sizeinPix, dtype)
+        for name, value in checkInstParams(instParams).items():
+            setattr(inst, name, value)
+        algo = Algorithm(algoFile, inst, debugLevel)
+        if timing:
+            algo.setTiming()
+        algo.runIt(inst, I1, I2, model, z0=z0, warmItr=warmItr)
+        record['zer4UpNm'] = algo.zer4UpNm
+        record['caustic'] = algo.caustic
+        if timing:
+            record['timing'] = algo.timer.asDict()
+        record['result'] = SolveResult.fromAlgorithm(
+            algo, inst, I1, I2, model, index, intraName, extraName)
+    except (Exception, SystemExit) as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        record['traceback'] = traceback.format_exc()
+    return record
+
+
+def _failedRecord(index, e):
+    # the record of a pair whose future itself failed, e.g. a worker died
+    return dict(index=index, zer4UpNm=None, caustic=None,
+                error='%s: %s' % (type(e).__name__, e),
+                traceback=traceback.format_exc(), timing=None, result=None)
+
+
+def _initWorker(instruFile, algoFile, model, sensorSamples, dtype):
+    # before the first pair arrives, build what it would otherwise pay for:
+    # the Instrument for its stamp size, and the masks, Zernike bases and
+    # fitters, by running the first outer iteration on an ideal pair (the
+    # pupil itself) at the centre of the field
+    if sensorSamples is None:
+        return
+    try:
+        inst = getInstrument(instruFile, sensorSamples, dtype)
+        algo = Algorithm(algoFile, inst, 0)
+        algo.setWarmStart(np.zeros(algo.numTerms), 0)
+        donut = np.isfinite(inst.xoSensor).astype(float)
+        algo.runIt(inst, Image(donut.copy(), (0, 0), Image.INTRA),
+                   Image(donut.copy(), (0, 0), Image.EXTRA), model)
+    except Exception as e:
+        # a bad configuration is also reported by each pair
+        log.warning('warming up the solver for %d pixel stamps failed: '
+                    '%s: %s', sensorSamples, type(e).__name__, e)
+
+
+class ParallelRunner(object):
+
+    def __init__(self, instruFile, algoFile, model, maxWorkers=None,
+                 debugLevel=0, dtype=np.float64, timing=False,
+                 sensorSamples=None):
+        """!Farm intra/extra pairs out to a pool of worker processes
+
+        @param instruFile     instrument name, as for Instrument
+        @param algoFile       algorithm name, as for Algorithm
+        @param model          optical model, 'paraxial', 'onAxis' or
+                              'offAxis'
+        @param maxWorkers     number of worker processes, default all cores
+        @param debugLevel     passed on to Algorithm
+        @param dtype          np.float32 for single precision solves
+        @param timing         add the per-stage timings to the records
+        @param sensorSamples  stamp size, in pixels, the workers get ready
+                              for when they start; by default the size of
+                              the first pair submitted
+
+        The worker processes are started by start(), or else by the first
+        submit().
+        """
+        self.instruFile = instruFile
+        self.algoFile = algoFile
+        self.model = model
+        self.maxWorkers = maxWorkers
+        self.debugLevel = debugLevel
+        self.dtype = dtype
+        self.timing = timing
+        self.sensorSamples = sensorSamples
+        self.pool = None
+
+    def start(self, sensorSamples=None):
+        """
+        Start the pool; each worker process gets ready for stamps of
+        sensorSamples pixels (by default the sensorSamples of the runner,
+        if it was given one) before it takes its first pair.
+        """
+        if sensorSamples is None:
+            sensorSamples = self.sensorSamples
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.maxWorkers, initializer=_initWorker,
+            initargs=(self.instruFile, self.algoFile, self.model,
+                      sensorSamples, self.dtype))
+
+    def submit(self, index, intra, extra, intraXY, extraXY=None, z0=None,
+               warmItr=4, instParams=None):
+        """
+        Queue one pair and return its Future; extraXY defaults to intraXY.
+        z0 and warmItr warm-start the solve, see Algorithm.setWarmStart(),
+        and instParams overrides Instrument attributes, see solvePair().
+        """
+        if extraXY is None:
+            extraXY = intraXY
+        if self.pool is None:
+            self.start(None if isinstance(intra, str) else len(intra))
+        return self.pool.submit(
+            solvePair, index, intra, extra, tuple(intraXY), tuple(extraXY),
+            self.instruFile, self.algoFile, self.model, self.debugLevel,
+            z0, warmItr, self.dtype, self.timing, instParams)
+
+    def run(self, pairs):
+        """
+        Solve all pairs and yield their result records (see solvePair) in
+        the order they complete.  Each pair is (intra, extra, fieldXY) or
+        (intra, extra, intraXY, extraXY); the record index is the position
+        of the pair in pairs.
+        """
+        futures = {}
+        for index, pair in enumerate(pairs):
+            futures[self.submit(index, *pair)] = index
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # e.g. a worker died; keep going with the other pairs
+                yield _failedRecord(futures[future], e)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
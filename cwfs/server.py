@@ -0,0 +1,404 @@
+# @package cwfs
+# @file server.py
+##
+# @       Local socket server of wavefront solves, and its client
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+from .runner import ParallelRunner, checkInstParams
+
+log = logging.getLogger('cwfs.server')
+
+# longest request line, i.e. a pair of stamps of about 2000x2000 pixels
+_lineLimit = 2**26
+
+
+def encodeArray(a):
+    """
+    Encode an array for a request or reply, as a dict of its dtype, shape
+    and base64 encoded data.
+    """
+    a = np.ascontiguousarray(a)
+    return dict(dtype=a.dtype.str, shape=list(a.shape),
+                data=base64.b64encode(a.tobytes()).decode('ascii'))
+
+
+def decodeArray(obj):
+    """
+    Decode an array encoded by encodeArray(), or given as nested lists.
+    """
+    if isinstance(obj, dict):
+        a = np.frombuffer(base64.b64decode(obj['data']),
+                          dtype=np.dtype(obj['dtype']))
+        return a.reshape(obj['shape'])
+    return np.array(obj, dtype=float)
+
+
+def _reply(rid, record, seconds):
+    reply = dict(id=rid, zer4UpNm=None, caustic=record['caustic'],
+                 stopReason=None, stopItr=None, converge=None,
+                 error=record['error'], timing=record['timing'],
+                 seconds=seconds)
+    result = record['result']
+    if result is not None:
+        reply.update(zer4UpNm=result.zer4UpNm.tolist(),
+                     stopReason=result.stopReason, stopItr=result.stopItr,
+                     converge=result.converge[:, :result.stopItr + 1].tolist())
+    return reply
+
+
+class SolveServer(object):
+
+    def __init__(self, instruFile, algoFile, model, maxWorkers=None,
+                 maxQueue=64, debugLevel=0, dtype=np.float64, timing=False,
+                 sensorSamples=None):
+        """!Serve wavefront solves over a local socket
+
+        @param instruFile     instrument name, as for Instrument
+        @param algoFile       algorithm name, as for Algorithm
+        @param model          optical model, 'paraxial', 'onAxis' or
+                              'offAxis'
+        @param maxWorkers     number of solver processes, default all cores
+        @param maxQueue       most solves waiting for a solver; requests
+                              beyond that are turned down
+        @param debugLevel     passed on to Algorithm
+        @param dtype          np.float32 for single precision solves
+        @param timing         add the per-stage timings to the replies
+        @param sensorSamples  stamp size, in pixels, the solver processes
+                              get ready for when they start
+
+        The protocol is JSON lines, one request or reply per line.  A
+        request is a dict with an 'id' (a string or an integer, unique
+        among the open requests of the connection) and an 'op':
+
+        solve   intra, extra: the stamps (see encodeArray); optional
+                intraXY, extraXY (default intraXY, or (0, 0)), instParams,
+                z0, warmItr (see runner.solvePair).  instParams may only
+                set the geometry in runner.INST_PARAMS; a request with any
+                other key is turned down before it is queued.  The reply has the id,
+                zer4UpNm, caustic, stopReason, stopItr, converge (the
+                Zernike history in m), error, timing and seconds (from
+                request to reply); or cancelled: true if it was cancelled.
+        cancel  target: the id of a solve.  A solve still waiting is
+                dropped; a running one is left to finish and its result
+                thrown away.  Unknown targets, e.g. solves that finished
+                already, are ignored.  There is no reply of its own.
+        status  replies with queueDepth (solves waiting for a solver),
+                running, completed, cancelled and rejected counts and the
+                number of workers.
+
+        Replies to solves are sent as they complete, so not necessarily
+        in the order of the requests.
+        """
+        self.maxWorkers = maxWorkers or os.cpu_count()
+        self.maxQueue = maxQueue
+        self.runner = ParallelRunner(instruFile, algoFile, model,
+                                     maxWorkers=self.maxWorkers,
+                                     debugLevel=debugLevel, dtype=dtype,
+                                     timing=timing,
+                                     sensorSamples=sensorSamples)
+        self.server = None
+        self.slots = None
+        self.nRequests = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """
+        Start the solver processes and listen on the Unix socket path, or
+        else on host:port.  Returns the address listened on.
+        """
+        loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.maxWorkers)
+        # start every worker, so the first requests don't pay for the
+        # process start-up and, given the stamp size, the geometry setup
+        self.runner.start()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.runner.pool, os.getpid)
+            for _ in range(self.maxWorkers)])
+        if path is not None:
+            self.server = await asyncio.start_unix_server(
+                self._handle, path, limit=_lineLimit)
+        else:
+            self.server = await asyncio.start_server(
+                self._handle, host, port, limit=_lineLimit)
+        address = self.server.sockets[0].getsockname()
+        log.info('listening on %s', address)
+        return address
+
+    async def serveForever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.runner.close()
+
+    def status(self):
+        return dict(queueDepth=self.queued, running=self.running,
+                    completed=self.completed, cancelled=self.cancelled,
+                    rejected=self.rejected, workers=self.maxWorkers)
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = {}
+
+        async def send(reply):
+            async with lock:
+                if writer.is_closing():
+                    return
+                try:
+                    writer.write(json.dumps(reply).encode() + b'\n')
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    await send(dict(id=None, error='request too long'))
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    rid = request.get('id')
+                    op = request.get('op', 'solve')
+                except (ValueError, AttributeError):
+                    await send(dict(id=None, error='bad request'))
+                    continue
+
+                if (op == 'status'):
+                    await send(dict(id=rid, **self.status()))
+                elif (op == 'cancel'):
+                    task = tasks.get(request.get('target'))
+                    if task is not None:
+                        task.cancel()
+                elif (op != 'solve'):
+                    await send(dict(id=rid, error='unknown op %r' % op))
+                elif (not isinstance(rid, (str, int)) or rid in tasks):
+                    await send(dict(id=rid, error='the id must be a string '
+                                    'or an integer not in use'))
+                elif (self.queued >= self.maxQueue):
+                    self.rejected += 1
+                    await send(dict(id=rid, error='queue full'))
+                else:
+                    try:
+                        request['instParams'] = checkInstParams(
+                            request.get('instParams'))
+                    except ValueError as e:
+                        await send(dict(id=rid, error='bad solve request: '
+                                        '%s: %s' % (type(e).__name__, e)))
+                        continue
+                    self.queued += 1
+                    task = asyncio.create_task(self._solve(rid, request,
+                                                           send))
+                    tasks[rid] = task
+                    task.add_done_callback(
+                        lambda t, rid=rid: tasks.pop(rid, None))
+        finally:
+            # the client is gone, nobody wants the results
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    def _release(self):
+        self.running -= 1
+        self.slots.release()
+
+    async def _solve(self, rid, request, send):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            try:
+                intra = decodeArray(request['intra'])
+                extra = decodeArray(request['extra'])
+                intraXY = tuple(request.get('intraXY', (0, 0)))
+                extraXY = tuple(request.get('extraXY', intraXY))
+                z0 = request.get('z0')
+                if z0 is not None:
+                    z0 = np.array(z0, dtype=float)
+            except (KeyError, TypeError, ValueError) as e:
+                self.queued -= 1
+                await send(dict(id=rid, error='bad solve request: %s: %s'
+                                % (type(e).__name__, e)))
+                return
+            try:
+                await self.slots.acquire()
+            finally:
+                self.queued -= 1
+
+            # the slot is held until the solve is over, even if the
+            # request is cancelled while running
+            self.running += 1
+            future = self.runner.submit(
+                self.nRequests, intra, extra, intraXY, extraXY, z0=z0,
+                warmItr=request.get('warmItr', 4),
+                instParams=request.get('instParams'))
+            self.nRequests += 1
+            future.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(self._release))
+            record = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            await send(dict(id=rid, cancelled=True))
+            return
+        except Exception as e:
+            # e.g. a worker died
+            record = dict(caustic=None, timing=None, result=None,
+                          error='%s: %s' % (type(e).__name__, e))
+        self.completed += 1
+        await send(_reply(rid, record, time.time() - start))
+
+
+class SolveClient(object):
+
+    def __init__(self, address, timeout=None):
+        """!Blocking client of a SolveServer
+
+        @param address  the Unix socket path, or a (host, port) tuple
+        @param timeout  socket timeout in seconds, default none
+        """
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+        else:
+            self.sock = socket.create_connection(tuple(address), timeout)
+        self.fid = self.sock.makefile('rb')
+        self.replies = {}
+        self.nextId = 0
+
+    def _send(self, request):
+        if 'id' not in request:
+            request['id'] = self.nextId
+            self.nextId += 1
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+        return request['id']
+
+    def submit(self, intra, extra, intraXY=(0, 0), extraXY=None, **params):
+        """
+        Send a solve request and return its id; params are the optional
+        request keys, see SolveServer.
+        """
+        request = dict(op='solve', intra=encodeArray(intra),
+                       extra=encodeArray(extra), intraXY=list(intraXY),
+                       **params)
+        if extraXY is not None:
+            request['extraXY'] = list(extraXY)
+        if request.get('z0') is not None:
+            request['z0'] = [float(z) for z in request['z0']]
+        return self._send(request)
+
+    def cancel(self, rid):
+        self._send(dict(op='cancel', target=rid))
+
+    def wait(self, rid):
+        """
+        Return the reply to request rid, keeping the replies to other
+        requests that come first for their own wait().
+        """
+        while rid not in self.replies:
+            line = self.fid.readline()
+            if not line:
+                raise ConnectionError('the server closed the connection')
+            reply = json.loads(line)
+            self.replies[reply['id']] = reply
+        return self.replies.pop(rid)
+
+    def solve(self, intra, extra, intraXY=(0, 0), extraXY=None, **params):
+        return self.wait(self.submit(intra, extra, intraXY, extraXY,
+                                     **params))
+
+    def status(self):
+        return self.wait(self._send(dict(op='status')))
+
+    def close(self):
+        self.fid.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+async def _serve(server, path, port):
+    await server.start(path=path, port=port)
+    try:
+        await server.serveForever()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve wavefront solves to local clients over a Unix '
+        'socket or a TCP port on localhost')
+    parser.add_argument('-socket', dest='path', default=None,
+                        help='Unix socket path to listen on')
+    parser.add_argument('-port', dest='port', type=int, default=0,
+                        help='TCP port on localhost to listen on, when no '
+                        'socket is given. Default 0, any free port.')
+    parser.add_argument('-i', '--instrument', dest='instruFile',
+                        default='mmto',
+                        help='instrument parameter file. Default "mmto".')
+    parser.add_argument('-a', '--algorithm', dest='algoFile',
+                        default='exp',
+                        help='algorithm parameter file. Default "exp".')
+    parser.add_argument('-m', '--model', dest='model',
+                        choices=('paraxial', 'onAxis', 'offAxis'),
+                        default='onAxis',
+                        help='optical model. Default "onAxis".')
+    parser.add_argument('-workers', dest='maxWorkers', type=int,
+                        default=None,
+                        help='number of solver processes. Default all '
+                        'cores.')
+    parser.add_argument('-queue', dest='maxQueue', type=int, default=64,
+                        help='most solves waiting for a solver. '
+                        'Default 64.')
+    parser.add_argument('-timing', dest='timing', action='store_true',
+                        help='add per-stage timings to the replies')
+    parser.add_argument('-size', dest='sensorSamples', type=int,
+                        default=None,
+                        help='stamp size in pixels the solver processes '
+                        'get ready for when they start')
+    parser.add_argument('-d', '--debug', dest='debugLevel', type=int,
+                        default=0, choices=(-1, 0, 1, 2, 3),
+                        help='debug level, -1=quiet, 0=Zernikes, '
+                        '1=operator, 2=expert, 3=everything, default=0')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(name)s - %(levelname)s - %(message)s')
+
+    server = SolveServer(args.instruFile, args.algoFile, args.model,
+                         maxWorkers=args.maxWorkers, maxQueue=args.maxQueue,
+                         debugLevel=args.debugLevel, timing=args.timing,
+                         sensorSamples=args.sensorSamples)
+    try:
+        asyncio.run(_serve(server, args.path, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
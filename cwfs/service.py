@@ -0,0 +1,363 @@
+# @package cwfs
+# @file service.py
+##
+# @       Long-running solver of the donut pairs arriving in a directory
+
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+
+from .image import readCutout
+from .runner import ParallelRunner, _failedRecord, checkInstParams
+
+log = logging.getLogger('cwfs.service')
+
+Frame = namedtuple('Frame', ('name', 'stamp', 'header'))
+Pair = namedtuple('Pair', ('intra', 'extra', 'focoff', 'rot'))
+
+
+class DirectoryWatcher(object):
+
+    def __init__(self, directory, pattern='*.fits', skipExisting=True):
+        """!Poll a directory for new files
+
+        @param directory     the directory to watch
+        @param pattern       glob pattern of the file names wanted
+        @param skipExisting  ignore the files already there
+
+        A file is only handed out once its size and modification time are
+        the same in two polls in a row, so files still being written are
+        left alone.  Each file is handed out once.
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.seen = set()
+        self.sizes = {}
+        if skipExisting:
+            self.seen.update(self._scan())
+
+    def _scan(self):
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if (entry.name in self.seen or not entry.is_file() or
+                        not fnmatch.fnmatch(entry.name, self.pattern)):
+                    continue
+                st = entry.stat()
+                files[entry.name] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def poll(self, limit=None):
+        """
+        Return the paths of up to limit new, complete files, oldest first.
+        The files beyond the limit are left for later polls.
+        """
+        files = self._scan()
+        ready = sorted((files[name][1], name) for name in files
+                       if self.sizes.get(name) == files[name])
+        if limit is not None:
+            ready = ready[:max(limit, 0)]
+        for _, name in ready:
+            self.seen.add(name)
+            del files[name]
+        self.sizes = files
+        return [os.path.join(self.directory, name) for _, name in ready]
+
+
+class FramePairer(object):
+
+    def __init__(self, focoff=1000.0):
+        """!Pair intra and extra focal frames as they arrive
+
+        @param focoff  M2 focus offset (um) assumed when the headers of a
+                       pair have no FOCUS
+        """
+        self.focoff = focoff
+        self.pending = None
+
+    def add(self, frame):
+        """
+        Add a Frame and return the Pair it completes, or None.
+
+        As in bino_cwfs, the frame with the lower header FOCUS is the intra
+        focal one and the focus offset is half the FOCUS difference;
+        without FOCUS in both headers the first frame is the intra one.
+        A frame with the same FOCUS as the waiting one replaces it.  rot is
+        the mean ROT of the pair, 0 if neither header has one.
+        """
+        pending, self.pending = self.pending, frame
+        if pending is None:
+            return None
+
+        frames = [pending, frame]
+        focus = [f.header.get('FOCUS') for f in frames]
+        if (None not in focus):
+            if (focus[0] == focus[1]):
+                log.warning('%s has the same FOCUS as %s, dropping %s',
+                            frame.name, pending.name, pending.name)
+                return None
+            intra, extra = np.argmin(focus), np.argmax(focus)
+            focoff = max(focus) - np.mean(focus)
+        else:
+            intra, extra = 0, 1
+            focoff = self.focoff
+        rots = [f.header['ROT'] for f in frames if 'ROT' in f.header]
+        rot = np.mean(rots) if len(rots) > 0 else 0.0
+
+        self.pending = None
+        return Pair(frames[intra], frames[extra], float(focoff), float(rot))
+
+
+class WatchService(object):
+
+    def __init__(self, directory, instruFile, algoFile, model,
+                 pattern='*.fits', recipe=None, intraXY=(0, 0),
+                 extraXY=(0, 0), focoff=1000.0, focusScale=None,
+                 instParams=None, pollInterval=1.0, maxPending=4,
+                 maxWorkers=None, skipExisting=True, debugLevel=0,
+                 timing=False):
+        """!Solve the donut pairs written to a directory as they arrive
+
+        @param directory     the directory to watch
+        @param instruFile    instrument name, as for Instrument
+        @param algoFile      algorithm name, as for Algorithm
+        @param model         optical model, 'paraxial', 'onAxis' or
+                             'offAxis'
+        @param pattern       glob pattern of the image file names
+        @param recipe        trim recipe of readCutout, e.g. 'binospec'
+        @param intraXY       field position of the intra images (deg)
+        @param extraXY       field position of the extra images (deg)
+        @param focoff        M2 focus offset (um) of pairs without FOCUS
+        @param focusScale    if given, the instrument offset of a pair is
+                             focoff * 1e-6 * focusScale, as bino_cwfs does
+                             with 18.8 for the MMT
+        @param instParams    dict of Instrument attributes set for every
+                             pair, e.g. {'obscuration': 0.01}; see
+                             runner.checkInstParams()
+        @param pollInterval  seconds between polls of the directory
+        @param maxPending    most pairs queued or being solved at once;
+                             while that many are, no new files are read,
+                             so a burst waits on disk
+        @param maxWorkers    number of solver processes, default all cores
+        @param skipExisting  ignore the files already in the directory
+        @param debugLevel    passed on to Algorithm
+        @param timing        add the per-stage timings to the records
+
+        The solver processes are started with the first pair, and get
+        ready for its stamp size, once; they stay up until close().
+        """
+        self.intraXY = tuple(intraXY)
+        self.extraXY = tuple(extraXY)
+        self.recipe = recipe
+        self.focusScale = focusScale
+        self.instParams = checkInstParams(instParams)
+        self.pollInterval = pollInterval
+        self.maxPending = maxPending
+        self.watcher = DirectoryWatcher(directory, pattern, skipExisting)
+        self.pairer = FramePairer(focoff)
+        self.runner = ParallelRunner(instruFile, algoFile, model,
+                                     maxWorkers=maxWorkers,
+                                     debugLevel=debugLevel, timing=timing)
+        self.inflight = {}
+        self.nPairs = 0
+        self.stopped = False
+
+    def _intake(self):
+        # read new frames only while there is room in the queue; a pair
+        # takes two frames, one of which may be waiting already
+        room = self.maxPending - len(self.inflight)
+        if (room <= 0):
+            return
+        limit = 2 * room - (self.pairer.pending is not None)
+        for path in self.watcher.poll(limit):
+            try:
+                stamp, header = readCutout(path, recipe=self.recipe)
+            except Exception as e:
+                log.warning('skipping %s: %s: %s', path,
+                            type(e).__name__, e)
+                continue
+            pair = self.pairer.add(Frame(os.path.basename(path), stamp,
+                                         header))
+            if pair is not None:
+                self._submit(pair)
+
+    def _submit(self, pair):
+        instParams = dict(self.instParams)
+        if self.focusScale is not None:
+            instParams['offset'] = pair.focoff * 1.0e-6 * self.focusScale
+        future = self.runner.submit(
+            self.nPairs, pair.intra.stamp, pair.extra.stamp, self.intraXY,
+            self.extraXY, instParams=instParams)
+        self.inflight[future] = (self.nPairs, pair)
+        log.info('pair %d: %s (intra), %s (extra)', self.nPairs,
+                 pair.intra.name, pair.extra.name)
+        self.nPairs += 1
+
+    def _record(self, future):
+        index, pair = self.inflight.pop(future)
+        try:
+            record = future.result()
+        except Exception as e:
+            record = _failedRecord(index, e)
+        record.update(intraName=pair.intra.name, extraName=pair.extra.name,
+                      focoff=pair.focoff, rot=pair.rot)
+        if record['result'] is not None:
+            record['result'] = record['result']._replace(
+                intraName=pair.intra.name, extraName=pair.extra.name)
+        return record
+
+    def run(self, maxResults=None):
+        """
+        Watch the directory and yield a result record (see
+        runner.solvePair) for every pair, in the order they are solved.
+        The records also have the intraName and extraName of the pair, its
+        focoff and rot (see FramePairer.add).  Runs until stop() is called
+        or maxResults records have been yielded.
+        """
+        nResults = 0
+        while (not self.stopped and
+               (maxResults is None or nResults < maxResults)):
+            self._intake()
+            if len(self.inflight) == 0:
+                time.sleep(self.pollInterval)
+                continue
+            done, _ = wait(self.inflight, timeout=self.pollInterval,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                yield self._record(future)
+                nResults += 1
+
+    def stop(self):
+        self.stopped = True
+
+    @property
+    def queueDepth(self):
+        return len(self.inflight)
+
+    def close(self):
+        self.runner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _jsonRecord(record):
+    zer = record['zer4UpNm']
+    return json.dumps(dict(
+        index=record['index'], intraName=record['intraName'],
+        extraName=record['extraName'], focoff=record['focoff'],
+        rot=record['rot'], caustic=record['caustic'],
+        zer4UpNm=None if zer is None else [float(z) for z in zer],
+        error=record['error'], timing=record['timing']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Watch a directory for intra/extra focal images and '
+        'write the Zernikes of every pair as a JSON line as it is solved')
+    parser.add_argument('directory', help='directory to watch')
+    parser.add_argument('-pattern', dest='pattern', default='*.fits',
+                        help='glob pattern of the image files. '
+                        'Default "*.fits".')
+    parser.add_argument('-recipe', dest='recipe', default='binospec',
+                        help='trim recipe for the frames, "none" to read '
+                        'them whole. Default "binospec".')
+    parser.add_argument('-focoff', dest='focoff', type=float,
+                        default=1000.0,
+                        help='M2 focus offset in microns of pairs without '
+                        'FOCUS in the headers. Default 1000.0 um.')
+    parser.add_argument('-focscale', dest='focusScale', type=float,
+                        default=18.8,
+                        help='instrument offset per M2 focus offset, '
+                        '0 to keep the offset of the instrument file. '
+                        'Default 18.8.')
+    parser.add_argument('-obscuration', dest='obscuration', type=float,
+                        default=0.01,
+                        help='obscuration used for the solves, negative '
+                        'to keep the one of the instrument file. '
+                        'Default 0.01.')
+    parser.add_argument('-ixy', dest='intra_xy', nargs=2, type=float,
+                        default=[0, 0],
+                        help='intra focal field (x,y) in deg. '
+                        'Default [0 0].')
+    parser.add_argument('-exy', dest='extra_xy', nargs=2, type=float,
+                        default=[0, 0],
+                        help='extra focal field (x,y) in deg. '
+                        'Default [0 0].')
+    parser.add_argument('-i', '--instrument', dest='instruFile',
+                        default='mmto',
+                        help='instrument parameter file. Default "mmto".')
+    parser.add_argument('-a', '--algorithm', dest='algoFile',
+                        default='exp',
+                        help='algorithm parameter file. Default "exp".')
+    parser.add_argument('-m', '--model', dest='model',
+                        choices=('paraxial', 'onAxis', 'offAxis'),
+                        default='onAxis',
+                        help='optical model. Default "onAxis".')
+    parser.add_argument('-interval', dest='pollInterval', type=float,
+                        default=1.0,
+                        help='seconds between polls. Default 1.0.')
+    parser.add_argument('-pending', dest='maxPending', type=int, default=4,
+                        help='most pairs queued or being solved at once. '
+                        'Default 4.')
+    parser.add_argument('-workers', dest='maxWorkers', type=int,
+                        default=None,
+                        help='number of solver processes. Default all '
+                        'cores.')
+    parser.add_argument('-all', dest='skipExisting', action='store_false',
+                        help='also solve the images already there')
+    parser.add_argument('-o', '--output', dest='output', default='-',
+                        help='file the JSON lines are appended to, "-" '
+                        'for stdout. Default "-".')
+    parser.add_argument('-d', '--debug', dest='debugLevel', type=int,
+                        default=0, choices=(-1, 0, 1, 2, 3),
+                        help='debug level, -1=quiet, 0=Zernikes, '
+                        '1=operator, 2=expert, 3=everything, default=0')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(name)s - %(levelname)s - %(message)s')
+
+    instParams = {}
+    if (args.obscuration >= 0):
+        instParams['obscuration'] = args.obscuration
+    service = WatchService(
+        args.directory, args.instruFile, args.algoFile, args.model,
+        pattern=args.pattern,
+        recipe=None if args.recipe == 'none' else args.recipe,
+        intraXY=args.intra_xy, extraXY=args.extra_xy, focoff=args.focoff,
+        focusScale=args.focusScale or None, instParams=instParams,
+        pollInterval=args.pollInterval, maxPending=args.maxPending,
+        maxWorkers=args.maxWorkers, skipExisting=args.skipExisting,
+        debugLevel=args.debugLevel)
+
+    fid = sys.stdout if args.output == '-' else open(args.output, 'a')
+    try:
+        with service:
+            for record in service.run():
+                if record['error'] is not None:
+                    log.error('pair %d (%s, %s) failed: %s', record['index'],
+                              record['intraName'], record['extraName'],
+                              record['error'])
+                fid.write(_jsonRecord(record) + '\n')
+                fid.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if fid is not sys.stdout:
+            fid.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+
+from ..instrument import Instrument
+from ..algorithm import Algorithm, runBatch, solveLeastSquares
+from ..image import Image, readFile, getMaskCache
+from ..tools import getDataDir, getZernikeBasisCache
+
+
+def load_pair(imgDir, filenameFmt):
+    imgDir = os.path.join(getDataDir(), 'testImages', imgDir)
+    intra = readFile(os.path.join(imgDir, filenameFmt % "intra"))
+    extra = readFile(os.path.join(imgDir, filenameFmt % "extra"))
+    return intra, extra
+
+
+def test_run_batch():
+    """
+    Test that a batch solve gives the same answer as solving pair by pair
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    intra0 = intra.copy()
+    inst = Instrument('lsst', intra.shape[0])
+
+    I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+    I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+    algo = Algorithm('exp', inst, 0)
+    algo.runIt(inst, I1, I2, 'onAxis')
+
+    # second pair is the first one seen through the other side of focus
+    zer, errors = runBatch(inst, 'exp', [intra, np.rot90(extra, 2)],
+                           [extra, np.rot90(intra, 2)], (0, 0), 'onAxis')
+    assert zer.shape == (2, algo.numTerms - 3)
+    assert errors == [None, None]
+    np.testing.assert_allclose(zer[0], algo.zer4UpNm, atol=1e-6)
+    np.testing.assert_allclose(zer[1], -zer[0], atol=0.1)
+    np.testing.assert_array_equal(intra, intra0)
+
+    # a blank stamp fails on its own, the other pair is still solved
+    zer, errors = runBatch(inst, 'exp', [np.zeros_like(intra), intra],
+                           [extra, extra], (0, 0), 'onAxis')
+    assert errors[0].startswith('ValueError') and errors[1] is None
+    assert np.isnan(zer[0]).all()
+    np.testing.assert_allclose(zer[1], algo.zer4UpNm, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        runBatch(inst, 'exp', [intra], [extra[:-2, :-2]], (0, 0), 'onAxis')
+
+
+@pytest.mark.parametrize('solver', ['fft', 'exp'])
+def test_solve_least_squares(solver):
+    """
+    Test that the least-squares steps of several solves, stacked, give the
+    same answer as one by one, and so does a batch solved in lockstep
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    algos = []
+    for a, b in ((intra, extra), (np.rot90(extra, 2), np.rot90(intra, 2))):
+        I1 = Image(a.copy(), (0, 0), Image.INTRA)
+        I2 = Image(b.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm(solver, inst, 0)
+        # itr0 leaves the masked, normalized stamps ready to solve
+        algo.itr0(inst, I1, I2, 'onAxis')
+        algo.startPoissonEq(inst, I1, I2, 1)
+        algos.append(algo)
+    for algo, solution in zip(algos, solveLeastSquares(algos)):
+        single = solveLeastSquares([algo])[0]
+        np.testing.assert_allclose(solution, single, rtol=1e-10,
+                                   atol=1e-12 * np.abs(single).max())
+
+    algo = Algorithm(solver, inst, 0)
+    algo.runIt(inst, Image(intra.copy(), (0, 0), Image.INTRA),
+               Image(extra.copy(), (0, 0), Image.EXTRA), 'onAxis')
+    zer, errors = runBatch(inst, solver, [intra, intra], [extra, extra],
+                           (0, 0), 'onAxis')
+    assert errors == [None, None]
+    np.testing.assert_allclose(zer, [algo.zer4UpNm] * 2, atol=1e-6)
+
+
+def test_early_termination():
+    """
+    Test that runIt stops once converged, but not before the whole
+    compensation sequence is on
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+
+    zer = {}
+    for tol in (None, 1.0, 1e6):
+        I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+        I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm('exp', inst, 0)
+        algo.setConvergence(tol)
+        algo.runIt(inst, I1, I2, 'onAxis')
+        zer[tol] = algo.zer4UpNm
+        if tol is None:
+            assert algo.stopReason == 'outerItr'
+            assert algo.stopItr == algo.outerItr
+        else:
+            assert algo.stopReason == 'converged'
+            assert algo.fullCompItr() < algo.stopItr < algo.outerItr
+
+    # a huge tolerance still waits for the compensation sequence
+    assert algo.stopItr == algo.fullCompItr() + 1
+    np.testing.assert_allclose(zer[1.0], zer[None], atol=1)
+
+    with pytest.raises(ValueError):
+        algo.setConvergence(1, mode='pct')
+
+
+def test_warm_start():
+    """
+    Test that a solve started from a prior solution needs fewer iterations
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+
+    I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+    I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+    cold = Algorithm('exp', inst, 0)
+    cold.runIt(inst, I1, I2, 'onAxis')
+    z0 = cold.converge[:, cold.stopItr]
+
+    # a 30nm error in z8 is worked off in a few iterations
+    zPrior = z0.copy()
+    zPrior[7] += 30e-9
+    I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+    I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+    warm = Algorithm('exp', inst, 0)
+    warm.runIt(inst, I1, I2, 'onAxis', z0=zPrior, warmItr=4)
+    assert warm.stopItr == 4
+    np.testing.assert_allclose(warm.zer4UpNm, cold.zer4UpNm, atol=2)
+
+    zer, errors = runBatch(inst, 'exp', [intra, intra], [extra, extra],
+                           (0, 0), 'onAxis', z0=zPrior, chain=True)
+    np.testing.assert_allclose(zer[0], warm.zer4UpNm, atol=1e-6)
+    np.testing.assert_allclose(zer[1], cold.zer4UpNm, atol=1)
+
+    with pytest.raises(ValueError):
+        warm.setWarmStart(z0[:10])
+
+
+def test_exp_tiles():
+    """
+    Test that the low-memory exp solver streams over tiles without caching
+    the bases, and gets the same answer
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    cache = getZernikeBasisCache()
+
+    zer = {}
+    for tileSize in (0, 1000):
+        cache.clear()
+        I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+        I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm('exp', inst, 0)
+        algo.expTileSize = tileSize
+        algo.runIt(inst, I1, I2, 'onAxis')
+        zer[tileSize] = algo.zer4UpNm
+        cacheBytes = cache.nbytes
+        if tileSize == 0:
+            fullBytes = cacheBytes
+
+    np.testing.assert_allclose(zer[1000], zer[0], atol=1e-6)
+    # only the compensator's bases are left in the cache
+    assert cacheBytes < fullBytes
+
+
+def test_increase_resolution():
+    """
+    Test a solve at twice the sensor resolution, with an oversampled
+    compensator
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+
+    zer = []
+    for factor in (1, 2, 1):
+        I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+        I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm('fft', inst, 0)
+        algo.upReso = factor
+        algo.compOversample = factor
+        algo.runIt(inst, I1, I2, 'onAxis')
+        zer.append(algo.zer4UpNm)
+        assert algo.caustic == 0
+        if factor == 2:
+            size = algo.itrInst.sensorSamples
+            assert I1.image.shape == (size, size)
+
+    # the solve was on a resampled copy of the instrument; the next pair
+    # gets the original geometry
+    assert size == 2 * intra.shape[0]
+    assert inst.sensorSamples == intra.shape[0]
+    np.testing.assert_array_equal(zer[2], zer[0])
+    # the finer grid mostly changes z7 and z9; pin the difference it makes
+    diff = [1.25, -0.38, -2.42, -35.77, -0.24, -11.44, -0.29, -0.54, 0.21,
+            0.12, -4.23, 0.49, 0.08, 9.16, -0., 4.49, -0.48, 5.1, -0.13]
+    np.testing.assert_allclose(zer[1] - zer[0], diff, atol=0.5)
+
+
+def test_mask_cache():
+    """
+    Test that images at the same field position share read-only masks,
+    equal to the ones built from scratch
+    """
+    intra, extra = load_pair('LSST_NE_SN25', 'z11_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    cache = getMaskCache()
+    cache.clear()
+
+    masks = []
+    for image in (intra, extra):
+        img = Image(image.copy(), (1.185, 1.185), Image.INTRA)
+        img.getMasks(inst, 'offAxis', 1, 1, 128)
+        masks.append(img)
+    assert len(cache) == 1
+    assert masks[1].pMask is masks[0].pMask
+    assert masks[0].pMask.dtype == bool
+    assert not masks[0].cMaskPad.flags.writeable
+
+    img.makeMaskList(inst, 'offAxis')
+    img.makeMask(inst, 1, 1)
+    np.testing.assert_array_equal(masks[0].pMask, img.pMask)
+    np.testing.assert_array_equal(masks[0].cMask, img.cMask)
+    assert masks[0].cMaskPad.sum() == masks[0].cMask.sum()
+
+    # a different position gets its own masks
+    img = Image(intra.copy(), (1.185, 1.0), Image.INTRA)
+    img.getMasks(inst, 'offAxis', 1, 1, 128)
+    assert len(cache) == 2
+
+
+def test_stage_timing():
+    """
+    Test that a timed solve records every stage, and that timing is off by
+    default
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+
+    for name in ('fft', 'exp'):
+        I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+        I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+        algo = Algorithm(name, inst, 0)
+        algo.setTiming()
+        algo.runIt(inst, I1, I2, 'onAxis')
+        timing = algo.timer.asDict()
+        nSolves = algo.stopItr + 1
+
+        signal = 'createSignal' if name == 'fft' else 'getdIandI'
+        for stage in ('masks', 'coCenter', 'compensateIntra',
+                      'compensateExtra', signal, 'zernikeFit',
+                      'solvePoissonEq', 'runIt'):
+            assert timing['stages'][stage]['seconds'] > 0
+        assert timing['stages']['solvePoissonEq']['calls'] == nSolves
+        assert len(timing['series']['outerItr']) == nSolves
+        if name == 'fft':
+            assert len(timing['series']['innerItr']) == \
+                nSolves * algo.innerItr
+        assert timing['counts']['solves'] == nSolves
+        assert timing['counts']['causticImages'] == 0
+
+        fid = io.StringIO()
+        algo.timer.writeJSONLine(fid, solver=name)
+        line = json.loads(fid.getvalue())
+        assert line['solver'] == name
+        assert line['counts'] == timing['counts']
+
+    I1 = Image(intra.copy(), (0, 0), Image.INTRA)
+    I2 = Image(extra.copy(), (0, 0), Image.EXTRA)
+    algo = Algorithm('exp', inst, 0)
+    algo.runIt(inst, I1, I2, 'onAxis')
+    assert algo.timer.asDict() == dict(stages={}, series={}, counts={})
+
+
+def test_pair_threads():
+    """
+    Test that working on the intra and extra images on two threads gives
+    the same answer
+    """
+    intra, extra = load_pair('LSST_NE_SN25', 'z11_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+
+    for name in ('fft', 'exp'):
+        zer = {}
+        for threads in (False, True):
+            I1 = Image(intra.copy(), (1.185, 1.185), Image.INTRA)
+            I2 = Image(extra.copy(), (1.185, 1.185), Image.EXTRA)
+            algo = Algorithm(name, inst, 0)
+            algo.setPairThreads(threads)
+            algo.runIt(inst, I1, I2, 'offAxis')
+            zer[threads] = algo.zer4UpNm
+        np.testing.assert_array_equal(zer[True], zer[False])
+
+
+def test_offaxis_basis_cache():
+    """
+    Test that the offAxis compensator, whose grids move with the field,
+    doesn't fill the Zernike basis cache, and that the exp solver keeps one
+    set of bases per grid whatever the number of terms compensated
+    """
+    intra, extra = load_pair('LSST_NE_SN25', 'z11_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    cache = getZernikeBasisCache()
+
+    for name, perField in (('fft', 0), ('exp', 4)):
+        cache.clear()
+        sizes = []
+        for field in (1.185, 1.19):
+            I1 = Image(intra.copy(), (field, field), Image.INTRA)
+            I2 = Image(extra.copy(), (field, field), Image.EXTRA)
+            algo = Algorithm(name, inst, 0)
+            algo.runIt(inst, I1, I2, 'offAxis')
+            sizes.append(len(cache))
+        # only the solver's own grids, which follow the masks
+        assert sizes[1] - sizes[0] == perField
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndimage
+from astropy.io import fits
+from scipy.signal import correlate
+
+from ..image import Image, closeProjection, readCutout, windowCorrelation
+
+
+def test_window_correlation():
+    """
+    Test that the windowed correlation matches the central window of the
+    full one
+    """
+    rng = np.random.default_rng(0)
+    for m, n, r in ((120, 120, 10), (121, 117, 10), (64, 80, 5)):
+        image = rng.random((m, m + 2))
+        template = rng.random((n, n - 3))
+        full = correlate(image, template, mode='same')
+        c0, c1 = m // 2, (m + 2) // 2
+        np.testing.assert_allclose(
+            windowCorrelation(image, template, r),
+            full[c0 - r:c0 + r, c1 - r:c1 + r], rtol=1e-12)
+
+
+def test_close_projection():
+    """
+    Test that the decomposed closing matches the one with the 9x9 octagon
+    """
+    cross = ndimage.generate_binary_structure(2, 1)
+    struct = ndimage.iterate_structure(cross, 4)
+    struct = ndimage.binary_dilation(struct, structure=cross)
+    struct = ndimage.binary_dilation(struct, structure=cross)
+
+    rng = np.random.default_rng(0)
+    for level in (0.5, 0.8, 0.95):
+        mask = rng.random((100, 100)) > level
+        closed = ndimage.binary_erosion(
+            ndimage.binary_dilation(mask, structure=struct), structure=struct)
+        np.testing.assert_array_equal(closeProjection(mask), closed)
+
+
+def test_read_cutout(tmp_path):
+    """
+    Test that stamps are cut out of (scaled, multi-extension) frames
+    without touching the file
+    """
+    frame = np.random.default_rng(0).integers(
+        0, 60000, (516, 532)).astype(np.uint16)
+    header = fits.Header([('FOCUS', 1000.)])
+    filename = str(tmp_path / 'sog.fits')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(frame, header)]).writeto(filename)
+    with open(filename, 'rb') as fid:
+        before = fid.read()
+
+    stamp, hdr = readCutout(filename, recipe='binospec')
+    np.testing.assert_array_equal(
+        stamp, np.flipud(frame[131:387, 167:423]).astype(float))
+    assert hdr['FOCUS'] == 1000.
+
+    stamp, _ = readCutout(filename, box=(10, 30, 20, 40), ext=1)
+    np.testing.assert_array_equal(stamp, frame[10:30, 20:40])
+
+    img = Image.fromFits(filename, (0, 0), Image.INTRA, recipe='binospec')
+    assert img.sizeinPix == 256
+    assert img.name == filename
+
+    with pytest.raises(ValueError):
+        readCutout(filename, box=(500, 600, 0, 10), ext=1)
+    with pytest.raises(ValueError):
+        readCutout(filename, recipe='sog')
+
+    with open(filename, 'rb') as fid:
+        assert fid.read() == before
+
+    # a multi-extension frame is trimmed whatever its shape, a single
+    # extension one only if it has the raw shape
+    frame = frame[:, :520]
+    for hdus, shape in (([fits.PrimaryHDU(), fits.ImageHDU(frame)],
+                         (256, 256)),
+                        ([fits.PrimaryHDU(frame)], frame.shape)):
+        filename = str(tmp_path / ('sog%d.fits' % len(hdus)))
+        fits.HDUList(hdus).writeto(filename)
+        stamp, _ = readCutout(filename, recipe='binospec')
+        assert stamp.shape == shape
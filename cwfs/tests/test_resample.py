@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from ..resample import upsample, downsample
+
+
+def test_round_trip():
+    """
+    Test that downsampling an upsampled image gives the image back
+    """
+    image = np.arange(12, dtype=np.float32).reshape(3, 4)
+    up = upsample(image, 3)
+    assert up.shape == (9, 12)
+    np.testing.assert_array_equal(up[3:6, 6:9], image[1, 2])
+    down = downsample(up, 3)
+    assert down.dtype == np.float32
+    np.testing.assert_array_equal(down, image)
+
+    with pytest.raises(ValueError):
+        downsample(up, 2)
+    with pytest.raises(ValueError):
+        upsample(image, 1.5)
+
+
+def test_downsample_nan():
+    """
+    Test that NaNs are left out of the block means
+    """
+    image = np.array([[1, np.nan, np.nan, np.nan],
+                      [3, 2, np.nan, np.nan]])
+    np.testing.assert_array_equal(downsample(image, 2), [[2, np.nan]])
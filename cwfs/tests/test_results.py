@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from ..instrument import Instrument
+from ..algorithm import Algorithm
+from ..image import Image
+from ..results import SolveResult, ResultWriter, readResults
+from .test_algorithm import load_pair
+
+
+def solve(name='exp'):
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    I1 = Image(intra, (0, 0), Image.INTRA)
+    I2 = Image(extra, (0, 0), Image.EXTRA)
+    algo = Algorithm(name, inst, 0)
+    algo.setTiming()
+    algo.runIt(inst, I1, I2, 'onAxis')
+    return algo, inst, I1, I2
+
+
+def test_solve_result():
+    """
+    Test that a result is a read-only snapshot of the solve
+    """
+    algo, inst, I1, I2 = solve()
+    result = SolveResult.fromAlgorithm(algo, inst, I1, I2, 'onAxis', 3,
+                                       'intra.txt', 'extra.txt')
+    np.testing.assert_array_equal(result.zer4UpNm, algo.zer4UpNm)
+    assert result.stopReason == algo.stopReason
+    assert result.timing['counts']['solves'] == algo.stopItr + 1
+    assert result.provenance.algorithmParams == algo.params
+    assert result.geometry['offset'] == inst.offset
+    assert result.geometry['sensorSamples'] == inst.sensorSamples
+    assert result.Wconverge is None
+    with pytest.raises(AttributeError):
+        result.caustic = 1
+    with pytest.raises(ValueError):
+        result.zer4UpNm[0] = 0
+    algo.zer4UpNm[0] += 1
+    assert result.zer4UpNm[0] != algo.zer4UpNm[0]
+
+
+@pytest.mark.parametrize('ext', ['npz', 'fits'])
+def test_result_writer(tmp_path, ext):
+    """
+    Test that results written in batches, and appended to an existing
+    file, read back as one table
+    """
+    algo, inst, I1, I2 = solve()
+    result = SolveResult.fromAlgorithm(algo, inst, I1, I2, 'onAxis')
+    # a warm-started solve has a shorter convergence history
+    results = [result._replace(index=k, intraName='i%d' % k)
+               for k in range(5)]
+    results[3] = results[3]._replace(converge=result.converge[:, :5])
+
+    filename = str(tmp_path / ('night.' + ext))
+    with ResultWriter(filename, batchSize=2) as writer:
+        writer.extend(results[:3])
+    with ResultWriter(filename, batchSize=2) as writer:
+        assert writer.nBatches == 2
+        writer.extend(results[3:])
+
+    table = readResults(filename)
+    np.testing.assert_array_equal(table['index'], np.arange(5))
+    assert list(table['intraName']) == ['i%d' % k for k in range(5)]
+    np.testing.assert_array_equal(table['zer4UpNm'][4], result.zer4UpNm)
+    assert table['converge'].shape == (5,) + result.converge.shape
+    np.testing.assert_array_equal(table['converge'][3, :, 5:], 0)
+    assert table['stopReason'][0] == result.stopReason
+    assert table['timing'][1] == result.timing
+    assert table['provenance'] == result.provenance
+
+    other = result._replace(provenance=result.provenance._replace(
+        model='offAxis'))
+    with pytest.raises(ValueError):
+        ResultWriter(filename).append(other)
+
+
+def test_result_writer_geometry(tmp_path):
+    """
+    Test that pairs solved with different offsets go to one file, each with
+    its own geometry
+    """
+    algo, inst, I1, I2 = solve()
+    first = SolveResult.fromAlgorithm(algo, inst, I1, I2, 'onAxis', 0)
+    inst.offset *= 1.1
+    second = SolveResult.fromAlgorithm(algo, inst, I1, I2, 'onAxis', 1)
+    assert second.provenance == first.provenance
+
+    filename = str(tmp_path / 'night.fits')
+    with ResultWriter(filename) as writer:
+        writer.extend([first, second])
+    table = readResults(filename)
+    np.testing.assert_allclose(table['offset'], [first.geometry['offset'],
+                                                 second.geometry['offset']])
+    np.testing.assert_array_equal(table['sensorSamples'],
+                                  inst.sensorSamples)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from ..algorithm import runBatch
+from ..errors import oddNumPixError
+from ..image import Image, getMaskCache
+from ..instrument import Instrument
+from ..runner import (ParallelRunner, _getInstrument, _initWorker,
+                      checkInstParams, getInstrument, solvePair)
+from ..tools import getZernikeBasisCache
+from .test_algorithm import load_pair
+
+
+def test_parallel_runner():
+    """
+    Test that a bad pair becomes an error record and the others are solved
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    zer = runBatch(inst, 'exp', intra, extra, (0, 0), 'onAxis')[0][0]
+
+    pairs = [(intra, extra, (0, 0)),
+             (intra[:-1, :-1], extra[:-1, :-1], (0, 0)),
+             (intra, extra[:-2, :-2], (0, 0), (0, 0))]
+    with ParallelRunner('lsst', 'exp', 'onAxis', maxWorkers=2) as runner:
+        records = sorted(runner.run(pairs), key=lambda r: r['index'])
+
+    assert [r['index'] for r in records] == [0, 1, 2]
+    assert records[0]['error'] is None
+    np.testing.assert_allclose(records[0]['zer4UpNm'], zer, atol=1e-6)
+    assert records[1]['error'].startswith('oddNumPixError')
+    assert records[2]['error'].startswith('imageDiffSizeError')
+    for r in records[1:]:
+        assert r['zer4UpNm'] is None
+        assert r['traceback']
+
+    with pytest.raises(oddNumPixError):
+        Image(intra[:-1, :-1], (0, 0), Image.INTRA)
+
+
+def test_init_worker(caplog):
+    """
+    Test that a worker gets the instrument, masks and Zernike bases of the
+    stamp size ready, and that a bad configuration is logged
+    """
+    masks = len(getMaskCache())
+    bases = len(getZernikeBasisCache())
+    _initWorker('lsst', 'exp', 'onAxis', 96, np.float64)
+    assert _getInstrument.cache_info().currsize > 0
+    assert getInstrument('lsst', 96).sensorSamples == 96
+    assert len(getMaskCache()) > masks
+    assert len(getZernikeBasisCache()) > bases
+
+    _initWorker('lsst', 'nonexistent', 'onAxis', 96, np.float64)
+    assert 'warming up' in caplog.text
+
+
+def test_inst_params():
+    """
+    Test that instParams may only set the instrument geometry
+    """
+    assert checkInstParams(None) == {}
+    assert checkInstParams({'offset': '1e-3'}) == {'offset': 1e-3}
+    for bad in ({'filename': 'x'}, {'setSensorSamples': 0},
+                {'offset': 'far'}, {'offset': float('nan')}, ['offset']):
+        with pytest.raises(ValueError):
+            checkInstParams(bad)
+
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    record = solvePair(0, intra, extra, (0, 0), (0, 0), 'lsst', 'exp',
+                       'onAxis', instParams={'params': ()})
+    assert record['error'].startswith('ValueError')
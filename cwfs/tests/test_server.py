@@ -0,0 +1,57 @@
+import asyncio
+
+import numpy as np
+
+from ..algorithm import runBatch
+from ..instrument import Instrument
+from ..server import SolveClient, SolveServer, decodeArray, encodeArray
+from .test_algorithm import load_pair
+
+
+def test_solve_server(tmp_path):
+    """
+    Test that concurrent solves over the socket match a local solve, and
+    that a queued solve can be cancelled
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    zer = runBatch(inst, 'exp', intra, extra, (0, 0), 'onAxis')[0][0]
+    np.testing.assert_array_equal(decodeArray(encodeArray(intra)), intra)
+
+    path = str(tmp_path / 'cwfs.sock')
+
+    def client():
+        with SolveClient(path, timeout=60) as c:
+            first = c.submit(intra, extra)
+            second = c.submit(intra, extra, (0, 0), (0, 0))
+            bad = c.submit(intra, extra[:-2, :-2])
+            status = c.status()
+            c.cancel(second)
+            params = c.submit(intra, extra, instParams={'xSensor': 0})
+            return (status, c.wait(first), c.wait(second), c.wait(bad),
+                    c.wait(params), c.status())
+
+    async def scenario():
+        server = SolveServer('lsst', 'exp', 'onAxis', maxWorkers=1)
+        await server.start(path=path)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, client)
+        finally:
+            await server.close()
+
+    status, first, second, bad, params, final = asyncio.run(scenario())
+    # one solve runs at a time, the others wait
+    assert status['queueDepth'] + status['running'] == 3
+    assert status['running'] <= 1
+    assert first['error'] is None
+    np.testing.assert_allclose(first['zer4UpNm'], zer, atol=1e-6)
+    assert first['stopReason'] == 'outerItr'
+    assert second == dict(id=second['id'], cancelled=True)
+    assert bad['error'].startswith('imageDiffSizeError')
+    # only the geometry may be changed, and a request that tries anything
+    # else is never queued
+    assert params['error'].startswith('bad solve request: ValueError')
+    assert 'xSensor' in params['error']
+    assert final['cancelled'] == 1
+    assert final['completed'] == 2
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from ..algorithm import runBatch
+from ..instrument import Instrument
+from ..service import DirectoryWatcher, WatchService
+from .test_algorithm import load_pair
+
+
+def test_watch_service(tmp_path):
+    """
+    Test that frames written to the watched directory are paired by FOCUS,
+    solved, and only read while there is room in the queue
+    """
+    intra, extra = load_pair('LSST_C_SN26', 'z7_0.25_%s.txt')
+    inst = Instrument('lsst', intra.shape[0])
+    zer = runBatch(inst, 'exp', intra, extra, (0, 0), 'onAxis')[0][0]
+
+    fits.PrimaryHDU(np.zeros((4, 4))).writeto(tmp_path / 'old.fits')
+    watcher = DirectoryWatcher(str(tmp_path))
+    # the extra focal frame comes first
+    for name, image, focus in (('a.fits', extra, 500.0),
+                               ('b.fits', intra, -500.0),
+                               ('c.fits', intra, -500.0)):
+        fits.PrimaryHDU(image, fits.Header([('FOCUS', focus),
+                                            ('ROT', 10.0)])).writeto(
+            tmp_path / name)
+    assert watcher.poll() == []
+    assert watcher.poll(2) == [os.path.join(str(tmp_path), name)
+                               for name in ('a.fits', 'b.fits')]
+    assert watcher.poll() == [os.path.join(str(tmp_path), 'c.fits')]
+
+    with WatchService(str(tmp_path), 'lsst', 'exp', 'onAxis',
+                      pollInterval=0.01, maxPending=1, maxWorkers=1,
+                      skipExisting=False) as service:
+        service.watcher.seen.add('old.fits')
+        service.watcher.poll()
+        service._intake()
+        assert service.queueDepth == 1
+        # c.fits is still on disk, unread
+        assert service.pairer.pending is None
+        record = next(service.run(maxResults=1))
+
+    assert record['error'] is None
+    assert (record['intraName'], record['extraName']) == ('b.fits', 'a.fits')
+    assert record['result'].intraName == 'b.fits'
+    assert record['focoff'] == 500.0
+    assert record['rot'] == 10.0
+    np.testing.assert_allclose(record['zer4UpNm'], zer, atol=1e-6)
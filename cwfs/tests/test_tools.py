@@ -0,0 +1,159 @@
+import numpy as np
+
+from .. import tools
+
+
+def test_zernike_basis_cache():
+    """
+    Test the cached Zernike bases against the closed-form evaluators
+    """
+    y, x = np.mgrid[-1:1:64j, -1:1:64j]
+    e = 0.61
+    rng = np.random.default_rng(1234)
+    Z = rng.standard_normal(22)
+
+    cache = tools.getZernikeBasisCache()
+    cache.clear()
+
+    np.testing.assert_allclose(
+        tools.ZernikeAnnularBasisEval(Z, x, y, e),
+        tools.ZernikeAnnularEval(Z, x, y, e), atol=1e-12)
+    for atype in ('dx', 'dy', 'dx2', 'dy2', 'dxy'):
+        np.testing.assert_allclose(
+            tools.ZernikeAnnularBasisEval(Z, x, y, e, atype),
+            tools.ZernikeAnnularGrad(Z, x, y, e, atype), atol=1e-10)
+    np.testing.assert_allclose(
+        tools.ZernikeBasisEval(Z, x, y), tools.ZernikeEval(Z, x, y),
+        atol=1e-12)
+    for atype in ('dx', 'dy'):
+        np.testing.assert_allclose(
+            tools.ZernikeBasisEval(Z, x, y, atype),
+            tools.ZernikeGrad(Z, x, y, atype), atol=1e-10)
+
+    # same grid, same basis object; the basis can't be modified
+    basis = tools.ZernikeAnnularBasis(x, y, e, 22)
+    assert basis is tools.ZernikeAnnularBasis(x.copy(), y.copy(), e, 22)
+    assert not basis.flags.writeable
+    assert basis is not tools.ZernikeAnnularBasis(x, y, 0.5, 22)
+
+    # least recently used entries are dropped to stay under maxBytes
+    maxBytes = cache.maxBytes
+    try:
+        cache.clear()
+        cache.maxBytes = 2 * basis.nbytes
+        tools.ZernikeAnnularBasis(x, y, e, 22)
+        tools.ZernikeAnnularBasis(x, y, e, 22, 'dx')
+        tools.ZernikeAnnularBasis(x, y, e, 22, 'dy')
+        assert len(cache) == 2
+        assert cache.nbytes <= cache.maxBytes
+        assert basis is not tools.ZernikeAnnularBasis(x, y, e, 22)
+    finally:
+        cache.maxBytes = maxBytes
+        cache.clear()
+
+
+def test_zernike_masked_fit():
+    """
+    Test that the cached masked fitter recovers the input Zernikes
+    """
+    y, x = np.mgrid[-1.1:1.1:80j, -1.1:1.1:80j]
+    r = np.hypot(x, y)
+    e = 0.4
+    mask = ((r <= 1) & (r >= e)).astype(int)
+    rng = np.random.default_rng(42)
+    Z = rng.standard_normal((3, 22))
+
+    S = np.array([tools.ZernikeAnnularEval(z, x, y, e) for z in Z])
+    np.testing.assert_allclose(
+        tools.ZernikeMaskedFit(S[0], x, y, 22, mask, e), Z[0], atol=1e-10)
+
+    # many surfaces at once, and the fitter is only built once
+    fitter = tools.getZernikeMaskedFitter(x, y, 22, mask, e)
+    assert fitter is tools.getZernikeMaskedFitter(x, y, 22, mask, e)
+    np.testing.assert_allclose(
+        tools.ZernikeMaskedFit(S, x, y, 22, mask, e), Z, atol=1e-10)
+
+    # surfaces with NaNs inside the mask are fitted on their finite pixels
+    S[1, 40, 10:20] = np.nan
+    np.testing.assert_allclose(fitter.fit(S), Z, atol=1e-10)
+
+    S = np.array([tools.ZernikeEval(z, x, y) for z in Z])
+    np.testing.assert_allclose(
+        tools.ZernikeMaskedFit(S, x, y, 22, mask, 0), Z, atol=1e-10)
+
+
+def test_poly_monomials():
+    """
+    Test the monomial-stack polynomial engine against explicit powers
+    """
+    rng = np.random.default_rng(7)
+    x = rng.uniform(-1, 1, (20, 30))
+    y = rng.uniform(-1, 1, (20, 30))
+    for order in (8, 10):
+        c = rng.standard_normal((2, tools.polyNumTerms(order)))
+        exps = [(n - k, k) for n in range(order + 1) for k in range(n + 1)]
+
+        f = sum(c[:, i, None, None] * x**a * y**b
+                for i, (a, b) in enumerate(exps))
+        dfdx = sum(c[:, i, None, None] * a * x**(a - 1) * y**b
+                   for i, (a, b) in enumerate(exps) if a > 0)
+        dfdy = sum(c[:, i, None, None] * b * x**a * y**(b - 1)
+                   for i, (a, b) in enumerate(exps) if b > 0)
+
+        M = tools.polyMonomials(x, y, order)
+        np.testing.assert_allclose(np.tensordot(c, M, axes=1), f)
+        np.testing.assert_allclose(
+            np.tensordot(tools.polyGradCoeff(c, order, 'dx'), M, axes=1),
+            dfdx)
+        np.testing.assert_allclose(
+            np.tensordot(tools.polyGradCoeff(c, order, 'dy'), M, axes=1),
+            dfdy)
+
+    np.testing.assert_allclose(tools.getFunction('poly10_2D')(c[0], x, y=y),
+                               f[0])
+
+
+def test_config_file_cache(tmp_path):
+    """
+    Test that configuration files are parsed once and re-read when changed
+    """
+    paramFile = tmp_path / "test.param"
+    paramFile.write_text("# comment\n###\nblock comment\n###\n"
+                         "Obscuration  0.5\n\nOffset (m)  1.0e-3\n")
+    lines = tools.readParamFile(str(paramFile))
+    assert lines == ('Obscuration  0.5', 'Offset (m)  1.0e-3')
+    assert tools.readParamFile(str(paramFile)) is lines
+
+    paramFile.write_text("Obscuration  0.25\n")
+    assert tools.readParamFile(str(paramFile)) == ('Obscuration  0.25',)
+
+    txtFile = tmp_path / "sequence.txt"
+    txtFile.write_text("4 4 6 6 13 13 22\n")
+    seq = tools.loadTxt(str(txtFile))
+    assert seq is tools.loadTxt(str(txtFile))
+    assert not seq.flags.writeable
+    np.testing.assert_array_equal(seq, [4, 4, 6, 6, 13, 13, 22])
+
+
+def test_poisson_fft_solver():
+    """
+    Test the real-transform Poisson solver against the shifted full FFT
+    """
+    padDim, aps = 64, 0.01
+    rng = np.random.default_rng(3)
+    S = np.zeros((padDim, padDim))
+    S[16:48, 16:48] = rng.standard_normal((32, 32))
+
+    v, u = np.mgrid[-0.5 / aps:0.5 / aps:1 / padDim / aps,
+                    -0.5 / aps:0.5 / aps:1 / padDim / aps]
+    u2v2 = -4 * np.pi**2 * (u * u + v * v)
+    u2v2[padDim // 2, padDim // 2] = np.inf
+    SFFT = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(S)))
+    W = np.fft.fftshift(np.fft.irfft2(np.fft.fftshift(SFFT / u2v2),
+                                      s=S.shape))
+
+    solver = tools.PoissonFFTSolver(padDim, aps, workers=2)
+    assert solver.filter is tools.poissonFilter(padDim, aps, np.float64)
+    solver.work[...] = S
+    np.testing.assert_allclose(solver.solve(), W, atol=1e-12)
+    np.testing.assert_array_equal(solver.work, S)
@@ -66,3 +66,37 @@ def test_matlab_validation():
             aerr = np.abs(matZ - zer)
 
             assert(np.max(aerr) < tol)
+
+
+def test_single_precision_validation():
+    """
+    Test the single precision mode against double precision and matlab
+    """
+    rootdir = getDataDir()
+    validationDir = os.path.join(str(rootdir), 'validation')
+
+    tests = [
+        ('testImages/F1.23_1mm_v61', 'z7_0.25_%s.txt', (0, 0), 'fft', 'paraxial'),
+        ('testImages/LSST_C_SN26',   'z7_0.25_%s.txt', (0, 0), 'exp', 'onAxis'),
+        ('testImages/LSST_NE_SN25',  'z11_0.25_%s.txt', (1.185, 1.185), 'fft', 'offAxis'),
+    ]
+
+    for imgDir, filenameFmt, fldxy, algorithm, model in tests:
+        zer = {}
+        for dtype in (np.float64, np.float32):
+            I1 = Image(readFile(os.path.join(str(rootdir), imgDir, filenameFmt % "intra")),
+                       fldxy, Image.INTRA)
+            I2 = Image(readFile(os.path.join(str(rootdir), imgDir, filenameFmt % "extra")),
+                       fldxy, Image.EXTRA)
+            inst = Instrument('lsst', I1.sizeinPix, dtype=dtype)
+            algo = Algorithm(algorithm, inst, 0)
+            algo.runIt(inst, I1, I2, model)
+            zer[dtype] = algo.zer4UpNm
+
+        assert(I1.image.dtype == np.float32)
+        assert(algo.Wconverge.dtype == np.float32)
+
+        matlabZFile = '%s_%s_%s.txt' % (os.path.basename(imgDir), filenameFmt[:-7], algorithm)
+        matZ = np.loadtxt(os.path.join(validationDir, matlabZFile))
+        assert(np.max(np.abs(matZ - zer[np.float32])) < 10)
+        assert(np.max(np.abs(zer[np.float64] - zer[np.float32])) < 0.01)
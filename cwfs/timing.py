@@ -0,0 +1,138 @@
+# @package cwfs
+# @file timing.py
+##
+# @       Per-stage wall time and counters of a solve
+
+import json
+import time
+from contextlib import nullcontext
+
+# what stage() hands out when timing is off
+_noStage = nullcontext()
+
+
+class StageTimer(object):
+    """
+    Wall time per named stage, series of per-iteration times and counters.
+
+    Use as
+
+        with timer.stage('compensateIntra'):
+            ...
+        laps = timer.laps('innerItr')
+        for i in range(n):
+            ...
+            laps.lap()
+        timer.count('causticImages')
+
+    Stages may nest, so the time of a stage includes that of the stages
+    inside it.  A series keeps every duration rather than only their sum.
+    When the timer is disabled stage() and laps() return shared no-op
+    objects and count() returns at once, so the instrumentation can stay
+    in place.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.series = {}
+        self.counts = {}
+
+    def stage(self, name, series=False):
+        if not self.enabled:
+            return _noStage
+        return _Stage(self, name, series)
+
+    def laps(self, name, series=True):
+        """
+        Return a Laps for name; each of its lap() calls adds the time since
+        the previous one (or since laps()) as one call of the stage, by
+        default to the series.  This times e.g. the body of a loop without
+        re-indenting it.
+        """
+        if not self.enabled:
+            return _noLaps
+        return Laps(self, name, series)
+
+    def add(self, name, seconds, series=False):
+        if series:
+            self.series.setdefault(name, []).append(seconds)
+        else:
+            stage = self.stages.setdefault(name, dict(calls=0, seconds=0.))
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def asDict(self):
+        """
+        Return the stages, series and counts as a dict of plain types,
+        {'stages': {name: {'calls': n, 'seconds': s}},
+         'series': {name: [s, ...]}, 'counts': {name: n}}
+        """
+        return dict(
+            stages={k: dict(v) for k, v in self.stages.items()},
+            series={k: list(v) for k, v in self.series.items()},
+            counts=dict(self.counts))
+
+    def toJSON(self, **extra):
+        """
+        Return asDict(), with the extra keys (e.g. an exposure id) added,
+        as one line of JSON
+        """
+        record = dict(extra)
+        record.update(self.asDict())
+        return json.dumps(record)
+
+    def writeJSONLine(self, fid, **extra):
+        """
+        Append toJSON(**extra) to the open file fid, one solve per line
+        """
+        fid.write(self.toJSON(**extra) + '\n')
+
+
+class _Stage(object):
+    __slots__ = ('timer', 'name', 'series', 'start')
+
+    def __init__(self, timer, name, series):
+        self.timer = timer
+        self.name = name
+        self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start,
+                       self.series)
+        return False
+
+
+class Laps(object):
+    __slots__ = ('timer', 'name', 'series', 'last')
+
+    def __init__(self, timer, name, series):
+        self.timer = timer
+        self.name = name
+        self.series = series
+        self.last = time.perf_counter()
+
+    def lap(self):
+        now = time.perf_counter()
+        self.timer.add(self.name, now - self.last, self.series)
+        self.last = now
+
+
+class _NoLaps(object):
+
+    def lap(self):
+        pass
+
+
+_noLaps = _NoLaps()
@@ -5,10 +5,16 @@
 # @       Large Synoptic Survey Telescope
 
 ##
+import os
 import sys
+import hashlib
+import threading
 import pkg_resources
+from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
+import scipy.fft
 
 from .errors import unknownUnitError
 
@@ -24,7 +30,11 @@ def padArray(inArray, dim):
     if m > dim:
         raise Exception('padArray: array is larger than dimension')
 
-    out = np.zeros((dim, dim))
+    # single precision arrays stay single precision
+    if inArray.dtype == np.float32:
+        out = np.zeros((dim, dim), dtype=np.float32)
+    else:
+        out = np.zeros((dim, dim))
     i = int(np.floor((dim - m) / 2))
     j = int(i + m)
     out[i:j, i:j] = inArray
@@ -715,6 +725,61 @@ def ZernikeAnnularJacobian(Z, x, y, e, atype):
 
     return j
 
+
+def polyNumTerms(order):
+    """Number of coefficients of a 2D polynomial of the given order"""
+    return (order + 1) * (order + 2) // 2
+
+
+def polyMonomials(x, y, order):
+    """
+    Stack of the monomials x**(n-k) * y**k, for n = 0..order and k = 0..n,
+    in the order used by the offAxis_c*_poly*.txt coefficient files.
+
+    Each degree is built from the previous one with a single multiplication
+    by x (plus one by y for the pure y**n term), so a polynomial of any
+    order, and any number of them, is a tensordot of coefficients against
+    this stack.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    M = np.empty((polyNumTerms(order),) + x.shape,
+                 dtype=np.result_type(x, y, float))
+    M[0] = 1
+    i = 1
+    for n in range(1, order + 1):
+        prev = i - n  # first term of degree n - 1
+        np.multiply(M[prev:prev + n], x, out=M[i:i + n])
+        np.multiply(M[prev + n - 1], y, out=M[i + n])
+        i += n + 1
+    return M
+
+
+@lru_cache(maxsize=None)
+def _polyGradMatrix(order, atype):
+    D = np.zeros((polyNumTerms(order), polyNumTerms(order)))
+    for n in range(1, order + 1):
+        for k in range(n + 1):
+            t = n * (n + 1) // 2 + k  # term x**(n-k) * y**k
+            if (atype == 'dx') and (n - k > 0):
+                D[(n - 1) * n // 2 + k, t] = n - k
+            elif (atype == 'dy') and (k > 0):
+                D[(n - 1) * n // 2 + k - 1, t] = k
+    return D
+
+
+def polyGradCoeff(c, order, atype):
+    """
+    Coefficients of the x ('dx') or y ('dy') derivative of the polynomial(s)
+    c, on the same monomial stack as c (see polyMonomials).  c may hold one
+    polynomial per row.
+    """
+    if atype not in ('dx', 'dy'):
+        msg = f"Wrong atype, {atype}. Must be either 'dx' or 'dy'."
+        raise ValueError(msg)
+    return np.dot(c, _polyGradMatrix(order, atype).T)
+
+
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 #
 # Any function you want to use by name outside this file must be put into
@@ -733,87 +798,13 @@ def _poly10_2D(c, data, y=None):
     else:
         x = data
 
-    F = c[0] + c[1] * x + c[2] * y + c[3] * x * x + \
-        c[4] * x * y + c[5] * y * y + c[6] * x**3 + \
-        c[7] * x**2 * y + c[8] * x * y**2 + c[9] * y**3 + \
-        c[10] * x**4 + c[11] * x**3 * y + c[12] * x**2 * y**2 + \
-        c[13] * x * y**3 + c[14] * y**4 + c[15] * x**5 + \
-        c[16] * x**4 * y + c[17] * x**3 * y**2 + c[18] * x**2 * y**3 + \
-        c[19] * x * y**4 + c[20] * y**5 + c[21] * x**6 + \
-        c[22] * x**5 * y + c[23] * x**4 * y**2 + c[24] * x**3 * y**3 + \
-        c[25] * x**2 * y**4 + c[26] * x * y**5 + c[27] * y**6 + \
-        c[28] * x**7 + c[29] * x**6 * y + c[30] * x**5 * y**2 + \
-        c[31] * x**4 * y**3 + c[32] * x**3 * y**4 + c[33] * x**2 * y**5 + \
-        c[34] * x * y**6 + c[35] * y**7 + c[36] * x**8 + \
-        c[37] * x**7 * y + c[38] * x**6 * y**2 + c[39] * x**5 * y**3 + \
-        c[40] * x**4 * y**4 + c[41] * x**3 * y**5 + c[42] * x**2 * y**6 + \
-        c[43] * x * y**7 + c[44] * y**8 + c[45] * x**9 + \
-        c[46] * x**8 * y + c[47] * x**7 * y**2 + c[48] * x**6 * y**3 + \
-        c[49] * x**5 * y**4 + c[50] * x**4 * y**5 + c[51] * x**3 * y**6 + \
-        c[52] * x**2 * y**7 + c[53] * x * y**8 + c[54] * y**9 + \
-        c[55] * x**10 + c[56] * x**9 * y + c[57] * x**8 * y**2 + \
-        c[58] * x**7 * y**3 + c[59] * x**6 * y**4 + c[60] * x**5 * y**5 + \
-        c[61] * x**4 * y**6 + c[62] * x**3 * y**7 + c[63] * x**2 * y**8 + \
-        c[64] * x * y**9 + c[65] * y**10
-
-    return F
+    return np.tensordot(c, polyMonomials(x, y, 10), axes=1)
 
 
 def _poly10Grad(c, x, y, atype):
 
-    if (atype == 'dx'):
-        out = c[1] + c[3] * 2 * x + c[4] * y + c[6] * 3 * x**2 + \
-            c[7] * 2 * x * y + c[8] * y**2 + c[10] * 4 * x**3 + \
-            c[11] * 3 * x**2 * y + c[12] * 2 * x * y**2 + c[13] * y**3 + \
-            c[15] * 5 * x**4 + c[16] * 4 * x**3 * y + \
-            c[17] * 3 * x**2 * y**2 + \
-            c[18] * 2 * x * y**3 + c[19] * y**4 + c[21] * 6 * x**5 + \
-            c[22] * 5 * x**4 * y + c[23] * 4 * x**3 * y**2 + \
-            c[24] * 3 * x**2 * y**3 + c[25] * 2 * x * y**4 + c[26] * y**5 + \
-            c[28] * 7 * x**6 + c[29] * 6 * x**5 * y + \
-            c[30] * 5 * x**4 * y**2 + \
-            c[31] * 4 * x**3 * y**3 + c[32] * 3 * x**2 * y**4 + \
-            c[33] * 2 * x * y**5 + c[34] * y**6 + \
-            c[36] * 8 * x**7 + c[37] * 7 * x**6 * y + \
-            c[38] * 6 * x**5 * y**2 + \
-            c[39] * 5 * x**4 * y**3 + c[40] * 4 * x**3 * y**4 + \
-            c[41] * 3 * x**2 * y**5 + c[42] * 2 * x * y**6 + c[43] * y**7 + \
-            c[45] * 9 * x**8 + c[46] * 8 * x**7 * y + \
-            c[47] * 7 * x**6 * y**2 + \
-            c[48] * 6 * x**5 * y**3 + c[49] * 5 * x**4 * y**4 + \
-            c[50] * 4 * x**3 * y**5 + c[51] * 3 * x**2 * y**6 + \
-            c[52] * 2 * x * y**7 + c[53] * y**8 + c[55] * 10 * x**9 + \
-            c[56] * 9 * x**8 * y + c[57] * 8 * x**7 * y**2 + \
-            c[58] * 7 * x**6 * y**3 + c[59] * 6 * x**5 * y**4 + \
-            c[60] * 5 * x**4 * y**5 + c[61] * 4 * x**3 * y**6 + \
-            c[62] * 3 * x**2 * y**7 + c[63] * 2 * x * y**8 + c[64] * y**9
-
-    elif (atype == 'dy'):
-        out = c[2] + c[4] * x + c[5] * 2 * y + c[7] * x**2 + \
-            c[8] * x * 2 * y + c[9] * 3 * y**2 + c[11] * x**3 + \
-            c[12] * x**2 * 2 * y + c[13] * x * 3 * y**2 + c[14] * 4 * y**3 + \
-            c[16] * x**4 + c[17] * x**3 * 2 * y + c[18] * x**2 * 3 * y**2 + \
-            c[19] * x * 4 * y**3 + c[20] * 5 * y**4 + c[22] * x**5 + \
-            c[23] * x**4 * 2 * y + c[24] * x**3 * 3 * y**2 + \
-            c[25] * x**2 * 4 * y**3 + c[26] * x * 5 * y**4 + \
-            c[27] * 6 * y**5 + c[29] * x**6 + c[30] * x**5 * 2 * y + \
-            c[31] * x**4 * 3 * y**2 + c[32] * x**3 * 4 * y**3 + \
-            c[33] * x**2 * 5 * y**4 + c[34] * x * 6 * y**5 + \
-            c[35] * 7 * y**6 + \
-            c[37] * x**7 + c[38] * x**6 * 2 * y + c[39] * x**5 * 3 * y**2 + \
-            c[40] * x**4 * 4 * y**3 + c[41] * x**3 * 5 * y**4 + \
-            c[42] * x**2 * 6 * y**5 + c[43] * x * 7 * y**6 + \
-            c[44] * 8 * y**7 + \
-            c[46] * x**8 + c[47] * x**7 * 2 * y + c[48] * x**6 * 3 * y**2 + \
-            c[49] * x**5 * 4 * y**3 + c[50] * x**4 * 5 * y**4 + \
-            c[51] * x**3 * 6 * y**5 + c[52] * x**2 * 7 * y**6 + \
-            c[53] * x * 8 * y**7 + c[54] * 9 * y**8 + c[56] * x**9 + \
-            c[57] * x**8 * 2 * y + c[58] * x**7 * 3 * y**2 + \
-            c[59] * x**6 * 4 * y**3 + c[60] * x**5 * 5 * y**4 + \
-            c[61] * x**4 * 6 * y**5 + c[62] * x**3 * 7 * y**6 + \
-            c[63] * x**2 * 8 * y**7 + c[64] * x * 9 * y**8 + c[65] * 10 * y**9
-
-    return out
+    return np.tensordot(polyGradCoeff(c, 10, atype),
+                        polyMonomials(x, y, 10), axes=1)
 
 
 try:
@@ -853,16 +844,11 @@ def extractArray(inArray, dim):
 
 
 def ZernikeMaskedFit(S, x, y, numTerms, mask, e):
-
-    j, i = np.nonzero(mask[:])
-    S = S[i, j]
-    x = x[i, j]
-    y = y[i, j]
-    if (e > 0):
-        Z = ZernikeAnnularFit(S, x, y, numTerms, e)
-    else:
-        Z = ZernikeFit(S, x, y, numTerms)
-    return Z
+    """
+    Fit numTerms (annular, if e > 0) Zernikes to S on the pixels where mask
+    is non-zero.  S can also be a stack of surfaces, see ZernikeMaskedFitter.
+    """
+    return getZernikeMaskedFitter(x, y, numTerms, mask, e).fit(S)
 
 
 def ZernikeFit(S, x, y, numTerms):
@@ -1113,6 +1099,350 @@ def ZernikeAnnularEval(Z, x, y, e):
     return S
 
 
+class LRUCache(object):
+    """
+    Least-recently-used cache bounded by the total size of its entries.
+
+    Entries are built on demand by get(key, build) and must have an nbytes
+    attribute (numpy arrays do).  The oldest entries are dropped once the
+    cache holds more than maxBytes.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key, build):
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                self._cache[key] = value
+                return value
+
+        value = build()
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = value
+                self.nbytes += value.nbytes
+            while self.nbytes > self.maxBytes and len(self._cache) > 0:
+                _, old = self._cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+
+
+# the Zernike basis stacks are keyed by a digest of the grid together with
+# the obscuration, the number of terms and the derivative type.
+_zernikeBasisCache = LRUCache(maxBytes=512 * 1024**2)
+# least-squares fitters, keyed by grid, mask, obscuration and number of terms
+_zernikeFitterCache = LRUCache(maxBytes=256 * 1024**2)
+
+
+def getZernikeBasisCache():
+    """
+    Return the process-wide cache used by ZernikeBasis() and
+    ZernikeAnnularBasis(), e.g. to change its maxBytes or clear() it
+    """
+    return _zernikeBasisCache
+
+
+def getZernikeFitterCache():
+    """
+    Return the process-wide cache used by getZernikeMaskedFitter()
+    """
+    return _zernikeFitterCache
+
+
+def _gridKey(*arrays):
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).view(np.uint8))
+    return tuple((a.shape, a.dtype.str) for a in arrays) + (h.hexdigest(),)
+
+
+def _buildBasis(func, numTerms, x, *args):
+    basis = np.zeros((numTerms,) + x.shape, dtype=x.dtype)
+    Z = np.zeros(numTerms)
+    for i in range(numTerms):
+        Z[i] = 1
+        basis[i] = func(Z, x, *args)
+        Z[i] = 0
+    basis.setflags(write=False)
+    return basis
+
+
+def ZernikeBasis(x, y, numTerms, atype=None):
+    """
+    Stack of the first numTerms Zernikes evaluated on (x, y).
+
+    atype=None gives the Zernikes themselves (see ZernikeEval), 'dx' or
+    'dy' gives their derivatives (see ZernikeGrad).  The stack is built
+    once per grid and kept in the Zernike basis cache.
+    """
+    numTerms = int(numTerms)
+    key = ('std', _gridKey(x, y), numTerms, atype)
+    if atype is None:
+        def build():
+            return _buildBasis(ZernikeEval, numTerms, x, y)
+    else:
+        def build():
+            return _buildBasis(ZernikeGrad, numTerms, x, y, atype)
+    return _zernikeBasisCache.get(key, build)
+
+
+def ZernikeAnnularBasis(x, y, e, numTerms, atype=None):
+    """
+    Stack of the first numTerms annular Zernikes evaluated on (x, y).
+
+    atype=None gives the Zernikes themselves (see ZernikeAnnularEval),
+    'dx', 'dy', 'dx2', 'dy2' or 'dxy' gives their derivatives (see
+    ZernikeAnnularGrad).  The stack is built once per grid and kept in the
+    Zernike basis cache.
+    """
+    numTerms = int(numTerms)
+    key = ('annular', _gridKey(x, y), float(e), numTerms, atype)
+    if atype is None:
+        def build():
+            return _buildBasis(ZernikeAnnularEval, numTerms, x, y, e)
+    else:
+        def build():
+            return _buildBasis(ZernikeAnnularGrad, numTerms, x, y, e, atype)
+    return _zernikeBasisCache.get(key, build)
+
+
+def ZernikeBasisEval(Z, x, y, atype=None):
+    """
+    Same as ZernikeEval(Z, x, y) (atype=None) or ZernikeGrad(Z, x, y, atype),
+    but computed from the cached basis.  Use this for grids that are
+    evaluated over and over.  The result has the precision of the grid.
+    """
+    basis = ZernikeBasis(x, y, len(Z), atype)
+    return np.tensordot(np.asarray(Z, dtype=basis.dtype), basis, axes=1)
+
+
+def ZernikeAnnularBasisEval(Z, x, y, e, atype=None):
+    """
+    Same as ZernikeAnnularEval(Z, x, y, e) (atype=None) or
+    ZernikeAnnularGrad(Z, x, y, e, atype), but computed from the cached
+    basis.  Use this for grids that are evaluated over and over.  The
+    result has the precision of the grid.
+    """
+    basis = ZernikeAnnularBasis(x, y, e, len(Z), atype)
+    return np.tensordot(np.asarray(Z, dtype=basis.dtype), basis, axes=1)
+
+
+def ZernikeGradSums(x, y, e, numTerms, dI, image, tileSize):
+    """
+    The sums over the samples (x, y) that the exp Poisson solver needs,
+
+    F[i]    = sum(dI * Z_i)
+    M[i, j] = sum(image * (dZ_i/dx dZ_j/dx + dZ_i/dy dZ_j/dy))
+
+    for the first numTerms annular Zernikes with obscuration e, or the
+    standard ones for e=0.  The samples are streamed tileSize at a time and
+    nothing is cached, so only (numTerms x tileSize) basis values exist at
+    any time.  The sums are accumulated in double precision.
+    """
+    numTerms = int(numTerms)
+    x = np.ravel(x)
+    y = np.ravel(y)
+    dI = np.ravel(dI)
+    image = np.ravel(image)
+    F = np.zeros(numTerms)
+    M = np.zeros((numTerms, numTerms))
+    for i0 in range(0, x.size, tileSize):
+        xt = x[np.newaxis, i0:i0 + tileSize]
+        yt = y[np.newaxis, i0:i0 + tileSize]
+        if (e > 0):
+            Z = _buildBasis(ZernikeAnnularEval, numTerms, xt, yt, e)
+            Gx = _buildBasis(ZernikeAnnularGrad, numTerms, xt, yt, e, 'dx')
+            Gy = _buildBasis(ZernikeAnnularGrad, numTerms, xt, yt, e, 'dy')
+        else:
+            Z = _buildBasis(ZernikeEval, numTerms, xt, yt)
+            Gx = _buildBasis(ZernikeGrad, numTerms, xt, yt, 'dx')
+            Gy = _buildBasis(ZernikeGrad, numTerms, xt, yt, 'dy')
+        Z = Z[:, 0, :].astype(float, copy=False)
+        Gx = Gx[:, 0, :].astype(float, copy=False)
+        Gy = Gy[:, 0, :].astype(float, copy=False)
+        It = image[i0:i0 + tileSize]
+        F += np.dot(Z, dI[i0:i0 + tileSize])
+        M += np.dot(Gx * It, Gx.T) + np.dot(Gy * It, Gy.T)
+    return F, M
+
+
+class ZernikeMaskedFitter(object):
+    """
+    Least-squares Zernike fit of surfaces sampled on a fixed grid and mask.
+
+    The pseudo-inverse of the masked design matrix is computed once, so each
+    fit is a single matrix product.  Use getZernikeMaskedFitter() to get a
+    cached fitter rather than building one directly.
+    """
+
+    def __init__(self, x, y, numTerms, mask, e):
+        self.numTerms = int(numTerms)
+        self.e = e
+        self.mask = mask != 0
+
+        # the fit is always done in double precision
+        x = x[self.mask].astype(float)
+        y = y[self.mask].astype(float)
+        self.valid = np.isfinite(x + y)
+        x = x[self.valid]
+        y = y[self.valid]
+        # design matrix H, (npix x numTerms)
+        if (e > 0):
+            H = _buildBasis(ZernikeAnnularEval, self.numTerms, x, y, e).T
+        else:
+            H = _buildBasis(ZernikeEval, self.numTerms, x, y).T
+        self.x = x
+        self.y = y
+        self.pinvH = np.linalg.pinv(H)
+        self.nbytes = self.pinvH.nbytes + x.nbytes + y.nbytes
+
+    def fit(self, S):
+        """
+        Fit S, a 2-d surface or a stack of them, with shape (..., m, n).
+        Returns the coefficients with shape (..., numTerms).
+        """
+        S = S[..., self.mask][..., self.valid]
+        if np.all(np.isfinite(S)):
+            return np.dot(S, self.pinvH.T)
+
+        # some of the surfaces have holes in them. fit those one by one on
+        # the finite pixels only, as ZernikeFit/ZernikeAnnularFit do.
+        Z = np.zeros(S.shape[:-1] + (self.numTerms,))
+        for idx in np.ndindex(S.shape[:-1]):
+            if (self.e > 0):
+                Z[idx] = ZernikeAnnularFit(
+                    S[idx], self.x, self.y, self.numTerms, self.e)
+            else:
+                Z[idx] = ZernikeFit(S[idx], self.x, self.y, self.numTerms)
+        return Z
+
+
+def getZernikeMaskedFitter(x, y, numTerms, mask, e):
+    """
+    Return the ZernikeMaskedFitter for this grid, mask, number of terms and
+    obscuration, building it only if it isn't in the fitter cache yet.
+    """
+    key = (_gridKey(x, y, mask), float(e), int(numTerms))
+    return _zernikeFitterCache.get(
+        key, lambda: ZernikeMaskedFitter(x, y, numTerms, mask, e))
+
+
+@lru_cache(maxsize=32)
+def poissonFilter(padDim, aperturePixelSize, dtype=np.float64):
+    """
+    The inverse Laplacian 1 / (-4 pi^2 (u^2 + v^2)) on the half-spectrum
+    grid of scipy.fft.rfft2 for a (padDim x padDim) array with pixels of
+    aperturePixelSize, with 0 at the origin.  The array is cached and
+    read-only.
+    """
+    v = scipy.fft.fftfreq(padDim, aperturePixelSize)[:, np.newaxis]
+    u = scipy.fft.rfftfreq(padDim, aperturePixelSize)[np.newaxis, :]
+    u2v2 = -4 * (np.pi**2) * (u * u + v * v)
+    # Set origin to Inf to result in 0 at origin after filtering
+    u2v2[0, 0] = np.inf
+    H = (1 / u2v2).astype(dtype)
+    H.flags.writeable = False
+    return H
+
+
+class PoissonFFTSolver(object):
+    """
+    Solve the Poisson equation del2 W = S on a (padDim x padDim) grid by
+    FFT, with real-input transforms.
+
+    The filter comes from poissonFilter(), and work holds a padded signal
+    buffer that callers can fill in place, so nothing padDim-sized is
+    allocated per iteration besides the transforms themselves.  workers is
+    passed on to scipy.fft, -1 meaning all cores.  With dtype=np.float32
+    the transforms are done in single precision.
+    """
+
+    def __init__(self, padDim, aperturePixelSize, workers=None,
+                 dtype=np.float64):
+        self.padDim = padDim
+        self.aperturePixelSize = aperturePixelSize
+        self.workers = workers
+        self.dtype = np.dtype(dtype)
+        self.filter = poissonFilter(padDim, aperturePixelSize, self.dtype.type)
+        self.work = np.zeros((padDim, padDim), dtype=self.dtype)
+
+    def solve(self, S=None):
+        """
+        Return W for the signal S, by default the work buffer.  The
+        centering fftshifts of the signal and the wavefront cancel for an
+        even padDim, so none are needed.
+        """
+        if S is None:
+            S = self.work
+        spectrum = scipy.fft.rfft2(S, workers=self.workers)
+        spectrum *= self.filter
+        return scipy.fft.irfft2(spectrum, s=S.shape, workers=self.workers,
+                                overwrite_x=True)
+
+
+def _fileKey(filename):
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    return filename, st.st_mtime_ns, st.st_size
+
+
+def readParamFile(filename):
+    """
+    Return the parameter lines of a .param or .algo file as a tuple of
+    stripped strings, leaving out comments and ### blocks.
+
+    Files are parsed once per process; the result is reused for as long as
+    the file's modification time and size are unchanged.
+    """
+    return _readParamFile(*_fileKey(filename))
+
+
+@lru_cache(maxsize=256)
+def _readParamFile(filename, mtime, size):
+    lines = []
+    iscomment = False
+    with open(filename) as fid:
+        for line in fid:
+            line = line.strip()
+            if (line.startswith('###')):
+                iscomment = ~iscomment
+            if (not(line.startswith('#')) and
+                    (not iscomment) and len(line) > 0):
+                lines.append(line)
+    return tuple(lines)
+
+
+def loadTxt(filename):
+    """
+    np.loadtxt() for configuration data files (compensation sequences,
+    mask and off-axis correction parameters).  Files are read once per
+    process and the returned array is read-only, so copy it before
+    modifying it.
+    """
+    return _loadTxt(*_fileKey(filename))
+
+
+@lru_cache(maxsize=256)
+def _loadTxt(filename, mtime, size):
+    data = np.loadtxt(filename)
+    data.setflags(write=False)
+    return data
+
+
 def outParam(filename, algo, inst, I1, I2, model):
     if (filename == ''):
         fout = sys.stdout
@@ -1120,33 +1450,20 @@ def outParam(filename, algo, inst, I1, I2, model):
         fout = open(filename, 'w')
 
     fout.write('intra image: \t %s \t field in deg =(%6.3f, %6.3f)\n' %
-               (I1.name, I1.fieldX, I1.fieldY))
+               (getattr(I1, 'name', ''), I1.fieldX, I1.fieldY))
     fout.write('extra image: \t %s \t field in deg =(%6.3f, %6.3f)\n' %
-               (I2.name, I2.fieldX, I2.fieldY))
+               (getattr(I2, 'name', ''), I2.fieldX, I2.fieldY))
     fout.write('Using optical model:\t %s\n' % model)
     fout.write('\n')
-    finst = open(inst.filename)
+    # the parameter lines as they were read when inst and algo were set up
     fout.write('---instrument file: --- %s ----------\n' % inst.filename)
-    iscomment = False
-    for line in finst:
-        line = line.strip()
-        if (line.startswith('###')):
-            iscomment = ~iscomment
-        if (not(line.startswith('#')) and (not iscomment) and len(line) > 0):
-            fout.write(line + '\n')
-    finst.close()
+    for line in inst.params:
+        fout.write(line + '\n')
 
     fout.write('\n')
-    falgo = open(algo.filename)
-    fout.write('---algorithm file: --- %s ----------\n' % inst.filename)
-    iscomment = False
-    for line in falgo:
-        line = line.strip()
-        if (line.startswith('###')):
-            iscomment = ~iscomment
-        if (not(line.startswith('#')) and (not iscomment) and len(line) > 0):
-            fout.write(line + '\n')
-    falgo.close()
+    fout.write('---algorithm file: --- %s ----------\n' % algo.filename)
+    for line in algo.params:
+        fout.write(line + '\n')
 
     if not (filename == ''):
         fout.close()